@@ -35,8 +35,8 @@ def main():
     with open(args.config) as handle:
         conf = RetrieverConfig(json.load(handle))
 
-    retriever = Retriever(conf)
-    retriever.retrieve()
+    with Retriever(conf) as retriever:
+        retriever.retrieve()
 
 
 if __name__ == '__main__':
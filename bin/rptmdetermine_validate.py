@@ -37,13 +37,13 @@ def main():
     with open(args.config) as handle:
         conf = ValidatorConfig(json.load(handle))
 
-    validator = Validator(conf)
-    validator.validate()
+    with Validator(conf) as validator:
+        validator.validate()
 
-    with open(validator.file_prefix + "validated_psms", "wb") as fh:
-        pickle.dump(validator.psms, fh)
+        with open(validator.file_prefix + "validated_psms", "wb") as fh:
+            pickle.dump(validator.psms, fh)
 
-    validator.localize()
+        validator.localize()
 
     write_results(validator.file_prefix + "results.csv", validator.psms)
 
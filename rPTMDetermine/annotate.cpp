@@ -1,6 +1,8 @@
 #include <Python.h>
+#include <algorithm>
 #include <cmath>
 #include <map>
+#include <stdexcept>
 #include <string>
 #include <utility>
 #include <vector>
@@ -8,6 +10,36 @@
 #include "annotate.h"
 #include "annotation.h"
 #include "converters.h"
+
+long findPeak(
+		const double* mzArray,
+		const size_t numPeaks,
+		const size_t mzStride,
+		const double mass,
+		const double tol,
+		double& delta)
+{
+	// mzArray is sorted, so mass - mz decreases along the array and the
+	// peaks within tolerance of the ion form a contiguous run. The first of
+	// these is the first peak not more than tol below the ion. The m/z
+	// values are mzStride elements apart, e.g. the first column of the
+	// peak array
+	size_t lower = 0;
+	size_t upper = numPeaks;
+	while (lower < upper) {
+		const size_t mid = lower + (upper - lower) / 2;
+		if (mass - mzArray[mid * mzStride] > tol) {
+			lower = mid + 1;
+		}
+		else {
+			upper = mid;
+		}
+	}
+	if (lower == numPeaks) return -1;
+
+	delta = mass - mzArray[lower * mzStride];
+	return std::fabs(delta) <= tol ? static_cast<long>(lower) : -1;
+}
 	
 std::map<std::string, Annotation> annotate(
 		const std::vector<double>& mzArray,
@@ -16,28 +48,120 @@ std::map<std::string, Annotation> annotate(
 {
 	std::map<std::string, Annotation> anns = std::map<std::string, Annotation>();
 
-	int startIdx = 0;
 	for (const Ion& ion : theorIons) {
-		for (int idx = 0; idx < mzArray.size(); idx++) {
-			double mz = mzArray[idx];
-			double delta = ion.mass - mz;
-			if (abs(delta) <= tol) {
-				anns.emplace(std::piecewise_construct,
-							 std::forward_as_tuple(ion.label),
-							 std::forward_as_tuple(idx, delta, ion.position));
-				startIdx = idx;
-				break;
-			}
-			if (mz > ion.mass + tol) {
-				startIdx = idx;
-				break;
-			}
+		double delta;
+		long index = findPeak(mzArray.data(), mzArray.size(), 1, ion.mass, tol, delta);
+		if (index >= 0) {
+			anns.emplace(std::piecewise_construct,
+						 std::forward_as_tuple(ion.label),
+						 std::forward_as_tuple(index, delta, ion.position));
 		}
 	}
 
 	return anns;
 }
 
+int64_t countLabels(const int64_t* labelIndices, const size_t numIons) {
+	int64_t numLabels = 0;
+	for (size_t ii = 0; ii < numIons; ii++) {
+		if (labelIndices[ii] < 0) {
+			throw std::logic_error("Label indices must be non-negative");
+		}
+		numLabels = std::max(numLabels, labelIndices[ii] + 1);
+	}
+	return numLabels;
+}
+
+/* Annotates the ions in [ionStart, ionEnd), retaining the first matched ion
+   for each label, as in annotate. The matched ions are recorded in byLabel
+   and flagged in matched, which must be sized to the number of labels */
+void annotateLabels(
+		const double* mzArray,
+		const size_t numPeaks,
+		const size_t mzStride,
+		const double* ionMasses,
+		const int64_t* ionPositions,
+		const int64_t* labelIndices,
+		const size_t ionStart,
+		const size_t ionEnd,
+		const double tol,
+		std::vector<AnnotationRecord>& byLabel,
+		std::vector<bool>& matched)
+{
+	for (size_t ii = ionStart; ii < ionEnd; ii++) {
+		const int64_t label = labelIndices[ii];
+		if (matched[label]) continue;
+
+		double delta;
+		long index = findPeak(mzArray, numPeaks, mzStride, ionMasses[ii], tol,
+							  delta);
+		if (index >= 0) {
+			byLabel[label] = {label, index, delta, ionPositions[ii]};
+			matched[label] = true;
+		}
+	}
+}
+
+std::vector<AnnotationRecord> annotateArrays(
+		const double* mzArray,
+		const size_t numPeaks,
+		const size_t mzStride,
+		const double* ionMasses,
+		const int64_t* ionPositions,
+		const int64_t* labelIndices,
+		const size_t numIons,
+		const double tol)
+{
+	const int64_t numLabels = countLabels(labelIndices, numIons);
+
+	std::vector<AnnotationRecord> byLabel(numLabels);
+	std::vector<bool> matched(numLabels, false);
+	annotateLabels(mzArray, numPeaks, mzStride, ionMasses, ionPositions,
+				   labelIndices, 0, numIons, tol, byLabel, matched);
+
+	std::vector<AnnotationRecord> records;
+	for (int64_t label = 0; label < numLabels; label++) {
+		if (matched[label]) records.push_back(byLabel[label]);
+	}
+
+	return records;
+}
+
+std::vector<BatchAnnotationRecord> annotateBatch(
+		const double* mzArray,
+		const size_t numPeaks,
+		const size_t mzStride,
+		const double* ionMasses,
+		const int64_t* ionPositions,
+		const int64_t* labelIndices,
+		const int64_t* ionOffsets,
+		const size_t numPeptides,
+		const double tol)
+{
+	const int64_t numLabels = countLabels(labelIndices, ionOffsets[numPeptides]);
+
+	// The per-label buffers are reused across peptides, resetting only the
+	// labels matched for the previous peptide
+	std::vector<AnnotationRecord> byLabel(numLabels);
+	std::vector<bool> matched(numLabels, false);
+	std::vector<BatchAnnotationRecord> records;
+	for (size_t pep = 0; pep < numPeptides; pep++) {
+		annotateLabels(mzArray, numPeaks, mzStride, ionMasses, ionPositions,
+					   labelIndices, ionOffsets[pep], ionOffsets[pep + 1], tol,
+					   byLabel, matched);
+
+		for (int64_t label = 0; label < numLabels; label++) {
+			if (!matched[label]) continue;
+			const AnnotationRecord& ann = byLabel[label];
+			records.push_back({static_cast<int64_t>(pep), label, ann.index,
+							   ann.delta_mass, ann.position});
+			matched[label] = false;
+		}
+	}
+
+	return records;
+}
+
 PyObject* python_annotate(PyObject* module, PyObject* args) {
 	PyObject* mzList = NULL;
 	PyObject* theorIons = NULL;
@@ -59,3 +183,118 @@ PyObject* python_annotate(PyObject* module, PyObject* args) {
         return NULL;
     }
 }
+
+PyObject* python_annotate_arrays(PyObject* module, PyObject* args) {
+	PyObject* mzArray = NULL;
+	PyObject* ionMasses = NULL;
+	PyObject* ionPositions = NULL;
+	PyObject* labelIndices = NULL;
+	PyObject* tol = NULL;
+
+	if (!PyArg_UnpackTuple(args, "cpython_annotate_arrays", 5, 5, &mzArray,
+						   &ionMasses, &ionPositions, &labelIndices, &tol)) {
+		return NULL;
+	}
+
+	try {
+		ColumnView<double> mzView(mzArray, "d");
+		BufferView<double> massView(ionMasses, "d");
+		BufferView<int64_t> positionView(ionPositions, "lq");
+		BufferView<int64_t> labelView(labelIndices, "lq");
+
+		if (positionView.size() != massView.size() ||
+				labelView.size() != massView.size()) {
+			throw std::logic_error("Ion arrays must be of equal length");
+		}
+
+		return annotationRecordsToBytes(
+			annotateArrays(
+				mzView.data(),
+				mzView.size(),
+				mzView.stride(),
+				massView.data(),
+				positionView.data(),
+				labelView.data(),
+				massView.size(),
+				PyFloat_AsDouble(tol)
+			)
+		);
+	}
+	catch (const std::exception& ex) {
+		PyErr_SetString(PyExc_RuntimeError, ex.what());
+		return NULL;
+	}
+}
+
+PyObject* python_annotate_batch(PyObject* module, PyObject* args) {
+	PyObject* mzArray = NULL;
+	PyObject* ionMasses = NULL;
+	PyObject* ionPositions = NULL;
+	PyObject* labelIndices = NULL;
+	PyObject* ionOffsets = NULL;
+	PyObject* tol = NULL;
+
+	if (!PyArg_UnpackTuple(args, "cpython_annotate_batch", 6, 6, &mzArray,
+						   &ionMasses, &ionPositions, &labelIndices,
+						   &ionOffsets, &tol)) {
+		return NULL;
+	}
+
+	try {
+		ColumnView<double> mzView(mzArray, "d");
+		BufferView<double> massView(ionMasses, "d");
+		BufferView<int64_t> positionView(ionPositions, "lq");
+		BufferView<int64_t> labelView(labelIndices, "lq");
+		BufferView<int64_t> offsetView(ionOffsets, "lq");
+		const double tolValue = PyFloat_AsDouble(tol);
+
+		if (positionView.size() != massView.size() ||
+				labelView.size() != massView.size()) {
+			throw std::logic_error("Ion arrays must be of equal length");
+		}
+
+		const size_t numOffsets = offsetView.size();
+		const int64_t* offsets = offsetView.data();
+		if (numOffsets == 0 || offsets[0] != 0 ||
+				offsets[numOffsets - 1] != static_cast<int64_t>(massView.size())) {
+			throw std::logic_error(
+				"Ion offsets must run from zero to the number of ions");
+		}
+		for (size_t ii = 1; ii < numOffsets; ii++) {
+			if (offsets[ii] < offsets[ii - 1]) {
+				throw std::logic_error("Ion offsets must be non-decreasing");
+			}
+		}
+
+		// The buffers are held by the views, so the annotation can proceed
+		// without the GIL
+		std::vector<BatchAnnotationRecord> records;
+		std::string error;
+		Py_BEGIN_ALLOW_THREADS
+		try {
+			records = annotateBatch(
+				mzView.data(),
+				mzView.size(),
+				mzView.stride(),
+				massView.data(),
+				positionView.data(),
+				labelView.data(),
+				offsets,
+				numOffsets - 1,
+				tolValue
+			);
+		}
+		catch (const std::exception& ex) {
+			error = ex.what();
+		}
+		Py_END_ALLOW_THREADS
+
+		if (!error.empty()) throw std::runtime_error(error);
+
+		return annotationRecordsToBytes(records);
+	}
+	catch (const std::exception& ex) {
+		PyErr_SetString(PyExc_RuntimeError, ex.what());
+		return NULL;
+	}
+}
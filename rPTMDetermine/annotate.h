@@ -8,13 +8,46 @@
 
 #include "annotation.h"
 
+long findPeak(
+	const double* mzArray,
+	const size_t numPeaks,
+	const size_t mzStride,
+	const double mass,
+	const double tol,
+	double& delta);
+
 std::map<std::string, Annotation> annotate(
 	const std::vector<double>& mzArray,
 	const std::vector<Ion>& theorIons,
 	const double tol);
+
+std::vector<AnnotationRecord> annotateArrays(
+	const double* mzArray,
+	const size_t numPeaks,
+	const size_t mzStride,
+	const double* ionMasses,
+	const int64_t* ionPositions,
+	const int64_t* labelIndices,
+	const size_t numIons,
+	const double tol);
+
+std::vector<BatchAnnotationRecord> annotateBatch(
+	const double* mzArray,
+	const size_t numPeaks,
+	const size_t mzStride,
+	const double* ionMasses,
+	const int64_t* ionPositions,
+	const int64_t* labelIndices,
+	const int64_t* ionOffsets,
+	const size_t numPeptides,
+	const double tol);
 	
 extern "C" {
 	PyObject* python_annotate(PyObject* module, PyObject* args);
+
+	PyObject* python_annotate_arrays(PyObject* module, PyObject* args);
+
+	PyObject* python_annotate_batch(PyObject* module, PyObject* args);
 }
 
 #endif // _RPTMDETERMINE_ANNOTATE_H
\ No newline at end of file
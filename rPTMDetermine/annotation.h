@@ -2,6 +2,7 @@
 #define _RPTMDETERMINE_ANNOTATION_H
 
 #include <Python.h>
+#include <cstdint>
 #include <string>
 
 struct Annotation {
@@ -22,6 +23,25 @@ struct Annotation {
 	}
 };
 
+/* The fixed layout of an annotation returned in a buffer, matching the
+   ANNOTATION_DTYPE numpy structured dtype */
+struct AnnotationRecord {
+	int64_t label_index;
+	int64_t index;
+	double delta_mass;
+	int64_t position;
+};
+
+/* An AnnotationRecord tagged with the index of the ion set, i.e. peptide, to
+   which it belongs, matching the BATCH_ANNOTATION_DTYPE numpy dtype */
+struct BatchAnnotationRecord {
+	int64_t pep_index;
+	int64_t label_index;
+	int64_t index;
+	double delta_mass;
+	int64_t position;
+};
+
 struct Ion {
 	double mass;
 	std::string label;
@@ -62,6 +62,7 @@ class BaseConfig():
         "spectra_cache_file",
         "activation_mode",
         "activation_energy",
+        "spectra_workers",
     ]
 
     def __init__(self, json_config: Dict[str, Any],
@@ -253,7 +254,8 @@ class BaseConfig():
     @property
     def spectra_cache_file(self) -> Optional[str]:
         """
-        The location at which to store the pickle spectra cache.
+        The location at which to store the spectra cache directory. This
+        must not be an existing file.
 
         """
         return self.json_config.get("spectra_cache_file", None)
@@ -274,6 +276,16 @@ class BaseConfig():
         """
         return self.json_config.get("activation_energy", None)
 
+    @property
+    def spectra_workers(self) -> Optional[int]:
+        """
+        The number of worker processes with which to read and preprocess the
+        spectra files. If 1, the files are read in the main process. If
+        None, the shared process pool, with one worker per CPU, is used.
+
+        """
+        return self.json_config.get("spectra_workers", None)
+
     def _check_required(self):
         """
         Checks that the required options have been set in the configuration
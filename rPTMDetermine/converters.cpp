@@ -1,4 +1,5 @@
 #include <Python.h>
+#include <cstring>
 #include <map>
 #include <stdexcept>
 #include <string>
@@ -10,6 +11,14 @@
 
 /* Python to C++ */
 
+bool bufferFormatMatches(const char* format, const char* accepted) {
+	// A NULL format denotes unsigned bytes
+	if (format == NULL) return false;
+	// Native, standard and little-endian byte order prefixes are accepted
+	if (*format == '@' || *format == '=' || *format == '<') format++;
+	return strlen(format) == 1 && strchr(accepted, *format) != NULL;
+}
+
 bool checkFloat(PyObject* obj) {
 	return PyFloat_Check(obj);
 }
@@ -106,4 +115,16 @@ PyObject* annotationMapToPyDict(const std::map<std::string, Annotation>& anns) {
 	}
 	
 	return dictObj;
-}
\ No newline at end of file
+}
+
+PyObject* annotationRecordsToBytes(const std::vector<AnnotationRecord>& records) {
+	return PyBytes_FromStringAndSize(
+		reinterpret_cast<const char*>(records.data()),
+		records.size() * sizeof(AnnotationRecord));
+}
+
+PyObject* annotationRecordsToBytes(const std::vector<BatchAnnotationRecord>& records) {
+	return PyBytes_FromStringAndSize(
+		reinterpret_cast<const char*>(records.data()),
+		records.size() * sizeof(BatchAnnotationRecord));
+}
@@ -3,11 +3,95 @@
 
 #include <Python.h>
 #include <map>
+#include <stdexcept>
 #include <string>
 #include <vector>
 
 #include "annotation.h"
 
+bool bufferFormatMatches(const char* format, const char* accepted);
+
+/* A read-only view of a one-dimensional, C-contiguous buffer of T, e.g. a
+   numpy array, acquired through the buffer protocol without copying. The
+   buffer is released on destruction. */
+template<class T>
+class BufferView {
+public:
+	BufferView(PyObject* source, const char* formats) {
+		if (PyObject_GetBuffer(source, &view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) != 0) {
+			PyErr_Clear();
+			throw std::logic_error("PyObject pointer did not provide a contiguous buffer");
+		}
+		if (view.ndim > 1 || view.itemsize != sizeof(T) ||
+				!bufferFormatMatches(view.format, formats)) {
+			PyBuffer_Release(&view);
+			throw std::logic_error("Buffer was not of the expected type");
+		}
+	}
+
+	~BufferView() {
+		PyBuffer_Release(&view);
+	}
+
+	BufferView(const BufferView&) = delete;
+	BufferView& operator=(const BufferView&) = delete;
+
+	const T* data() const {
+		return static_cast<const T*>(view.buf);
+	}
+
+	size_t size() const {
+		return view.len / sizeof(T);
+	}
+
+private:
+	Py_buffer view;
+};
+
+/* A read-only view of the first column of a one- or two-dimensional,
+   C-contiguous buffer of T, e.g. the m/z column of a numpy (m/z, intensity)
+   peak array, acquired through the buffer protocol without copying. Element
+   i of the column is data()[i * stride()]. The buffer is released on
+   destruction. */
+template<class T>
+class ColumnView {
+public:
+	ColumnView(PyObject* source, const char* formats) {
+		if (PyObject_GetBuffer(source, &view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) != 0) {
+			PyErr_Clear();
+			throw std::logic_error("PyObject pointer did not provide a contiguous buffer");
+		}
+		if (view.ndim < 1 || view.ndim > 2 || view.itemsize != sizeof(T) ||
+				!bufferFormatMatches(view.format, formats) ||
+				(view.ndim == 2 && view.shape[1] < 1)) {
+			PyBuffer_Release(&view);
+			throw std::logic_error("Buffer was not of the expected type");
+		}
+	}
+
+	~ColumnView() {
+		PyBuffer_Release(&view);
+	}
+
+	ColumnView(const ColumnView&) = delete;
+	ColumnView& operator=(const ColumnView&) = delete;
+
+	const T* data() const {
+		return static_cast<const T*>(view.buf);
+	}
+
+	size_t size() const {
+		return static_cast<size_t>(view.shape[0]);
+	}
+
+	size_t stride() const {
+		return view.ndim == 2 ? static_cast<size_t>(view.shape[1]) : 1;
+	}
+
+private:
+	Py_buffer view;
+};
+
 std::vector<Ion> tupleListToIonVector(PyObject* source);
 
 std::vector<double> listToDoubleVector(PyObject* source);
@@ -20,4 +104,8 @@ PyObject* longVectorToList(const std::vector<long>& data);
 
 PyObject* annotationMapToPyDict(const std::map<std::string, Annotation>& anns);
 
+PyObject* annotationRecordsToBytes(const std::vector<AnnotationRecord>& records);
+
+PyObject* annotationRecordsToBytes(const std::vector<BatchAnnotationRecord>& records);
+
 #endif // _RPTMDETERMINE_CONVERTERS_H
\ No newline at end of file
@@ -7,6 +7,10 @@
 
 static PyMethodDef crPTMDetermine_methods[] = {
 	{"annotate", python_annotate, METH_VARARGS, "Spectrum annotation."},
+	{"annotate_arrays", python_annotate_arrays, METH_VARARGS,
+	 "Spectrum annotation using contiguous numpy arrays."},
+	{"annotate_batch", python_annotate_batch, METH_VARARGS,
+	 "Spectrum annotation for a ragged batch of ion sets."},
 	{NULL, NULL, 0, NULL} /* SENTINEL */
 };
 
@@ -0,0 +1,224 @@
+#! /usr/bin/env python3
+"""
+A module providing a persistent, memory-mapped index of the decoy peptides
+searched for decoy matches.
+
+The index is a directory of numpy arrays: the unique decoy sequences,
+concatenated as bytes, with the offset of each sequence, and, for each decoy
+peptide, i.e. a sequence with a combination of target modification sites,
+the index of its sequence, its mass and the (zero-based) target sites. The
+peptides are sorted by mass. Since the index depends only on the database
+and the modification configuration, it is built once and reused by
+subsequent runs.
+
+"""
+import hashlib
+import os
+import shutil
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from . import spectra_index
+
+
+# The version of the index layout and construction, included in the index
+# name so that stale indices are rebuilt
+DECOY_INDEX_VERSION = 1
+
+DECOY_INDEX_SUFFIX = ".decoyidx"
+
+# The maximum number of target modification sites in a decoy peptide
+MAX_TARGET_SITES = 3
+
+SEQS_FILE = "seqs.npy"
+SEQ_OFFSETS_FILE = "seq_offsets.npy"
+SEQ_IDXS_FILE = "seq_idxs.npy"
+MASSES_FILE = "masses.npy"
+TARGET_SITES_FILE = "target_sites.npy"
+
+
+def _index_key(*values) -> str:
+    """
+    Hashes the values for use in a decoy index name.
+
+    """
+    return hashlib.sha1(repr(values).encode()).hexdigest()
+
+
+def decoy_index_name(target_db_path: str, decoy_db_path: str, enzyme: str,
+                     fixed_mods: Dict[str, float], target_mod: str,
+                     mod_mass: float, target_res: Optional[str]) -> str:
+    """
+    Constructs the name of the decoy index for the given configuration,
+    keyed by the decoy peptide file path, the fingerprints of the protein
+    database and the decoy peptide file, the enzyme, the fixed modifications
+    and the target modification and residue. The name begins with the key of
+    the decoy file path, followed by the key of the file fingerprints, so
+    that the indices of a changed database can be found.
+
+    Args:
+        target_db_path (str): The path to the target protein database.
+        decoy_db_path (str): The path to the decoy peptide file.
+        enzyme (str): The enzyme used to digest the decoy proteins.
+        fixed_mods (dict): A dictionary of residue to fixed modification
+                           mass.
+        target_mod (str): The target modification.
+        mod_mass (float): The mass of the target modification.
+        target_res (str): The target residue, or None for unmodified decoys.
+
+    Returns:
+        The index name.
+
+    """
+    return "-".join([
+        _index_key(os.path.abspath(decoy_db_path)),
+        _index_key(spectra_index.file_fingerprint(target_db_path),
+                   spectra_index.file_fingerprint(decoy_db_path),
+                   DECOY_INDEX_VERSION),
+        _index_key(enzyme, sorted(fixed_mods.items()), target_mod, mod_mass,
+                   target_res)]) + DECOY_INDEX_SUFFIX
+
+
+def prune_stale_indices(index_path: str):
+    """
+    Removes the decoy indices alongside the given index which were built
+    from the same decoy peptide file before the database last changed.
+    Indices for other decoy files, or for other modification configurations
+    of the current database, are retained.
+
+    Args:
+        index_path (str): The path to the current decoy index, named by
+                          decoy_index_name.
+
+    """
+    index_dir, index_name = os.path.split(index_path)
+    path_key, db_key = index_name.split("-")[:2]
+    for entry in os.listdir(index_dir):
+        if not (entry.endswith(DECOY_INDEX_SUFFIX) or
+                entry.endswith(f"{DECOY_INDEX_SUFFIX}.tmp")):
+            continue
+        entry_keys = entry.split("-")
+        if (len(entry_keys) == 3 and entry_keys[0] == path_key and
+                entry_keys[1] != db_key):
+            shutil.rmtree(os.path.join(index_dir, entry), ignore_errors=True)
+
+
+class DecoyIndex:
+    """
+    A class to provide access to a decoy peptide index on disk.
+
+    """
+    def __init__(self, path: str):
+        """
+        Opens the decoy index, memory-mapping its arrays.
+
+        Args:
+            path (str): The path to the index directory.
+
+        """
+        self.path = path
+
+        def _load(name: str) -> np.ndarray:
+            return np.load(os.path.join(path, name),
+                           mmap_mode="r").view(np.ndarray)
+
+        self.seq_bytes = _load(SEQS_FILE)
+        self.seq_offsets = _load(SEQ_OFFSETS_FILE)
+        self.seq_idxs = _load(SEQ_IDXS_FILE)
+        self.masses = _load(MASSES_FILE)
+        self.target_sites = _load(TARGET_SITES_FILE)
+
+    def __len__(self) -> int:
+        """
+        Returns the number of decoy peptides in the index.
+
+        """
+        return len(self.masses)
+
+    @property
+    def num_sequences(self) -> int:
+        """
+        Returns the number of unique decoy sequences in the index.
+
+        """
+        return len(self.seq_offsets) - 1
+
+    def sequence(self, seq_idx: int) -> str:
+        """
+        Retrieves the decoy sequence with the given index.
+
+        Args:
+            seq_idx (int): The sequence index.
+
+        Returns:
+            The sequence string.
+
+        """
+        return self.seq_bytes[self.seq_offsets[seq_idx]:
+                              self.seq_offsets[seq_idx + 1]].tobytes()\
+            .decode()
+
+    def peptide_sites(self, idx: int) -> List[int]:
+        """
+        Retrieves the (zero-based) target modification sites of the decoy
+        peptide at the given position in the index.
+
+        Args:
+            idx (int): The position of the decoy peptide.
+
+        Returns:
+            List of target sites.
+
+        """
+        return [site for site in self.target_sites[idx].tolist()
+                if site >= 0]
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        """
+        Tests whether a complete decoy index exists at the path.
+
+        """
+        return os.path.isfile(os.path.join(path, MASSES_FILE))
+
+    @staticmethod
+    def write(path: str, seqs: Sequence[str], seq_idxs: np.ndarray,
+              masses: np.ndarray, target_sites: np.ndarray):
+        """
+        Writes the decoy peptides to a new index at the given path, replacing
+        any existing index. The index is written to a temporary directory and
+        moved into place once complete.
+
+        Args:
+            path (str): The path to the index directory.
+            seqs (list): The unique decoy sequences.
+            seq_idxs (numpy.ndarray): The sequence index of each peptide.
+            masses (numpy.ndarray): The mass of each peptide, sorted.
+            target_sites (numpy.ndarray): The target sites of each peptide,
+                                          padded with -1 to
+                                          MAX_TARGET_SITES columns.
+
+        """
+        tmp_path = f"{path}.tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        def _save(name: str, values: np.ndarray):
+            np.save(os.path.join(tmp_path, name), values)
+
+        seq_offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        np.cumsum([len(seq) for seq in seqs], out=seq_offsets[1:])
+
+        _save(SEQS_FILE, np.frombuffer("".join(seqs).encode(),
+                                       dtype=np.uint8))
+        _save(SEQ_OFFSETS_FILE, seq_offsets)
+        _save(SEQ_IDXS_FILE, np.asarray(seq_idxs, dtype=np.int64))
+        _save(TARGET_SITES_FILE, np.asarray(target_sites, dtype=np.int16))
+        # The masses are written last, marking the index as complete
+        _save(MASSES_FILE, np.asarray(masses, dtype=np.float64))
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
@@ -0,0 +1,6 @@
+import numpy as np
+from typing import Tuple
+
+def denoise(peaks: np.ndarray, assigned_peaks: np.ndarray, max_peaks_per_window: int) -> np.ndarray: ...
+
+def denoise_many(peaks: np.ndarray, assigned_peaks: np.ndarray, max_peaks_per_window: int) -> Tuple[np.ndarray, np.ndarray]: ...
@@ -1,66 +1,187 @@
 import cython
 import numpy as np
-cimport numpy as np
 
-from libc.stdlib cimport qsort
+from libc.stdlib cimport free, malloc, qsort
 
-@cython.boundscheck(False)
-def denoise(double[:, :] peaks, assigned_peaks, int max_peaks_per_window):
+
+cdef struct WindowPeak:
+    double intensity
+    Py_ssize_t index
+
+
+cdef int _compare_window_peaks(const void* a, const void* b) noexcept nogil:
+    """
+    Orders peaks by descending intensity, then by ascending index, so that
+    the sort is equivalent to a stable sort in descending intensity.
+
+    """
+    cdef const WindowPeak* peak_a = <const WindowPeak*>a
+    cdef const WindowPeak* peak_b = <const WindowPeak*>b
+    if peak_a.intensity > peak_b.intensity:
+        return -1
+    if peak_a.intensity < peak_b.intensity:
+        return 1
+    return (peak_a.index > peak_b.index) - (peak_a.index < peak_b.index)
+
+
+def denoise(const double[:, :] peaks, const unsigned char[:] assigned_peaks,
+            int max_peaks_per_window):
     """
     Denoises the mass spectrum using the annotated ions.
 
     Args:
-        assigned_peaks (list): A list of booleans indicating whether the
-                               corresponding index peak is annotated.
-        max_peaks_per_window (int, optional): The maximum number of peaks
-                                              to include per 100 Da window.
+        peaks (numpy.ndarray): The spectrum peaks, sorted by m/z.
+        assigned_peaks (numpy.ndarray): A boolean array indicating whether
+                                        the corresponding index peak is
+                                        annotated.
+        max_peaks_per_window (int): The maximum number of peaks to include
+                                    per 100 Da window.
 
     Returns:
-        Tuple: The denoised peak indexes as a list, The denoised spectrum
+        The denoised peak indexes as a numpy array.
 
     """
-    cdef ssize_t npeaks
-    cdef int n_windows, start_idx, window, end_idx, idx, ii
+    new_peaks, _ = denoise_many(
+        peaks, np.asarray(assigned_peaks)[np.newaxis, :],
+        max_peaks_per_window)
+    return new_peaks
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def denoise_many(const double[:, :] peaks,
+                 const unsigned char[:, :] assigned_peaks,
+                 int max_peaks_per_window):
+    """
+    Denoises the mass spectrum using each of a number of sets of annotated
+    ions, as denoise. The windows of the spectrum, and the order of the
+    peaks by intensity within each window, are independent of the
+    annotations, so these are calculated once for all of the sets.
+
+    Args:
+        peaks (numpy.ndarray): The spectrum peaks, sorted by m/z.
+        assigned_peaks (numpy.ndarray): A two-dimensional boolean array, with
+                                        one row per set of annotations,
+                                        indicating whether the corresponding
+                                        index peak is annotated.
+        max_peaks_per_window (int): The maximum number of peaks to include
+                                    per 100 Da window.
+
+    Returns:
+        Tuple of (the denoised peak indexes of all of the sets, concatenated
+        as a numpy array, the offsets of each set's indexes in that array).
+
+    """
+    cdef Py_ssize_t npeaks = peaks.shape[0]
+    cdef Py_ssize_t nsets = assigned_peaks.shape[0]
+    cdef Py_ssize_t n_windows, window, start_idx, end_idx, ii, jj, n_new_peaks
+    cdef Py_ssize_t n_window_peaks, n_scores, best_num, score, best_score
     cdef double max_mass
-    cdef int[:] window_peaks, ion_scores, sum_scores
-    
-    npeaks = peaks.shape[0]
+    cdef WindowPeak* window_peaks
+    cdef long long[:] window_starts_view, window_sizes_view, order_view
+    cdef long long[:] single_peaks_view, offsets_view, new_peaks_view
+
+    if assigned_peaks.shape[1] != npeaks:
+        raise ValueError("assigned_peaks must have one entry per peak")
+    if max_peaks_per_window < 1:
+        raise ValueError("max_peaks_per_window must be positive")
+
+    offsets = np.zeros(nsets + 1, dtype=np.int64)
+    if npeaks == 0:
+        return np.empty(0, dtype=np.int64), offsets
+    offsets_view = offsets
+
     # Divide the mass spectrum into windows of 100 Da
-    n_windows = int((peaks[-1][0] - peaks[0][0]) / 100.) + 1
-    start_idx, new_peaks = 0, []
+    n_windows = \
+        <Py_ssize_t>((peaks[npeaks - 1, 0] - peaks[0, 0]) / 100.) + 1
+
+    # For each window, the start and size of its peaks in order, which are
+    # sorted in descending order of intensity. A window without peaks of its
+    # own instead records the peak which is retained if annotated, or -1
+    window_starts = np.zeros(n_windows, dtype=np.int64)
+    window_sizes = np.zeros(n_windows, dtype=np.int64)
+    single_peaks = np.full(n_windows, -1, dtype=np.int64)
+    order = np.empty(npeaks, dtype=np.int64)
+    window_starts_view = window_starts
+    window_sizes_view = window_sizes
+    single_peaks_view = single_peaks
+    order_view = order
+
+    window_peaks = <WindowPeak*>malloc(npeaks * sizeof(WindowPeak))
+    if window_peaks == NULL:
+        raise MemoryError()
+
+    try:
+        start_idx = 0
+        for window in range(n_windows):
+            # Set up the mass limit for the current window
+            max_mass = peaks[0, 0] + (window + 1) * 100.
+
+            # Find the first index beyond the current window, or the last
+            # index of the spectrum
+            end_idx = start_idx
+            while end_idx < npeaks - 1 and peaks[end_idx, 0] <= max_mass:
+                end_idx += 1
+
+            window_starts_view[window] = start_idx
 
-    for window in range(n_windows):
-        # Set up the mass limit for the current window
-        max_mass = peaks[0][0] + (window + 1) * 100.
+            if end_idx == start_idx:
+                if peaks[end_idx, 0] <= max_mass:
+                    single_peaks_view[window] = end_idx
+                continue
 
-        # Find the last index with a peak mass within the current window
-        for end_idx in range(start_idx, npeaks):
-            if peaks[end_idx][0] > max_mass:
-                break
+            n_window_peaks = end_idx - start_idx
+            for ii in range(n_window_peaks):
+                window_peaks[ii].intensity = peaks[start_idx + ii, 1]
+                window_peaks[ii].index = start_idx + ii
+            qsort(window_peaks, n_window_peaks, sizeof(WindowPeak),
+                  _compare_window_peaks)
+            for ii in range(n_window_peaks):
+                order_view[start_idx + ii] = window_peaks[ii].index
+            window_sizes_view[window] = n_window_peaks
 
-        if end_idx == start_idx:
-            if (peaks[end_idx][0] <= max_mass and
-                    assigned_peaks[end_idx]):
-                new_peaks.append(end_idx)
-            continue
+            start_idx = end_idx
+    finally:
+        free(window_peaks)
 
-        # Sort the peaks within the window in descending order of
-        # intensity
-        window_peaks = sorted(list(range(start_idx, end_idx)),
-                              key=lambda ii: peaks[ii][1],
-                              reverse=True)
+    # Each set retains at most max_peaks_per_window peaks from each window,
+    # or the single peak of a window without peaks of its own. Once the
+    # final peak is reached, it is retained for each subsequent window in
+    # which it is annotated, so the same peak may be retained more than once
+    max_set_peaks = int(np.minimum(window_sizes, max_peaks_per_window).sum() +
+                        np.count_nonzero(single_peaks >= 0))
+    new_peaks = np.empty(nsets * max_set_peaks, dtype=np.int64)
+    new_peaks_view = new_peaks
 
-        ion_scores = [assigned_peaks[idx] for idx in window_peaks]
+    n_new_peaks = 0
+    for jj in range(nsets):
+        for window in range(n_windows):
+            n_window_peaks = window_sizes_view[window]
+            if n_window_peaks == 0:
+                ii = single_peaks_view[window]
+                if ii >= 0 and assigned_peaks[jj, ii]:
+                    new_peaks_view[n_new_peaks] = ii
+                    n_new_peaks += 1
+                continue
 
-        # Sum the scores for the top intensity peaks in the window
-        sum_scores = [sum(ion_scores[:idx])
-                      for idx in range(1, min(len(ion_scores) + 1,
-                                              max_peaks_per_window + 1))]
+            # Find the number of top intensity peaks in the window with the
+            # highest number of annotations, preferring fewer peaks
+            start_idx = window_starts_view[window]
+            n_scores = min(n_window_peaks, max_peaks_per_window)
+            score = 0
+            best_score = -1
+            best_num = 0
+            for ii in range(n_scores):
+                score += assigned_peaks[jj, order_view[start_idx + ii]] != 0
+                if score > best_score:
+                    best_score = score
+                    best_num = ii + 1
 
-        # Take the top number of peaks with the highest number of
-        # annotations
-        new_peaks += window_peaks[:sum_scores.index(max(sum_scores)) + 1]
+            for ii in range(best_num):
+                new_peaks_view[n_new_peaks] = order_view[start_idx + ii]
+                n_new_peaks += 1
 
-        start_idx = end_idx
+        offsets_view[jj + 1] = n_new_peaks
 
-    return new_peaks
\ No newline at end of file
+    return new_peaks[:n_new_peaks].copy(), offsets
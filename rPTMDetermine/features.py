@@ -1,9 +1,12 @@
 #! /usr/bin/env python3
 """
 """
+from __future__ import annotations  # Imported for lazy evaluation of types
 
 import dataclasses
-from typing import Iterator, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
 
 
 @dataclasses.dataclass(init=False)
@@ -100,6 +103,47 @@ class Features:
         """
         setattr(self, feature, value)
 
+    def to_array(self, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Writes the feature values into a row of a feature matrix, using NaN
+        for features which have not been initialized.
+
+        Args:
+            out (numpy.ndarray, optional): The row into which to write the
+                                           values. If None, a new array is
+                                           allocated.
+
+        Returns:
+            numpy.ndarray of the values of all_feature_names().
+
+        """
+        if out is None:
+            out = np.empty(len(Features.__slots__), dtype=np.float64)
+        for idx, feature in enumerate(Features.__slots__):
+            val = getattr(self, feature)
+            out[idx] = np.nan if val is None else val
+        return out
+
+    @classmethod
+    def from_array(cls, row: np.ndarray) -> Features:
+        """
+        Constructs the Features from a row of a feature matrix, leaving NaN
+        features uninitialized and restoring INTEGER_FEATURES to int.
+
+        Args:
+            row (numpy.ndarray): The values of all_feature_names().
+
+        Returns:
+            Features.
+
+        """
+        features = cls()
+        for feature, val in zip(Features.__slots__, row.tolist()):
+            if val == val:
+                setattr(features, feature,
+                        int(val) if feature in INTEGER_FEATURES else val)
+        return features
+
     def isvalid(self):
         """
         Check whether the feature is a valid feature
@@ -109,3 +153,28 @@ class Features:
         return not any(getattr(self, feature) is None
                        for feature in Features.__slots__)
 
+
+# The column index of each feature in feature matrices
+FEATURE_COLUMNS: Dict[str, int] = {
+    feature: idx for idx, feature in enumerate(Features.all_feature_names())}
+
+# The features which take integer values, stored as floats in feature
+# matrices
+INTEGER_FEATURES = frozenset(
+    ["PepLen", "Charge", "NumIonb", "NumIony", "MissedCleavages"])
+
+
+def feature_matrix(num_rows: int) -> np.ndarray:
+    """
+    Allocates a feature matrix, with one column per feature in
+    Features.all_feature_names(), initialized to NaN.
+
+    Args:
+        num_rows (int): The number of rows of the matrix.
+
+    Returns:
+        numpy.ndarray of shape (num_rows, number of features).
+
+    """
+    return np.full((num_rows, len(FEATURE_COLUMNS)), np.nan,
+                   dtype=np.float64)
@@ -0,0 +1,222 @@
+#! /usr/bin/env python3
+"""
+A module providing a process-wide, size-bounded cache of peptide fragment
+ions.
+
+Fragment ions are generated for the same peptide many times over the course
+of a run, e.g. for candidate prefiltering, annotation, feature extraction and
+similarity scoring. Rather than caching the ions on each pepfrag.Peptide,
+which pins them in memory for the lifetime of the Peptide, the ions are
+cached here as compact arrays, keyed by the peptide and the fragmentation
+configuration, and the least recently used entries are evicted once the
+cache exceeds its size limit.
+
+"""
+import collections
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from pepfrag import Ion, Peptide
+
+from .constants import DEFAULT_FRAGMENT_IONS
+
+
+# The theoretical fragment ions of a peptide, as parallel arrays of the ion
+# mass/charge ratios (float64), encoded labels (bytes) and positions (int32)
+FragmentIons = collections.namedtuple(
+    "FragmentIons", ["mzs", "labels", "positions"])
+
+
+def to_fragment_ions(ions: Sequence[Ion]) -> FragmentIons:
+    """
+    Converts a list of pepfrag Ions to FragmentIons.
+
+    Args:
+        ions (list): The pepfrag Ions, as (mass, label, position) tuples.
+
+    Returns:
+        FragmentIons.
+
+    """
+    if not ions:
+        return FragmentIons(np.empty(0, dtype=np.float64),
+                            np.empty(0, dtype="S1"),
+                            np.empty(0, dtype=np.int32))
+    mzs, labels, positions = zip(*ions)
+    return FragmentIons(np.array(mzs, dtype=np.float64),
+                        np.array([l.encode() for l in labels]),
+                        np.array(positions, dtype=np.int32))
+
+
+# The FragmentIons of a batch of peptides, concatenated such that the ions of
+# the ith peptide are at offsets[i]:offsets[i + 1], with the ion labels given
+# as indexes into the sorted list of unique labels
+FragmentIonBatch = collections.namedtuple(
+    "FragmentIonBatch", ["mzs", "positions", "label_idxs", "offsets",
+                         "labels"])
+
+
+def batch_fragment_ions(
+        fragment_ion_sets: Sequence[FragmentIons]) -> FragmentIonBatch:
+    """
+    Concatenates the FragmentIons of a batch of peptides. Since the labels
+    are indexed in sorted order, the annotation records for each peptide are
+    ordered by label.
+
+    Args:
+        fragment_ion_sets (list): The FragmentIons of each peptide.
+
+    Returns:
+        FragmentIonBatch.
+
+    """
+    offsets = np.zeros(len(fragment_ion_sets) + 1, dtype=np.int64)
+    np.cumsum([len(ions.mzs) for ions in fragment_ion_sets], out=offsets[1:])
+
+    if offsets[-1] == 0:
+        return FragmentIonBatch(np.empty(0, dtype=np.float64),
+                                np.empty(0, dtype=np.int64),
+                                np.empty(0, dtype=np.int64), offsets, [])
+
+    labels, label_idxs = np.unique(
+        np.concatenate([ions.labels for ions in fragment_ion_sets]),
+        return_inverse=True)
+    return FragmentIonBatch(
+        np.concatenate([ions.mzs for ions in fragment_ion_sets]),
+        np.concatenate([ions.positions for ions in fragment_ion_sets])
+        .astype(np.int64),
+        label_idxs.astype(np.int64), offsets,
+        [label.decode() for label in labels.tolist()])
+
+
+def _ion_types_key(ion_types: Dict[int, List[str]]) -> Tuple[Hashable, ...]:
+    """
+    Converts a fragmentation configuration dictionary to a hashable key.
+
+    """
+    return tuple(sorted((ion_type, tuple(neutral_losses))
+                        for ion_type, neutral_losses in ion_types.items()))
+
+
+class FragmentCache:
+    """
+    A least recently used cache of peptide fragment ions, bounded by the
+    total size of the cached arrays.
+
+    """
+    def __init__(self, max_bytes: int = 256 * 1024 ** 2):
+        """
+        Initializes the cache.
+
+        Args:
+            max_bytes (int, optional): The maximum total size of the cached
+                                       arrays, in bytes.
+
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        """
+        Returns the number of cached peptide fragmentations.
+
+        """
+        return len(self._entries)
+
+    def __str__(self) -> str:
+        """
+        Summarizes the cache usage.
+
+        """
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.
+        return (f"{len(self)} entries, {self.nbytes / 1024 ** 2:.1f} MB, "
+                f"{self.hits} hits, {self.misses} misses "
+                f"({hit_rate:.1%} hit rate)")
+
+    def get(self, peptide: Peptide,
+            ion_types: Optional[Dict[int, List[str]]] = None) \
+            -> FragmentIons:
+        """
+        Retrieves the fragment ions of the peptide, generating and caching
+        them if they are not already cached.
+
+        Args:
+            peptide (pepfrag.Peptide): The peptide to fragment.
+            ion_types (dict, optional): The fragmentation configuration dict.
+                                        Defaults to DEFAULT_FRAGMENT_IONS.
+
+        Returns:
+            FragmentIons.
+
+        """
+        if ion_types is None:
+            ion_types = DEFAULT_FRAGMENT_IONS
+
+        key = (peptide.seq, tuple(peptide.mods), peptide.charge,
+               _ion_types_key(ion_types))
+        fragments = self._entries.get(key)
+        if fragments is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return fragments
+
+        self.misses += 1
+        # The ions are regenerated for the requested configuration, since
+        # pepfrag otherwise returns those cached for any configuration, and
+        # are then cleared from the Peptide in favour of this cache
+        fragments = to_fragment_ions(
+            peptide.fragment(ion_types=ion_types, force=True))
+        peptide.clean_fragment_ions()
+
+        self._entries[key] = fragments
+        self.nbytes += _nbytes(fragments)
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _nbytes(evicted)
+
+        return fragments
+
+    def clear(self):
+        """
+        Removes all entries from the cache and resets the counters.
+
+        """
+        self._entries.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+def _nbytes(fragments: FragmentIons) -> int:
+    """
+    Calculates the size of the arrays of the FragmentIons.
+
+    """
+    return sum(arr.nbytes for arr in fragments)
+
+
+# The process-wide cache. Worker processes each maintain their own copy
+FRAGMENT_CACHE = FragmentCache()
+
+
+def get_fragment_ions(
+        peptide: Peptide,
+        ion_types: Optional[Dict[int, List[str]]] = None) -> FragmentIons:
+    """
+    Retrieves the fragment ions of the peptide from the process-wide cache.
+    This function is defined at module level in order to be picklable for
+    multiprocessing.
+
+    Args:
+        peptide (pepfrag.Peptide): The peptide to fragment.
+        ion_types (dict, optional): The fragmentation configuration dict.
+
+    Returns:
+        FragmentIons.
+
+    """
+    return FRAGMENT_CACHE.get(peptide, ion_types)
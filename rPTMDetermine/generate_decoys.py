@@ -5,16 +5,25 @@ Generate decoy peptides from the target protein sequence database.
 """
 import argparse
 import csv
+import itertools
 import logging
+import multiprocessing as mp
+from multiprocessing.pool import Pool
 import os
-from typing import List, Tuple
+from typing import Iterable, List, Optional, Set, Tuple
 
+import numpy as np
 from pepfrag import AA_MASSES, FIXED_MASSES
 
 from . import proteolysis
 from . import readers
 
 
+# The suffix of the binary decoy peptide table written by
+# generate_decoy_table
+DECOY_TABLE_SUFFIX = "_digested.npz"
+
+
 def generate_decoy_fasta(target_db_path: str,
                          decoy_prefix: str = "_DECOY") -> str:
     """
@@ -79,14 +88,14 @@ def generate_decoy_file(target_db_path: str,
             rows: List[Tuple[str, str, str]] = []
             count = 0
             for title, protein in readers.read_fasta_sequences(tfh):
-                peptides = proteolyzer.cleave(protein[::-1], numbermissed=2)
-                if not peptides:
+                peps = proteolyzer.cleave(protein[::-1], num_missed=2)
+                if not peps:
                     continue
                 prot_id = title.split()[0][1:]
                 rows += [(f">{decoy_prefix}_{prot_id}", pep,
                           "{:.6f}".format(sum(AA_MASSES[aa].mono for aa in pep)
                                           + FIXED_MASSES["H2O"]))
-                         for pep in peptides]
+                         for pep in peps]
                 count += 1
                 if count == 1000:
                     writer.writerows(rows)
@@ -96,6 +105,117 @@ def generate_decoy_file(target_db_path: str,
     return decoy_path
 
 
+def _digest_proteins(args: Tuple[proteolysis.Proteolyzer, List[str]]) \
+        -> Set[str]:
+    """
+    Digests the reversed protein sequences. This function is defined at
+    module level in order to be picklable for multiprocessing.
+
+    Args:
+        args (tuple): The protein digester and the protein sequences.
+
+    Returns:
+        The set of unique decoy peptides.
+
+    """
+    proteolyzer, proteins = args
+    return {pep for protein in proteins
+            for pep in proteolyzer.cleave(protein[::-1], num_missed=2)}
+
+
+def _protein_chunks(target_db_path: str, proteolyzer: proteolysis.Proteolyzer,
+                    chunk_size: int) \
+        -> Iterable[Tuple[proteolysis.Proteolyzer, List[str]]]:
+    """
+    Streams the protein sequences of the database in chunks of chunk_size
+    proteins.
+
+    """
+    with open(target_db_path) as tfh:
+        proteins = (protein
+                    for _, protein in readers.read_fasta_sequences(tfh))
+        while True:
+            chunk = list(itertools.islice(proteins, chunk_size))
+            if not chunk:
+                return
+            yield proteolyzer, chunk
+
+
+def generate_decoy_table(target_db_path: str,
+                         proteolyzer: proteolysis.Proteolyzer,
+                         pool: Optional[Pool] = None,
+                         chunk_size: int = 1000) -> str:
+    """
+    Generates the decoy peptide table, a binary alternative to the decoy
+    peptide file containing the unique decoy peptide sequences, sorted. The
+    masses are not stored, since those of the decoy peptides depend on the
+    configured modifications and are calculated when the decoy index is
+    built. The protein sequences are streamed from the
+    database and digested in chunks, in parallel if a pool is provided.
+
+    Args:
+        target_db_path (str): The path to the target protein sequence
+                              database.
+        proteolyzer (proteolysis.Proteolyzer): The protein digester object.
+        pool (multiprocessing.Pool, optional): The pool with which to digest
+                                               the proteins. If None, the
+                                               proteins are digested in this
+                                               process.
+        chunk_size (int, optional): The number of proteins per digestion job.
+
+    Returns:
+        The path to the newly-generated decoy table.
+
+    """
+    split_path = target_db_path.rsplit('.', maxsplit=1)
+    decoy_path = \
+        f"{split_path[0]}_reversed_{proteolyzer.enzyme}{DECOY_TABLE_SUFFIX}"
+
+    if os.path.exists(decoy_path):
+        logging.info(f"Using existing decoy peptides at {decoy_path}.")
+        return decoy_path
+
+    logging.info("Generating decoy peptides.")
+    unique_seqs: Set[str] = set()
+    for chunk_peps in (map if pool is None else pool.imap)(
+            _digest_proteins,
+            _protein_chunks(target_db_path, proteolyzer, chunk_size)):
+        unique_seqs.update(chunk_peps)
+    seqs = sorted(unique_seqs)
+
+    seq_offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum([len(seq) for seq in seqs], out=seq_offsets[1:])
+
+    # The table is written to a temporary file and moved into place once
+    # complete
+    tmp_path = f"{decoy_path}.tmp"
+    with open(tmp_path, "wb") as fh:
+        np.savez(fh,
+                 seqs=np.frombuffer("".join(seqs).encode(), dtype=np.uint8),
+                 seq_offsets=seq_offsets)
+    os.replace(tmp_path, decoy_path)
+
+    return decoy_path
+
+
+def read_decoy_table(decoy_path: str) -> List[str]:
+    """
+    Reads the decoy peptide table written by generate_decoy_table.
+
+    Args:
+        decoy_path (str): The path to the decoy peptide table.
+
+    Returns:
+        The decoy peptide sequences.
+
+    """
+    with np.load(decoy_path) as table:
+        seq_str = table["seqs"].tobytes().decode()
+        seq_offsets = table["seq_offsets"].tolist()
+    return [seq_str[start:end]
+            for start, end in zip(seq_offsets[:-1], seq_offsets[1:])]
+
+
 def parse_args():
     """
     Parses the command line arguments to the script.
@@ -125,6 +245,19 @@ def parse_args():
         default='DECOY_',
         help='Set accesion prefix for decoy proteins in output. '
              'Default=DECOY_')
+    parser.add_argument(
+        '--table',
+        action='store_true',
+        help='Write the unique decoy peptides to a binary peptide table, '
+             'digesting the proteins in parallel')
+    parser.add_argument(
+        '--processes',
+        '-p',
+        dest='processes',
+        type=int,
+        default=None,
+        help='The number of processes with which to digest the proteins '
+             'when writing a peptide table. Default = number of CPUs')
     return parser.parse_args()
 
 
@@ -134,8 +267,14 @@ def main():
 
     """
     args = parse_args()
-    generate_decoy_file(args.fasta, proteolysis.Proteolyzer(args.enzyme),
-                        decoy_prefix=args.dprefix)
+    proteolyzer = proteolysis.Proteolyzer(args.enzyme)
+    if not args.table:
+        generate_decoy_file(args.fasta, proteolyzer,
+                            decoy_prefix=args.dprefix)
+        return
+
+    with mp.Pool(processes=args.processes) as pool:
+        generate_decoy_table(args.fasta, proteolyzer, pool=pool)
 
 
 if __name__ == "__main__":
@@ -6,7 +6,7 @@ of PSMS.
 """
 import copy
 import itertools
-from typing import Callable, Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 import warnings
 
 import numpy as np
@@ -18,7 +18,9 @@ from sklearn.model_selection import StratifiedKFold
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 
-from .peptide_spectrum_match import PSM
+from .features import Features
+from .fragment_cache import get_fragment_ions
+from .peptide_spectrum_match import PSM, extract_feature_matrix
 from . import proteolysis
 from .psm_container import PSMContainer, PSMType
 
@@ -371,8 +373,8 @@ def merge_lda_results(psms: List[PSM], lda_results) -> List[PSM]:
     return psms
 
 
-def calculate_scores(model: CustomPipeline, psms: List[PSM],
-                     features: List[str], target_only: bool = True):
+def calculate_scores(model: CustomPipeline, psms: Sequence[PSM],
+                     features: Sequence[str], target_only: bool = True):
     """
     Calculates the LDA scores for the given psms using the trained model.
 
@@ -385,8 +387,9 @@ def calculate_scores(model: CustomPipeline, psms: List[PSM],
         The LDA scores for the PSMs as a numpy array.
 
     """
-    return model.decide_predict(
-        PSMContainer(psms).to_df(target_only)[features])[:, 0]
+    return model.decide_predict(pd.DataFrame(
+        PSMContainer(psms).feature_matrix(features, target_only),
+        columns=features))[:, 0]
 
 
 def _apply_deamidation_correction(
@@ -433,18 +436,30 @@ def _apply_deamidation_correction(
              for ii in range(len(deam_mods))))
              
         model, correction, dist_stats = get_model_func(psm)
-                         
+
+        cand_psms = []
         for deams in deam_combs:
             cand_psm = copy.deepcopy(base_psm)
             cand_psm.mods.extend(deams)
+            cand_psms.append(cand_psm)
+
+        # Annotate the spectrum with all of the candidates at once
+        cand_anns = psm.spectrum.annotate_many(
+            [get_fragment_ions(cand_psm.peptide) for cand_psm in cand_psms])
+
+        # Calculate new features
+        cand_features = extract_feature_matrix(
+            [(cand_psm.peptide, cand_psm.spectrum) for cand_psm in cand_psms],
+            target_mod, proteolyzer, anns=cand_anns)
+        for cand_psm, row in zip(cand_psms, cand_features):
+            cand_psm.features = Features.from_array(row)
 
-            # Calculate new features
-            cand_psm.extract_features(target_mod, proteolyzer)
+        # Compare probabilities using the same model used for the deamidated
+        # PSM
+        cor_scores = calculate_scores(model, cand_psms, features,
+                                      target_only=True) + correction
 
-            # Compare probabilities using the same model used for the deamidated
-            # PSM
-            cor_score = calculate_scores(model, [cand_psm], features,
-                                         target_only=True)[0] + correction
+        for cand_psm, cor_score in zip(cand_psms, cor_scores):
             cor_prob = calculate_prob(1, cor_score, dist_stats)
 
             if cor_score >= psm.lda_score:
@@ -6,21 +6,45 @@ This module provides functions for processing mass spectra.
 from __future__ import annotations
 
 import collections
-import operator
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 from pepfrag import Ion
 
-from crPTMDetermine import annotate
+from crPTMDetermine import annotate_arrays, annotate_batch
 
 from .constants import ITRAQ_MASSES
+from .denoise import denoise, denoise_many
+from .fragment_cache import (FragmentIonBatch, FragmentIons,
+                             batch_fragment_ions, to_fragment_ions)
 
 
 Annotation = collections.namedtuple("Annotation",
                                     ["peak_num", "mass_diff", "ion_pos"])
+
+# The layout of the annotation records returned by the native annotate_arrays
+ANNOTATION_DTYPE = np.dtype([
+    ("label_idx", np.int64),
+    ("peak_num", np.int64),
+    ("mass_diff", np.float64),
+    ("ion_pos", np.int64),
+])
+
+# The layout of the annotation records returned by the native annotate_batch
+BATCH_ANNOTATION_DTYPE = np.dtype([
+    ("pep_idx", np.int64),
+    ("label_idx", np.int64),
+    ("peak_num", np.int64),
+    ("mass_diff", np.float64),
+    ("ion_pos", np.int64),
+])
                                     
                                     
+# Sorted, such that the nearest reporter ions to a peak can be located by
+# binary search
+_SORTED_ITRAQ_MASSES = np.sort(ITRAQ_MASSES)
+
+
 MGF_BLOCK = '''BEGIN IONS
 TITLE=Locus:{spec_id}
 {charge}PEPMASS={pepmass:.5f}
@@ -29,6 +53,114 @@ END IONS
 '''
 
 
+def centroid_peaks(peaks: np.ndarray, offsets: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Centroids a block of m/z-sorted spectra, concatenated into a single peak
+    array, according to the m/z differences. Adjacent peaks with m/z
+    differences of no more than 0.1 Da are clustered. Clusters whose peaks
+    share the same intensity are centroided to the mean m/z, otherwise to
+    the (first) peak with the highest intensity.
+
+    Args:
+        peaks (numpy.ndarray): The (N, 2) array of concatenated peaks.
+        offsets (numpy.ndarray): The start offset of each spectrum within
+                                 peaks, followed by the total number of peaks.
+
+    Returns:
+        Tuple of (centroided peaks, offsets of the centroided spectra).
+
+    """
+    offsets = np.asarray(offsets)
+    if len(peaks) == 0:
+        return peaks, offsets
+    mz, intensity = peaks[:, 0], peaks[:, 1]
+
+    # Clusters start where the m/z difference exceeds the threshold, and at
+    # the start of each spectrum
+    is_start = np.empty(len(peaks), dtype=bool)
+    is_start[1:] = np.diff(mz) > 0.1
+    is_start[offsets[:-1][offsets[:-1] < offsets[1:]]] = True
+    starts = np.flatnonzero(is_start)
+    lengths = np.diff(np.append(starts, len(peaks)))
+
+    max_int = np.maximum.reduceat(intensity, starts)
+    min_int = np.minimum.reduceat(intensity, starts)
+
+    # Sum the m/z values of each cluster sequentially, in the order of the
+    # peaks, iterating over the positions within the multi-peak clusters
+    mz_sums = mz[starts].copy()
+    active = np.flatnonzero(lengths > 1)
+    pos = 1
+    while active.size:
+        mz_sums[active] += mz[starts[active] + pos]
+        pos += 1
+        active = active[lengths[active] > pos]
+
+    # The first peak with the highest intensity in each cluster
+    peak_idxs = np.arange(len(peaks))
+    max_idxs = np.minimum.reduceat(
+        np.where(intensity == np.repeat(max_int, lengths), peak_idxs,
+                 len(peaks)),
+        starts)
+
+    same_int = max_int == min_int
+    centroided = np.empty((len(starts), 2))
+    centroided[:, 0] = np.where(same_int, mz_sums / lengths, mz[max_idxs])
+    centroided[:, 1] = np.where(same_int, intensity[starts],
+                                intensity[max_idxs])
+
+    cluster_counts = np.zeros(len(peaks) + 1, dtype=np.int64)
+    np.cumsum(is_start, out=cluster_counts[1:])
+
+    return centroided, cluster_counts[offsets]
+
+
+def itraq_mask(mz: np.ndarray, tol: float = 0.1) -> np.ndarray:
+    """
+    Determines which m/z ratios are further than the tolerance from all of
+    the iTRAQ reporter ion masses.
+
+    Args:
+        mz (numpy.ndarray): The m/z ratios.
+        tol (float, optional): The mass tolerance.
+
+    Returns:
+        Boolean numpy array, True where the m/z is not an iTRAQ reporter ion.
+
+    """
+    # Only the reporter ions either side of each m/z need to be compared
+    idxs = np.searchsorted(_SORTED_ITRAQ_MASSES, mz)
+    lower = _SORTED_ITRAQ_MASSES[np.maximum(idxs - 1, 0)]
+    upper = _SORTED_ITRAQ_MASSES[
+        np.minimum(idxs, len(_SORTED_ITRAQ_MASSES) - 1)]
+    return (np.abs(mz - lower) > tol) & (np.abs(mz - upper) > tol)
+
+
+def preprocess_peaks(peaks: np.ndarray, offsets: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Preprocesses a block of m/z-sorted spectra, concatenated into a single
+    peak array, by centroiding and removing iTRAQ reporter ion peaks. This
+    is equivalent to calling Spectrum.centroid().remove_itraq() on each
+    spectrum.
+
+    Args:
+        peaks (numpy.ndarray): The (N, 2) array of concatenated peaks.
+        offsets (numpy.ndarray): The start offset of each spectrum within
+                                 peaks, followed by the total number of peaks.
+
+    Returns:
+        Tuple of (preprocessed peaks, offsets of the preprocessed spectra).
+
+    """
+    peaks, offsets = centroid_peaks(peaks, offsets)
+    mask = itraq_mask(peaks[:, 0])
+    kept_counts = np.zeros(len(peaks) + 1, dtype=np.int64)
+    np.cumsum(mask, out=kept_counts[1:])
+    return peaks[mask], kept_counts[offsets]
+
+
 class Spectrum():
     """
     A class to represent a mass spectrum. The class composes a numpy array to
@@ -40,21 +172,24 @@ class Spectrum():
     __slots__ = ("_peaks", "prec_mz", "charge", "retention_time",)
 
     def __init__(self, peak_list: Union[np.ndarray, List[List[float]]],
-                 prec_mz: float, charge: Optional[int],
+                 prec_mz: Optional[float], charge: Optional[int],
                  retention_time: Optional[float] = None):
         """
         Initializes the class.
 
         Args:
             peak_list (list): A list of lists containing m/z, intensity pairs.
-            prec_mz (float): The mass/charge ratio of the spectrum precursor.
+            prec_mz (float): The mass/charge ratio of the spectrum precursor,
+                             or None if unknown.
             charge (int): The charge state of the spectrum precursor.
             ret_time (float): The retention time for the spectrum.
 
         """
         self._peaks = (peak_list if isinstance(peak_list, np.ndarray)
                        else np.array(peak_list))
-        if self._peaks.shape[0] == 2:
+        # Accept column-oriented (2 x N) peak arrays. A 2 x 2 array is
+        # ambiguous and is taken to be row-oriented, like all other arrays
+        if self._peaks.shape[0] == 2 and self._peaks.shape[1] != 2:
             self._peaks = self._peaks.T
         self.prec_mz = prec_mz
         self.charge = charge
@@ -145,13 +280,16 @@ class Spectrum():
 
     def _mz_sort(self):
         """
-        Sorts the spectrum by the m/z ratios.
+        Sorts the spectrum by the m/z ratios. Spectra which are already sorted
+        are left untouched, so that views into a SpectrumStore are not copied.
 
         """
-        self._peaks = self._peaks[self._peaks[:, 0].argsort()]
+        mz = self._peaks[:, 0]
+        if (mz[1:] < mz[:-1]).any():
+            self._peaks = self._peaks[mz.argsort()]
 
     @property
-    def mz(self) -> np.array:
+    def mz(self) -> np.ndarray:
         """
         Retrieves the mass/charge ratios of the spectrum peaks.
 
@@ -159,7 +297,7 @@ class Spectrum():
         return self._peaks[:, 0]
 
     @property
-    def intensity(self) -> np.array:
+    def intensity(self) -> np.ndarray:
         """
         Retrieves the intensities of the spectrum peaks.
 
@@ -183,16 +321,19 @@ class Spectrum():
         return (self._peaks[peaks, :] if col is None
                 else self._peaks[peaks, col])
 
-    def normalize(self):
+    def normalize(self) -> Spectrum:
         """
-        Normalizes the spectrum to the base peak.
+        Normalizes the spectrum to the base peak. The spectrum itself is not
+        modified, so that spectra may share read-only peak arrays.
 
         Returns:
-            Spectrum
+            A new, normalized Spectrum.
 
         """
-        self._peaks[:, 1] = self._peaks[:, 1] / self.max_intensity()
-        return self
+        peaks = self._peaks.copy()
+        peaks[:, 1] = self._peaks[:, 1] / self.max_intensity()
+        return Spectrum(peaks, self.prec_mz, self.charge,
+                        retention_time=self.retention_time)
 
     def max_intensity(self) -> float:
         """
@@ -217,47 +358,14 @@ class Spectrum():
         if len(self._peaks) <= 1:
             return self
 
-        mz_diffs = np.diff(self.mz)
-
-        centroided = []
-        idx = 0
-        while idx < len(self._peaks):
-            peak = self._peaks[idx]
-            if idx >= len(mz_diffs):
-                centroided.append(peak)
-                break
-            diff = mz_diffs[idx]
-            if diff > 0.1:
-                centroided.append(peak)
-            else:
-                peak_cluster = [peak]
-                _diff = 0
-                while _diff <= 0.1:
-                    idx += 1
-                    peak = self._peaks[idx]
-                    peak_cluster.append(peak)
-                    if idx == len(mz_diffs):
-                        break
-                    _diff = mz_diffs[idx]
-                if len({p[1] for p in peak_cluster}) == 1:
-                    centroided.append(np.array(
-                        [sum(p[0] for p in peak_cluster) /
-                         float(len(peak_cluster)),
-                         peak_cluster[0][1]]))
-                else:
-                    centroided.append(max(peak_cluster,
-                                          key=operator.itemgetter(1)))
-            idx += 1
-
-        self._peaks = np.array(centroided)
+        self._peaks, _ = centroid_peaks(
+            self._peaks, np.array([0, len(self._peaks)]))
 
         return self
 
     def remove_itraq(self, tol: float = 0.1):
         """
         Removes the iTRAQ fragment peaks from the spectrum.
-        https://stackoverflow.com/questions/51744613/numpy-setdiff1d-with-
-        tolerance-comparing-a-numpy-array-to-another-and-saving-o.
 
         Args:
             tol (float, optional): The mass tolerance.
@@ -266,9 +374,7 @@ class Spectrum():
             Spectrum object minus any iTRAQ peaks.
 
         """
-        self._peaks = self._peaks[
-            (np.abs(np.subtract.outer(self._peaks[:, 0], ITRAQ_MASSES))
-             > tol).all(1)]
+        self._peaks = self._peaks[itraq_mask(self._peaks[:, 0], tol)]
         return self
 
     def annotate(self, theor_ions: List[Ion],
@@ -284,9 +390,129 @@ class Spectrum():
             A dictionary of ion label to Annotation namedtuple.
 
         """
-        return {k: Annotation(*v)
-                for k, v in annotate(list(self._peaks[:, 0]),
-                                     theor_ions, tol).items()}
+        return self.annotate_many([to_fragment_ions(theor_ions)],
+                                  tol=tol)[0]
+
+    def annotate_many(self, fragment_ion_sets: Sequence[FragmentIons],
+                      tol: float = 0.2) -> List[Dict[str, Annotation]]:
+        """
+        Annotates the spectrum using each of the provided sets of theoretical
+        ions, e.g. those of a set of candidate peptides, in a single native
+        call.
+
+        Args:
+            fragment_ion_sets (list): The FragmentIons of each peptide.
+            tol (float, optional): The mass tolerance for annotations.
+
+        Returns:
+            A list of dictionaries of ion label to Annotation namedtuple, one
+            per set of theoretical ions.
+
+        """
+        anns: List[Dict[str, Annotation]] = [{} for _ in fragment_ion_sets]
+        labels, records = self.annotate_records(fragment_ion_sets, tol=tol)
+        for pep_idx, label_idx, peak_num, mass_diff, ion_pos in \
+                records.tolist():
+            anns[pep_idx][labels[label_idx]] =\
+                Annotation(peak_num, mass_diff, ion_pos)
+        return anns
+
+    def annotate_records(
+            self,
+            fragment_ions: Union[Sequence[FragmentIons], FragmentIonBatch],
+            tol: float = 0.2) -> Tuple[List[str], np.ndarray]:
+        """
+        Annotates the spectrum using each of the provided sets of theoretical
+        ions in a single native call, as annotate_many, but returns the
+        annotations as records rather than as dictionaries.
+
+        Args:
+            fragment_ions (list/FragmentIonBatch): The FragmentIons of each
+                                                   peptide, or these already
+                                                   concatenated, e.g. to be
+                                                   reused across spectra.
+            tol (float, optional): The mass tolerance for annotations.
+
+        Returns:
+            Tuple of (sorted list of the ion labels, structured array of
+            BATCH_ANNOTATION_DTYPE), where the label_idx of each record
+            indexes the list of labels.
+
+        """
+        if not isinstance(fragment_ions, FragmentIonBatch):
+            fragment_ions = batch_fragment_ions(fragment_ions)
+
+        if len(fragment_ions.mzs) == 0:
+            return [], np.empty(0, dtype=BATCH_ANNOTATION_DTYPE)
+
+        records = self.annotate_batch(
+            fragment_ions.mzs, fragment_ions.positions,
+            fragment_ions.label_idxs, fragment_ions.offsets, tol)
+        return fragment_ions.labels, records
+
+    def annotate_arrays(self, ion_masses: np.ndarray,
+                        ion_positions: np.ndarray, label_idxs: np.ndarray,
+                        tol: float = 0.2) -> np.ndarray:
+        """
+        Annotates the spectrum using theoretical ions given as arrays, without
+        converting the peaks or ions to Python objects. The peak array is
+        passed to the native code as is, without copying the m/z column.
+
+        Args:
+            ion_masses (numpy.ndarray): The mass/charge ratios of the ions.
+            ion_positions (numpy.ndarray): The positions of the ions.
+            label_idxs (numpy.ndarray): An index for the label of each ion.
+                                        Where multiple ions share a label
+                                        index, the first matched is used.
+            tol (float, optional): The mass tolerance for annotations.
+
+        Returns:
+            A structured array of ANNOTATION_DTYPE, one record per annotated
+            label index, ordered by label index.
+
+        """
+        return np.frombuffer(
+            annotate_arrays(
+                np.ascontiguousarray(self._peaks, dtype=np.float64),
+                np.ascontiguousarray(ion_masses, dtype=np.float64),
+                np.ascontiguousarray(ion_positions, dtype=np.int64),
+                np.ascontiguousarray(label_idxs, dtype=np.int64),
+                float(tol)),
+            dtype=ANNOTATION_DTYPE)
+
+    def annotate_batch(self, ion_masses: np.ndarray,
+                       ion_positions: np.ndarray, label_idxs: np.ndarray,
+                       offsets: np.ndarray, tol: float = 0.2) -> np.ndarray:
+        """
+        Annotates the spectrum using a ragged batch of theoretical ion sets,
+        given as arrays, in a single native call. The GIL is released during
+        the annotation, so that batches can be annotated in multiple threads.
+
+        Args:
+            ion_masses (numpy.ndarray): The mass/charge ratios of the ions.
+            ion_positions (numpy.ndarray): The positions of the ions.
+            label_idxs (numpy.ndarray): An index for the label of each ion.
+                                        Within each ion set, the first matched
+                                        ion for a label index is used.
+            offsets (numpy.ndarray): The offsets of the ion sets in the ion
+                                     arrays, such that the ith set occupies
+                                     offsets[i]:offsets[i + 1].
+            tol (float, optional): The mass tolerance for annotations.
+
+        Returns:
+            A structured array of BATCH_ANNOTATION_DTYPE, ordered by ion set
+            index, then label index.
+
+        """
+        return np.frombuffer(
+            annotate_batch(
+                np.ascontiguousarray(self._peaks, dtype=np.float64),
+                np.ascontiguousarray(ion_masses, dtype=np.float64),
+                np.ascontiguousarray(ion_positions, dtype=np.int64),
+                np.ascontiguousarray(label_idxs, dtype=np.int64),
+                np.ascontiguousarray(offsets, dtype=np.int64),
+                float(tol)),
+            dtype=BATCH_ANNOTATION_DTYPE)
 
     def denoise(self, assigned_peaks: List[bool],
                 max_peaks_per_window: int = 8) -> Tuple[List[int], Spectrum]:
@@ -303,49 +529,60 @@ class Spectrum():
             Tuple: The denoised peak indexes as a list, The denoised spectrum
 
         """
-        npeaks = len(self._peaks)
-        # Divide the mass spectrum into windows of 100 Da
-        n_windows = int((self._peaks[-1][0] - self._peaks[0][0]) / 100.) + 1
-        start_idx = 0
-        new_peaks: List[int] = []
+        new_peaks = self.denoise_indices(assigned_peaks, max_peaks_per_window)
 
-        for window in range(n_windows):
-            # Set up the mass limit for the current window
-            max_mass = self._peaks[0][0] + (window + 1) * 100.
+        return new_peaks.tolist(), Spectrum(self._peaks[new_peaks, :],
+                                            self.prec_mz, self.charge)
 
-            # Find the last index with a peak mass within the current window
-            for end_idx in range(start_idx, npeaks):
-                if self._peaks[end_idx][0] > max_mass:
-                    break
+    def denoise_indices(self, assigned_peaks: Sequence[bool],
+                        max_peaks_per_window: int = 8) -> np.ndarray:
+        """
+        Denoises the mass spectrum using the annotated ions, as denoise, but
+        returns only the retained peak indexes, without constructing the
+        denoised spectrum.
 
-            if end_idx == start_idx:
-                if (self._peaks[end_idx][0] <= max_mass and
-                        assigned_peaks[end_idx]):
-                    new_peaks.append(end_idx)
-                continue
+        Args:
+            assigned_peaks (list): A list of booleans indicating whether the
+                                   corresponding index peak is annotated.
+            max_peaks_per_window (int, optional): The maximum number of peaks
+                                                  to include per 100 Da window.
 
-            # Sort the peaks within the window in descending order of
-            # intensity
-            window_peaks = sorted(list(range(start_idx, end_idx)),
-                                  key=lambda ii: self._peaks[ii][1],
-                                  reverse=True)
+        Returns:
+            numpy.ndarray of the denoised peak indexes, in window order.
 
-            ion_scores = [assigned_peaks[idx] for idx in window_peaks]
+        """
+        return denoise(
+            np.asarray(self._peaks, dtype=np.float64),
+            np.asarray(assigned_peaks, dtype=bool).view(np.uint8),
+            max_peaks_per_window)
 
-            # Sum the scores for the top intensity peaks in the window
-            sum_scores = [sum(ion_scores[:idx])
-                          for idx in range(1, min(len(ion_scores) + 1,
-                                                  max_peaks_per_window + 1))]
+    def denoise_many(self, assigned_peaks: np.ndarray,
+                     max_peaks_per_window: int = 8) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Denoises the mass spectrum using each of a number of sets of
+        annotated ions in a single call, as denoise_indices.
 
-            # Take the top number of peaks with the highest number of
-            # annotations
-            new_peaks += window_peaks[:sum_scores.index(max(sum_scores)) + 1]
+        Args:
+            assigned_peaks (numpy.ndarray): A two-dimensional boolean array,
+                                            with one row per set of
+                                            annotations, indicating whether
+                                            the corresponding index peak is
+                                            annotated.
+            max_peaks_per_window (int, optional): The maximum number of peaks
+                                                  to include per 100 Da window.
+
+        Returns:
+            Tuple of (numpy.ndarray of the denoised peak indexes of all of the
+            sets, in window order, numpy.ndarray of the offsets of each set's
+            indexes).
 
-            start_idx = end_idx
+        """
+        return denoise_many(
+            np.asarray(self._peaks, dtype=np.float64),
+            np.ascontiguousarray(assigned_peaks, dtype=bool).view(np.uint8),
+            max_peaks_per_window)
 
-        return new_peaks, Spectrum(self._peaks[new_peaks, :], self.prec_mz,
-                                   self.charge)
-                                   
     def to_mgf_block(self, spec_id: str) -> str:
         """
         Constructs a BEGIN IONS - END IONS MGF-format block for the spectrum.
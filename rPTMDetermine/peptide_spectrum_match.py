@@ -5,16 +5,22 @@ Module contains a class to define a Peptide Spectrum Match (PSM).
 """
 import bisect
 import collections
-from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+import itertools
+from typing import (Dict, Iterable, List, Optional, Sequence, Set, Tuple,
+                    Union)
 
-from .constants import DEFAULT_FRAGMENT_IONS, FIXED_MASSES
-from .features import Features
+import numpy as np
+
+from .constants import FIXED_MASSES
+from .features import FEATURE_COLUMNS, Features, feature_matrix
+from .fragment_cache import (FragmentIonBatch, FragmentIons,
+                             get_fragment_ions)
 from . import ionscore
 from . import mass_spectrum
 from . import proteolysis
 from . import utilities
 
-from pepfrag import IonType, ModSite, Peptide
+from pepfrag import ModSite, Peptide
 
 
 DecoyID = collections.namedtuple(
@@ -225,7 +231,7 @@ class PSM:
 
     def annotate_spectrum(
         self, tol: float = 0.2,
-        ion_types: Optional[Dict[IonType, Dict[str, Any]]] = None)\
+        ion_types: Optional[Dict[int, List[str]]] = None)\
             -> Dict[str, mass_spectrum.Annotation]:
         """
         Annotates the mass spectrum using the theoretical ions of the peptide.
@@ -240,27 +246,22 @@ class PSM:
         """
         self._check_spectrum_initialized()
 
-        if ion_types is None:
-            ion_types = {
-                IonType.precursor.value: ["H2O", "NH3"],
-                IonType.imm.value: [],
-                IonType.b.value: ["H2O", "NH3"],
-                IonType.y.value: ["H2O", "NH3"],
-                IonType.a.value: []
-            }
-
-        # Get the theoretical ions for the peptide
-        ions = self.peptide.fragment(
-            ion_types=DEFAULT_FRAGMENT_IONS if ion_types is None
-            else ion_types)
-
-        return self.spectrum.annotate(ions, tol=tol)
+        return self.spectrum.annotate_many(
+            [get_fragment_ions(self.peptide, ion_types)], tol=tol)[0]
 
-    def denoise_spectrum(self, tol: float = 0.2)\
+    def denoise_spectrum(
+        self, tol: float = 0.2,
+        anns: Optional[Dict[str, mass_spectrum.Annotation]] = None)\
             -> Tuple[Dict[str, Tuple[int, int]], mass_spectrum.Spectrum]:
         """
         Adaptively denoises the mass spectrum.
 
+        Args:
+            tol (float, optional): The annotation m/z tolerance.
+            anns (dict, optional): The spectrum annotations, if these have
+                                   already been computed, e.g. by
+                                   Spectrum.annotate_many.
+
         Returns:
             A dictionary mapping ion labels to peaks.
 
@@ -268,22 +269,17 @@ class PSM:
         self._check_spectrum_initialized()
 
         # The spectrum annotations
-        anns = self.annotate_spectrum(tol=tol)
-        ann_peak_nums = {an.peak_num for an in anns.values()}
-        denoised_peaks, denoised_spec = self.spectrum.denoise(
-            [idx in ann_peak_nums for idx in range(len(self.spectrum))])
-
-        denoised_peaks.sort()
-
-        ion_anns = {l: (bisect.bisect_left(denoised_peaks, a.peak_num),
-                        a.ion_pos)
-                    for l, a in anns.items() if a.peak_num in denoised_peaks}
+        if anns is None:
+            anns = self.annotate_spectrum(tol=tol)
 
-        return ion_anns, denoised_spec
+        return _denoise_annotated(self.spectrum, anns)
 
-    def extract_features(self, target_mod: Optional[str],
-                         proteolyzer: proteolysis.Proteolyzer,
-                         tol: float = 0.2) -> Features:
+    def extract_features(
+        self, target_mod: Optional[str],
+        proteolyzer: proteolysis.Proteolyzer,
+        tol: float = 0.2,
+        anns: Optional[Dict[str, mass_spectrum.Annotation]] = None)\
+            -> Features:
         """
         Extracts possible machine learning features from the peptide spectrum
         match.
@@ -295,187 +291,20 @@ class PSM:
             proteolyzer (proteolysis.Proteolyzer): The enzymatic proteolyzer
                                                    for calculating the number
                                                    of missed cleavages.
+            anns (dict, optional): The spectrum annotations, if these have
+                                   already been computed.
         Returns:
             Features.
         """
         self._check_spectrum_initialized()
 
-        ions, denoised_spectrum = self.denoise_spectrum()
-        self.spectrum.normalize()
-        denoised_spectrum.normalize()
-        self._calculate_features(ions, denoised_spectrum, target_mod, tol)
-
-        # Use the proteolyzer to determine the number of missed cleavages
-        self.features.MissedCleavages =\
-            proteolyzer.count_missed_cleavages(self.seq)
+        row = extract_feature_matrix(
+            [(self.peptide, self.spectrum)], target_mod, proteolyzer, tol=tol,
+            anns=None if anns is None else [anns])[0]
+        self.features = Features.from_array(row)
 
         return self.features
 
-    def _calculate_features(self, ions: dict,
-                            denoised_spectrum: mass_spectrum.Spectrum,
-                            target_mod: Optional[str], tol: float)\
-            -> Features:
-        """
-        Calculates potential machine learning features from the peptide
-        spectrum match.
-        Args:
-            ions (dict): The theoretical ion peak annotations.
-            denoised_spectrum (Spectrum): The denoised mass spectrum.
-            target_mod (str): The target modification type. If this, is None,
-                              i.e. for unmodified analogues, then some
-                              modification-based features will not be
-                              calculated.
-            tol (float): The mass tolerance level to apply.
-        """
-        # The length of the peptide
-        pep_len = len(self.seq)
-        self.features.PepLen = pep_len
-
-        self.features.PepMass = self.peptide.mass
-        self.features.Charge = self.charge
-        self.features.ErrPepMass = abs(
-            self.features.PepMass - denoised_spectrum.prec_mz * self.charge
-            + self.charge * FIXED_MASSES["H"])
-
-        # Intensities from the spectrum
-        intensities = list(denoised_spectrum.intensity)
-
-        mod_ion_start: Dict[str, int] = {}
-        if target_mod is not None:
-            # The position from which b-/y-ions will contain the modified
-            # residue
-            mod_ion_start = {'b': min(ms.site for ms in self.mods
-                                      if ms.mod == target_mod),
-                             'y': min(pep_len - ms.site + 1
-                                      for ms in self.mods
-                                      if ms.mod == target_mod)}
-
-            # The sum of the modified ion intensities
-            self.features.TotalIntMod = \
-                sum(intensities[ions[l][0]] for l in ions.keys()
-                    if (l[0] == 'y' and '-' not in l and
-                        ions[l][1] >= mod_ion_start['y'])
-                    or (l[0] == 'b' and '-' not in l and
-                        ions[l][1] >= mod_ion_start['b']))
-
-        # The regular b-/y-ions annotated for the PSM
-        seq_ions = [l for l in ions.keys() if l[0] in 'yb' and '-' not in l]
-
-        # The peaks annotated by theoretical ions
-        ann_peaks = {v[0] for v in ions.values()}
-
-        # The number of annotated peaks divided by the total number of peaks
-        self.features.FracIon = len(ann_peaks) /\
-            float(len(denoised_spectrum))
-        self.features.FracIonInt =\
-            sum(intensities[idx] for idx in ann_peaks) / sum(intensities)
-
-        # The intensity of the base peak
-        max_int = denoised_spectrum.max_intensity()
-
-        # The peaks with intensity >= 20% of the base peak intensity
-        peaks_20 = {ii for ii, peak in enumerate(denoised_spectrum)
-                    if peak[1] >= max_int * 0.2 and peak[0] >= 300}
-
-        # The fraction of peaks with intensities greater than 20% of the base
-        # peak annotated by the theoretical ions
-        ions_20 = {ions[l][0] for l in seq_ions if ions[l][0] in peaks_20}
-        self.features.FracIon20pc = \
-            (len(ions_20) / float(len(peaks_20)) if peaks_20 else 0)
-
-        # Sequence coverage
-        n_anns = self._calculate_sequence_coverage(target_mod, seq_ions,
-                                                   mod_ion_start)
-
-        # The fraction of b-ions annotated by theoretical ions
-        if self.features.NumIonb is not None:
-            self.features.NumIonb2l = self.features.NumIonb / float(pep_len)
-        # The fraction of y-ions annotated by theoretical ions
-        if self.features.NumIony is not None:
-            self.features.NumIony2l = self.features.NumIony / float(pep_len)
-
-        # Ion score
-        self._calculate_ion_scores(denoised_spectrum, n_anns, target_mod, tol)
-
-        return self.features
-
-    def _calculate_ion_scores(self, denoised_spectrum: mass_spectrum.Spectrum,
-                              n_anns: Dict[str, int],
-                              target_mod: Optional[str],
-                              tol: float):
-        """
-        Calculates the ion score features.
-        """
-        mzs = denoised_spectrum.mz
-        mzrange = mzs[-1] - mzs[0]
-        self.features.MatchScore = ionscore.ionscore(
-            len(self.seq), len(mzs), n_anns["all"], mzrange, tol)
-        if target_mod is not None:
-            self.features.MatchScoreMod = ionscore.ionscore(
-                len(self.seq), len(mzs), n_anns["mod"], mzrange, tol)
-
-    def _calculate_sequence_coverage(self, target_mod: Optional[str],
-                                     seq_ions: Iterable[str],
-                                     mod_ion_start: Dict[str, int]) \
-            -> Dict[str, int]:
-        """
-        Calculates features related to the sequence coverage by the ion
-        annotations.
-        Args:
-        """
-        # The maximum number of fragments annotated by theoretical ions
-        # across the charge states. mod is the maximum number of fragments
-        # containing the modified residue
-        n_anns: Dict[str, int] = {"all": 0, "mod": 0}
-
-        # The longest consecutive ion sequence found among charge states
-        max_ion_seq_len = 0
-        # Across the charge states, the maximum number of each ion type
-        # annotated
-        max_ion_counts = {'b': -1, 'y': -1}
-
-        for _charge in range(self.charge):
-            c_str = '[+]' if _charge == 0 else f'[{_charge + 1}+]'
-            # The number of annotated ions
-            n_ions = {"all": 0, "mod": 0}
-
-            for ion_type in ['y', 'b']:
-                # A list of b-/y-ion numbers (e.g. 2 for b2[+])
-                ion_nums = sorted(
-                    [int(l.split('[')[0][1:])
-                     for l in seq_ions if l[0] == ion_type and c_str in l])
-
-                if target_mod is not None:
-                    # The number of ions of ion_type containing the
-                    # modification
-                    n_ions["mod"] += len(ion_nums) - \
-                        bisect.bisect_left(ion_nums, mod_ion_start[ion_type])
-
-                # Increment the number of ions annotated for the current charge
-                n_ions["all"] += len(ion_nums)
-
-                # Update the max number of annotated ions if appropriate
-                if len(ion_nums) > max_ion_counts[ion_type]:
-                    max_ion_counts[ion_type] = len(ion_nums)
-
-                ion_seq_len, _ = utilities.longest_sequence(ion_nums)
-                if ion_seq_len > max_ion_seq_len:
-                    max_ion_seq_len = ion_seq_len
-
-            if n_ions["all"] > n_anns["all"]:
-                n_anns["all"] = n_ions["all"]
-
-            if target_mod is not None and n_ions["mod"] > n_anns["mod"]:
-                n_anns["mod"] = n_ions["mod"]
-
-        self.features.NumIonb = max_ion_counts['b']
-        self.features.NumIony = max_ion_counts['y']
-
-        # The longest sequence tag found divided by the peptide length
-        self.features.SeqTagm = max_ion_seq_len / float(len(self.seq))
-
-        return n_anns
-
 
 class UnmodPSM(PSM):
     """
@@ -551,3 +380,365 @@ def unique_unmod_psms(psms: List[UnmodPSM]) -> List[UnmodPSM]:
         uids.add(psm.uid)
         unique.append(psm)
     return unique
+
+
+def extract_feature_matrix(
+        pairs: Sequence[Tuple[Peptide, mass_spectrum.Spectrum]],
+        target_mod: Optional[str],
+        proteolyzer: proteolysis.Proteolyzer,
+        tol: float = 0.2,
+        anns: Optional[Sequence[Dict[str, mass_spectrum.Annotation]]] = None,
+        out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Extracts the machine learning features for a batch of peptide spectrum
+    matches, writing them directly into a feature matrix rather than
+    creating a Features object per match.
+
+    Args:
+        pairs (list): The (peptide, spectrum) pairs of the matches.
+        target_mod (str): The modification type under validation. If this,
+                          is None, i.e. for unmodified analogues, then
+                          some modification-based features will not be
+                          calculated.
+        proteolyzer (proteolysis.Proteolyzer): The enzymatic proteolyzer
+                                               for calculating the number
+                                               of missed cleavages.
+        tol (float, optional): The m/z tolerance.
+        anns (list, optional): The spectrum annotations of each pair, if
+                               these have already been computed.
+        out (numpy.ndarray, optional): The matrix into which to write the
+                                       features, with one row per pair.
+
+    Returns:
+        The feature matrix, whose columns are Features.all_feature_names(),
+        with NaN for the features which are not calculated.
+
+    """
+    if out is None:
+        out = feature_matrix(len(pairs))
+    elif out.shape != (len(pairs), len(FEATURE_COLUMNS)):
+        raise ValueError(
+            f"Feature matrix of shape {out.shape} does not match "
+            f"{len(pairs)} pairs and {len(FEATURE_COLUMNS)} features")
+    else:
+        out.fill(np.nan)
+
+    if anns is None:
+        anns = _annotate_pairs(pairs, tol)
+
+    for row, (peptide, spectrum), pair_anns in zip(out, pairs, anns):
+        # The spectrum is not modified, so that the pairs may share spectra
+        ions, denoised_spectrum = _denoise_annotated(spectrum, pair_anns)
+        _calculate_features(peptide, ions, denoised_spectrum.normalize(),
+                            target_mod, tol, row)
+
+        # Use the proteolyzer to determine the number of missed cleavages
+        row[FEATURE_COLUMNS["MissedCleavages"]] =\
+            proteolyzer.count_missed_cleavages(peptide.seq)
+
+    return out
+
+
+def calculate_match_scores(
+        peptides: Sequence[Peptide], spectrum: mass_spectrum.Spectrum,
+        fragment_ions: Optional[
+            Union[Sequence[FragmentIons], FragmentIonBatch]] = None,
+        tol: float = 0.2) -> np.ndarray:
+    """
+    Calculates only the MatchScore feature of each peptide matched to the
+    spectrum. Each peptide is annotated and denoised as by
+    extract_feature_matrix, but the sequence coverage is counted directly
+    from the annotation records and no other features are calculated, so
+    that large numbers of candidate peptides can be screened cheaply. The
+    spectrum is annotated and denoised for all of the peptides in single
+    batch calls.
+
+    Args:
+        peptides (list): The candidate peptides.
+        spectrum (mass_spectrum.Spectrum): The mass spectrum.
+        fragment_ions (list/FragmentIonBatch, optional): The FragmentIons of
+                                                         each peptide, if
+                                                         already retrieved.
+        tol (float, optional): The m/z tolerance.
+
+    Returns:
+        numpy.ndarray of the MatchScore of each peptide.
+
+    """
+    if fragment_ions is None:
+        fragment_ions = [get_fragment_ions(peptide) for peptide in peptides]
+
+    labels, records = spectrum.annotate_records(fragment_ions, tol=tol)
+
+    # The charge state counted towards sequence coverage for each record
+    label_charges = np.array([_sequence_ion_charge(l) for l in labels],
+                             dtype=np.int64)
+    record_charges = label_charges[records["label_idx"]]
+    pep_idxs = records["pep_idx"]
+    peak_nums = records["peak_num"]
+
+    # Denoise the spectrum using the annotations of all of the peptides at
+    # once
+    assigned = np.zeros((len(peptides), len(spectrum)), dtype=bool)
+    assigned[pep_idxs, peak_nums] = True
+    denoised_peaks, offsets = spectrum.denoise_many(assigned)
+    num_denoised = np.diff(offsets)
+    kept = np.zeros_like(assigned)
+    kept[np.repeat(np.arange(len(peptides)), num_denoised),
+         denoised_peaks] = True
+
+    # The maximum number of b-/y-ions annotated among the charge states up to
+    # the charge of each peptide
+    pep_charges = np.array([peptide.charge for peptide in peptides],
+                           dtype=np.int64)
+    record_kept = kept[pep_idxs, peak_nums]
+    charge_counts = np.zeros(
+        (len(peptides), max(pep_charges.max(initial=0),
+                            record_charges.max(initial=0)) + 1),
+        dtype=np.int64)
+    np.add.at(charge_counts,
+              (pep_idxs[record_kept], record_charges[record_kept]), 1)
+    charge_counts[np.arange(charge_counts.shape[1]) >
+                  pep_charges[:, np.newaxis]] = 0
+    seq_covs = charge_counts[:, 1:].max(axis=1, initial=0)
+
+    # The spectrum is sorted by m/z, so the denoised m/z range spans the
+    # lowest and highest retained peak indexes
+    mz_ranges = np.zeros(len(peptides), dtype=np.float64)
+    if len(denoised_peaks):
+        starts = np.minimum(offsets[:-1], len(denoised_peaks) - 1)
+        mz_ranges = np.where(
+            num_denoised > 0,
+            spectrum.mz[np.maximum.reduceat(denoised_peaks, starts)] -
+            spectrum.mz[np.minimum.reduceat(denoised_peaks, starts)], 0.)
+
+    return np.array([
+        ionscore.ionscore(len(peptide.seq), num_peaks, seq_cov, mz_range,
+                          tol)
+        for peptide, num_peaks, seq_cov, mz_range in zip(
+            peptides, num_denoised.tolist(), seq_covs.tolist(),
+            mz_ranges.tolist())], dtype=np.float64)
+
+
+def _sequence_ion_charge(label: str) -> int:
+    """
+    Finds the charge state of a regular b-/y-ion label, e.g. 2 for b3[2+],
+    or zero for the labels which do not count towards sequence coverage.
+
+    """
+    if label[0] not in "yb" or "-" in label or "[" not in label:
+        return 0
+    charge = label[label.index("[") + 1:].split("+")[0]
+    return int(charge) if charge else 1
+
+
+def _annotate_pairs(
+        pairs: Sequence[Tuple[Peptide, mass_spectrum.Spectrum]],
+        tol: float) -> List[Dict[str, mass_spectrum.Annotation]]:
+    """
+    Annotates the spectrum of each (peptide, spectrum) pair, using a single
+    Spectrum.annotate_many call for each run of pairs sharing a spectrum.
+
+    """
+    anns: List[Dict[str, mass_spectrum.Annotation]] = []
+    for _, group in itertools.groupby(pairs, key=lambda pair: id(pair[1])):
+        peps, spectra = zip(*group)
+        anns.extend(spectra[0].annotate_many(
+            [get_fragment_ions(peptide) for peptide in peps], tol=tol))
+    return anns
+
+
+def _denoise_annotated(spectrum: mass_spectrum.Spectrum,
+                       anns: Dict[str, mass_spectrum.Annotation])\
+        -> Tuple[Dict[str, Tuple[int, int]], mass_spectrum.Spectrum]:
+    """
+    Adaptively denoises the mass spectrum using its annotations.
+
+    Returns:
+        A dictionary mapping ion labels to (denoised peak index, ion
+        position), and the denoised spectrum.
+
+    """
+    ann_peak_nums = {an.peak_num for an in anns.values()}
+    denoised_peaks, denoised_spec = spectrum.denoise(
+        [idx in ann_peak_nums for idx in range(len(spectrum))])
+
+    denoised_peaks.sort()
+
+    ion_anns = {l: (bisect.bisect_left(denoised_peaks, a.peak_num),
+                    a.ion_pos)
+                for l, a in anns.items() if a.peak_num in denoised_peaks}
+
+    return ion_anns, denoised_spec
+
+
+def _calculate_features(peptide: Peptide, ions: dict,
+                        denoised_spectrum: mass_spectrum.Spectrum,
+                        target_mod: Optional[str], tol: float,
+                        row: np.ndarray):
+    """
+    Calculates potential machine learning features from the peptide
+    spectrum match.
+    Args:
+        peptide (pepfrag.Peptide): The matched peptide.
+        ions (dict): The theoretical ion peak annotations.
+        denoised_spectrum (Spectrum): The denoised mass spectrum.
+        target_mod (str): The target modification type. If this, is None,
+                          i.e. for unmodified analogues, then some
+                          modification-based features will not be
+                          calculated.
+        tol (float): The mass tolerance level to apply.
+        row (numpy.ndarray): The feature matrix row into which to write the
+                             features.
+    """
+    col = FEATURE_COLUMNS
+    charge = peptide.charge
+
+    # The length of the peptide
+    pep_len = len(peptide.seq)
+    row[col["PepLen"]] = pep_len
+
+    pep_mass = peptide.mass
+    row[col["PepMass"]] = pep_mass
+    row[col["Charge"]] = charge
+    row[col["ErrPepMass"]] = abs(
+        pep_mass - denoised_spectrum.prec_mz * charge
+        + charge * FIXED_MASSES["H"])
+
+    # Intensities from the spectrum
+    intensities = list(denoised_spectrum.intensity)
+
+    mod_ion_start: Dict[str, int] = {}
+    if target_mod is not None:
+        # The position from which b-/y-ions will contain the modified
+        # residue
+        mod_ion_start = {'b': min(ms.site for ms in peptide.mods
+                                  if ms.mod == target_mod),
+                         'y': min(pep_len - ms.site + 1
+                                  for ms in peptide.mods
+                                  if ms.mod == target_mod)}
+
+        # The sum of the modified ion intensities
+        row[col["TotalIntMod"]] = \
+            sum(intensities[ions[l][0]] for l in ions.keys()
+                if (l[0] == 'y' and '-' not in l and
+                    ions[l][1] >= mod_ion_start['y'])
+                or (l[0] == 'b' and '-' not in l and
+                    ions[l][1] >= mod_ion_start['b']))
+
+    # The regular b-/y-ions annotated for the PSM
+    seq_ions = [l for l in ions.keys() if l[0] in 'yb' and '-' not in l]
+
+    # The peaks annotated by theoretical ions
+    ann_peaks = {v[0] for v in ions.values()}
+
+    # The number of annotated peaks divided by the total number of peaks
+    row[col["FracIon"]] = len(ann_peaks) / float(len(denoised_spectrum))
+    row[col["FracIonInt"]] =\
+        sum(intensities[idx] for idx in ann_peaks) / sum(intensities)
+
+    # The intensity of the base peak
+    max_int = denoised_spectrum.max_intensity()
+
+    # The peaks with intensity >= 20% of the base peak intensity
+    peaks_20 = {ii for ii, peak in enumerate(denoised_spectrum)
+                if peak[1] >= max_int * 0.2 and peak[0] >= 300}
+
+    # The fraction of peaks with intensities greater than 20% of the base
+    # peak annotated by the theoretical ions
+    ions_20 = {ions[l][0] for l in seq_ions if ions[l][0] in peaks_20}
+    row[col["FracIon20pc"]] = \
+        (len(ions_20) / float(len(peaks_20)) if peaks_20 else 0)
+
+    # Sequence coverage
+    n_anns = _calculate_sequence_coverage(peptide, target_mod, seq_ions,
+                                          mod_ion_start, row)
+
+    # The fraction of b-ions annotated by theoretical ions
+    row[col["NumIonb2l"]] = row[col["NumIonb"]] / float(pep_len)
+    # The fraction of y-ions annotated by theoretical ions
+    row[col["NumIony2l"]] = row[col["NumIony"]] / float(pep_len)
+
+    # Ion score
+    _calculate_ion_scores(pep_len, denoised_spectrum, n_anns, target_mod,
+                          tol, row)
+
+
+def _calculate_ion_scores(pep_len: int,
+                          denoised_spectrum: mass_spectrum.Spectrum,
+                          n_anns: Dict[str, int],
+                          target_mod: Optional[str],
+                          tol: float, row: np.ndarray):
+    """
+    Calculates the ion score features.
+    """
+    mzs = denoised_spectrum.mz
+    mzrange = mzs[-1] - mzs[0]
+    row[FEATURE_COLUMNS["MatchScore"]] = ionscore.ionscore(
+        pep_len, len(mzs), n_anns["all"], mzrange, tol)
+    if target_mod is not None:
+        row[FEATURE_COLUMNS["MatchScoreMod"]] = ionscore.ionscore(
+            pep_len, len(mzs), n_anns["mod"], mzrange, tol)
+
+
+def _calculate_sequence_coverage(peptide: Peptide, target_mod: Optional[str],
+                                 seq_ions: Iterable[str],
+                                 mod_ion_start: Dict[str, int],
+                                 row: np.ndarray) -> Dict[str, int]:
+    """
+    Calculates features related to the sequence coverage by the ion
+    annotations.
+    Args:
+    """
+    # The maximum number of fragments annotated by theoretical ions
+    # across the charge states. mod is the maximum number of fragments
+    # containing the modified residue
+    n_anns: Dict[str, int] = {"all": 0, "mod": 0}
+
+    # The longest consecutive ion sequence found among charge states
+    max_ion_seq_len = 0
+    # Across the charge states, the maximum number of each ion type
+    # annotated
+    max_ion_counts = {'b': -1, 'y': -1}
+
+    for _charge in range(peptide.charge):
+        c_str = '[+]' if _charge == 0 else f'[{_charge + 1}+]'
+        # The number of annotated ions
+        n_ions = {"all": 0, "mod": 0}
+
+        for ion_type in ['y', 'b']:
+            # A list of b-/y-ion numbers (e.g. 2 for b2[+])
+            ion_nums = sorted(
+                [int(l.split('[')[0][1:])
+                 for l in seq_ions if l[0] == ion_type and c_str in l])
+
+            if target_mod is not None:
+                # The number of ions of ion_type containing the
+                # modification
+                n_ions["mod"] += len(ion_nums) - \
+                    bisect.bisect_left(ion_nums, mod_ion_start[ion_type])
+
+            # Increment the number of ions annotated for the current charge
+            n_ions["all"] += len(ion_nums)
+
+            # Update the max number of annotated ions if appropriate
+            if len(ion_nums) > max_ion_counts[ion_type]:
+                max_ion_counts[ion_type] = len(ion_nums)
+
+            ion_seq_len, _ = utilities.longest_sequence(ion_nums)
+            if ion_seq_len > max_ion_seq_len:
+                max_ion_seq_len = ion_seq_len
+
+        if n_ions["all"] > n_anns["all"]:
+            n_anns["all"] = n_ions["all"]
+
+        if target_mod is not None and n_ions["mod"] > n_anns["mod"]:
+            n_anns["mod"] = n_ions["mod"]
+
+    row[FEATURE_COLUMNS["NumIonb"]] = max_ion_counts['b']
+    row[FEATURE_COLUMNS["NumIony"]] = max_ion_counts['y']
+
+    # The longest sequence tag found divided by the peptide length
+    row[FEATURE_COLUMNS["SeqTagm"]] = max_ion_seq_len / float(len(peptide.seq))
+
+    return n_anns
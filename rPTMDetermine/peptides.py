@@ -4,11 +4,11 @@ A set of functions to be used for processing peptide sequences.
 
 """
 import collections
-import functools
 import operator
-from typing import Sequence, Union
+from typing import Sequence, Tuple, Union
 
-from pepfrag import AA_MASSES, FIXED_MASSES, IonType, ModSite, Peptide
+import numpy as np
+from pepfrag import AA_MASSES, FIXED_MASSES, ModSite, Peptide
 
 from .readers import preparse_mod_string
 
@@ -75,14 +75,186 @@ def merge_seq_mods(seq: str,
     return ''.join(seq_list)
 
 
-@functools.lru_cache(maxsize=10000)
-def get_by_ion_mzs(peptide: Peptide):
+# Monoisotopic residue masses indexed by the ASCII code of the residue, with
+# zero mass for padding
+_RESIDUE_MASSES = np.zeros(256, dtype=np.float64)
+for _res, _mass in AA_MASSES.items():
+    _RESIDUE_MASSES[ord(_res)] = _mass.mono
+
+
+def encode_sequences(seqs: Sequence[str]) -> np.ndarray:
+    """
+    Encodes peptide sequences as a matrix of the ASCII codes of their
+    residues, padded with zeros to the longest sequence.
+
+    Args:
+        seqs (list): The peptide sequences.
+
+    Returns:
+        numpy.ndarray of uint8 of shape (number of sequences, maximum
+        length).
+
+    """
+    max_len = max((len(seq) for seq in seqs), default=0)
+    if max_len == 0:
+        return np.zeros((len(seqs), 0), dtype=np.uint8)
+    return np.array(seqs, dtype=f"S{max_len}").view(np.uint8)\
+        .reshape(len(seqs), max_len)
+
+
+def residue_masses(codes: np.ndarray) -> np.ndarray:
+    """
+    Looks up the monoisotopic masses of the residues encoded by
+    encode_sequences, with zero mass for the padding.
+
+    Args:
+        codes (numpy.ndarray): The encoded sequences.
+
+    Returns:
+        numpy.ndarray of the residue masses, of the same shape as codes.
+
+    """
+    return _RESIDUE_MASSES[codes]
+
+
+def _mod_column(site: Union[int, str], seq_len: int, cterm_col: int) -> int:
+    """
+    Converts a modification site to its column in the mass matrix used by
+    get_by_ion_mzs_batch.
+
+    """
+    if isinstance(site, str):
+        term = site.lower().replace("-", "")
+        if term == "nterm":
+            return 0
+        if term == "cterm":
+            return cterm_col
+    site = int(site)
+    if not 1 <= site <= seq_len:
+        raise ValueError(f"Invalid modification site {site}")
+    return site
+
+
+def get_by_ion_mzs_batch(peptides: Sequence[Peptide]) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Generates the b/y-type fragment ion mass/charge ratios, without neutral
+    losses, for a batch of peptides in a single vectorized pass. The ions are
+    those generated by pepfrag: b- and y-ions of each charge state up to the
+    peptide charge, where ions of charge c are generated for fragments of at
+    least 2c - 1 residues.
+
+    Args:
+        peptides (list): The peptides to fragment.
+
+    Returns:
+        Tuple of (ion m/z array, offsets), such that the ions of the ith
+        peptide are mzs[offsets[i]:offsets[i + 1]], sorted by m/z.
+
+    """
+    num_peps = len(peptides)
+    if num_peps == 0:
+        return np.empty(0, dtype=np.float64), np.zeros(1, dtype=np.int64)
+
+    lengths = np.array([len(pep.seq) for pep in peptides], dtype=np.int64)
+    charges = np.array([pep.charge for pep in peptides], dtype=np.int64)
+    max_len = int(lengths.max())
+
+    # The mass matrix columns are the N-terminus, the residues (padded to the
+    # longest sequence) and the C-terminus
+    cterm_col = max_len + 1
+    masses = np.zeros((num_peps, max_len + 2), dtype=np.float64)
+    masses[:, 1:cterm_col] = residue_masses(
+        encode_sequences([pep.seq for pep in peptides]))
+
+    mod_rows, mod_cols, mod_masses = [], [], []
+    for ii, pep in enumerate(peptides):
+        for mod_mass, site, _ in pep.mods:
+            mod_rows.append(ii)
+            mod_cols.append(_mod_column(site, lengths[ii], cterm_col))
+            mod_masses.append(mod_mass)
+    # The modification masses at each site are summed before being added to
+    # the residue masses, as in pepfrag
+    site_mod_masses = np.zeros_like(masses)
+    np.add.at(site_mod_masses, (mod_rows, mod_cols), mod_masses)
+    masses += site_mod_masses
+
+    return get_by_ion_mzs_from_masses(masses, lengths, charges)
+
+
+def get_by_ion_mzs_from_masses(masses: np.ndarray, lengths: np.ndarray,
+                               charges: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Generates the b/y-type fragment ion mass/charge ratios, as for
+    get_by_ion_mzs_batch, from the modified residue masses of the peptides.
+
+    Args:
+        masses (numpy.ndarray): The masses of the N-terminus, the residues,
+                                including their modifications and padded
+                                with zeros to the longest sequence, and the
+                                C-terminus, one row per peptide.
+        lengths (numpy.ndarray): The peptide sequence lengths.
+        charges (numpy.ndarray): The peptide charge states.
+
+    Returns:
+        Tuple of (ion m/z array, offsets), such that the ions of the ith
+        peptide are mzs[offsets[i]:offsets[i + 1]], sorted by m/z.
+
+    """
+    num_peps = len(masses)
+    if num_peps == 0:
+        return np.empty(0, dtype=np.float64), np.zeros(1, dtype=np.int64)
+
+    max_len = masses.shape[1] - 2
+    max_charge = int(charges.max())
+    cterm_col = max_len + 1
+
+    rows = np.arange(num_peps)[:, np.newaxis]
+    # Fragment lengths, 1 to max_len
+    frag_lens = np.arange(1, max_len + 1)
+
+    # The b-ion neutral masses: the N-terminus plus the cumulative residue
+    # masses from the N-terminus
+    b_masses = np.cumsum(masses[:, :cterm_col], axis=1)[:, 1:]
+
+    # The y-ion neutral masses: water, or the C-terminal modification, plus
+    # the cumulative residue masses from the C-terminus
+    rev_cols = lengths[:, np.newaxis] - frag_lens + 1
+    rev_masses = np.where(rev_cols >= 1,
+                          masses[rows, np.maximum(rev_cols, 0)], 0.)
+    cterm = masses[:, cterm_col]
+    y_base = np.where(cterm == 0., FIXED_MASSES["H2O"], cterm)
+    y_masses = np.cumsum(
+        np.column_stack([y_base, rev_masses]), axis=1)[:, 1:]
+
+    # Ions of shape (peptide, charge, ion type, fragment length)
+    ion_charges = np.arange(1, max_charge + 1)[:, np.newaxis, np.newaxis]
+    # The singly charged ions are protonated further to reach charge c, in
+    # the same order of operations as pepfrag
+    singly = np.stack([b_masses, y_masses],
+                      axis=1)[:, np.newaxis] + FIXED_MASSES["H"]
+    mzs = (singly + (ion_charges - 1) * FIXED_MASSES["H"]) / ion_charges
+    valid = np.broadcast_to(
+        (frag_lens >= 2 * ion_charges - 1) &
+        (frag_lens < lengths[:, np.newaxis, np.newaxis, np.newaxis]) &
+        (ion_charges <= charges[:, np.newaxis, np.newaxis, np.newaxis]),
+        mzs.shape)
+
+    mzs = mzs[valid]
+    counts = valid.reshape(num_peps, -1).sum(axis=1)
+    offsets = np.zeros(num_peps + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    # Sort the ions of each peptide by m/z
+    mzs = mzs[np.lexsort((mzs, np.repeat(np.arange(num_peps), counts)))]
+
+    return mzs, offsets
+
+
+def get_by_ion_mzs(peptide: Peptide) -> np.ndarray:
     """
-    Get the b/y-type fragment ions for the peptide.
+    Get the b/y-type fragment ions for the peptide, sorted by m/z.
 
     """
-    return [mass for mass, _, _ in peptide.fragment(
-        ion_types={
-            IonType.b.value: [],
-            IonType.y.value: [],
-        })]
+    return get_by_ion_mzs_batch([peptide])[0]
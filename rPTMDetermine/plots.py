@@ -20,6 +20,7 @@ import seaborn as sns
 
 from pepfrag import Peptide
 
+from .fragment_cache import get_fragment_ions
 from .mass_spectrum import Annotation
 from .peptide_spectrum_match import PSM
 
@@ -556,18 +557,15 @@ def plot_psm(
         if denoise:
             _, denoised_spec = psm.denoise_spectrum(tol=tol)
             spec = denoised_spec
-            if psm.peptide.fragment_ions is None:
-                raise RuntimeError("No fragment ions available for annotation")
-            anns = denoised_spec.annotate(psm.peptide.fragment_ions, tol=tol)
+            anns = denoised_spec.annotate_many(
+                [get_fragment_ions(psm.peptide)], tol=tol)[0]
         else:
             spec = psm.spectrum
             anns = psm.annotate_spectrum(tol=tol)
 
         max_int = max(spec[:, 1])
         if rel_intensity:
-            spec[:, 1] /= max_int
-
-        psm.peptide.clean_fragment_ions()
+            spec = spec.normalize()
 
         if mz_range is not None:
             spec = spec[(spec[:, 0] >= mz_range[0]) &
@@ -13,10 +13,13 @@ import sys
 from typing import (Callable, Dict, Generic, Iterable, List, Optional,
                     overload, Sequence, Set, Tuple, TypeVar)
 
+import numpy as np
 import pandas as pd
 
 from pepfrag import ModSite, Peptide
 
+from .features import (FEATURE_COLUMNS, INTEGER_FEATURES, Features,
+                       feature_matrix)
 from .peptide_spectrum_match import PSM, SimilarityScore
 from .readers import parse_mods
 
@@ -51,14 +54,6 @@ class PSMContainer(collections.UserList, Generic[PSMType]):  # pylint: disable=t
         res = self.data[idx]
         return PSMContainer(res) if isinstance(res, list) else res
 
-    def clean_fragment_ions(self):
-        """
-        Removes the cached fragment ions for the PSMs.
-
-        """
-        for psm in self.data:
-            psm.peptide.clean_fragment_ions()
-
     def get_by_seq(self, seq: str) -> PSMContainer[PSMType]:
         """
         Retrieves the PSMs with the given peptide sequence.
@@ -248,6 +243,37 @@ class PSMContainer(collections.UserList, Generic[PSMType]):  # pylint: disable=t
              round(psm.max_similarity, 2) >= sim_threshold and
              (psm.site_prob is None or psm.site_prob >= site_prob)])
 
+    def feature_matrix(self, features: Optional[Sequence[str]] = None,
+                       target_only: bool = False) -> np.ndarray:
+        """
+        Collects the psm features, including decoy, into a feature matrix,
+        with the decoy row, if any, following that of its target.
+
+        Args:
+            features (list, optional): The features to include as columns.
+                                       Defaults to all features.
+            target_only (bool, optional): Whether to exclude decoy features.
+
+        Returns:
+            numpy.ndarray with NaN for features which are not set.
+
+        """
+        num_rows = len(self.data)
+        if not target_only:
+            num_rows += sum(psm.decoy_id is not None for psm in self.data)
+        matrix = feature_matrix(num_rows)
+        row = 0
+        for psm in self.data:
+            psm.features.to_array(out=matrix[row])
+            row += 1
+            if not target_only and psm.decoy_id is not None:
+                psm.decoy_id.features.to_array(out=matrix[row])
+                row += 1
+
+        if features is None:
+            return matrix
+        return matrix[:, [FEATURE_COLUMNS[f] for f in features]]
+
     def to_df(self, target_only: bool = False) -> pd.DataFrame:
         """
         Converts the psm features, including decoy, into a pandas dataframe,
@@ -258,22 +284,32 @@ class PSMContainer(collections.UserList, Generic[PSMType]):  # pylint: disable=t
             pandas.DataFrame
 
         """
-        rows = []
+        data_ids, spec_ids, seqs, targets, uids = [], [], [], [], []
         for psm in self.data:
-            trow = {"data_id": psm.data_id, "spec_id": psm.spec_id,
-                    "seq": psm.seq, "target": True, "uid": psm.uid}
-            for feature, value in psm.features:
-                trow[feature] = value
-            rows.append(trow)
+            data_ids.append(psm.data_id)
+            spec_ids.append(psm.spec_id)
+            seqs.append(psm.seq)
+            targets.append(True)
+            uids.append(psm.uid)
             if not target_only and psm.decoy_id is not None:
-                drow = {"data_id": "", "spec_id": "",
-                        "seq": psm.decoy_id.seq, "target": False,
-                        "uid": psm.uid}
-                for feature, value in psm.decoy_id.features:
-                    drow[feature] = value
-                rows.append(drow)
-
-        return pd.DataFrame(rows)
+                data_ids.append("")
+                spec_ids.append("")
+                seqs.append(psm.decoy_id.seq)
+                targets.append(False)
+                uids.append(psm.uid)
+
+        # Features which are not set for any PSM are excluded
+        features = pd.DataFrame(self.feature_matrix(target_only=target_only),
+                                columns=Features.all_feature_names())
+        features = features.dropna(axis=1, how="all")
+        # Integer features set for every PSM are restored to integers
+        int_features = [f for f in features.columns
+                        if f in INTEGER_FEATURES and features[f].notna().all()]
+        features[int_features] = features[int_features].astype(np.int64)
+        return pd.concat(
+            [pd.DataFrame({"data_id": data_ids, "spec_id": spec_ids,
+                           "seq": seqs, "target": targets, "uid": uids}),
+             features], axis=1)
 
 
 def read_csv(csv_file: str, ptmdb, spectra=None, sep: str = "\t")\
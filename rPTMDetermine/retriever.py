@@ -10,7 +10,7 @@ import itertools
 import logging
 import os
 import pickle
-from typing import Dict, List, Optional, Sequence, Set, Tuple
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
 
 import numpy as np
 import pandas as pd
@@ -18,12 +18,13 @@ import tqdm
 
 from pepfrag import ModSite, Peptide
 
-from .constants import DEFAULT_FRAGMENT_IONS, RESIDUES
+from .constants import RESIDUES
+from .fragment_cache import FRAGMENT_CACHE
 from . import ionscore
 from . import lda
 from . import mass_spectrum
 from .peptide_spectrum_match import PSM
-from .peptides import merge_seq_mods
+from .peptides import get_by_ion_mzs_batch, merge_seq_mods
 from .psm_container import PSMContainer
 from . import readers
 from .retriever_config import RetrieverConfig
@@ -74,14 +75,11 @@ def calculate_lda_probs(
         features (list): The list of features to be used.
 
     """
-    # Convert PSMContainer to a pandas DataFrame
     batch_size = 10000
     for ii in tqdm.tqdm(range(0, len(psms), batch_size)):
         batch_psms = psms[ii:ii + batch_size]
 
-        psms_df = batch_psms.to_df()
-
-        lda_scores = lda_model.decide_predict(psms_df[features])[:, 0]
+        lda_scores = lda.calculate_scores(lda_model, batch_psms, features)
         for jj, psm in enumerate(batch_psms):
             psm.lda_score = lda_scores[jj]
             psm.lda_prob = lda.calculate_prob(1, psm.lda_score, score_stats)
@@ -113,13 +111,19 @@ class Retriever(validator_base.ValidateBase):
         results.
 
         """
-        logging.info("Reading mass spectra files.")
-        all_spectra = self.read_mass_spectra()
-
         logging.info("Extracting peptide candidates.")
-        peptides, ret_times = self._get_peptides(all_spectra)
+        peptides, peptide_spectra = self._get_peptides()
         logging.info(f"{len(peptides)} candidate peptides extracted.")
 
+        # Only the spectra of the search results, and those which could match
+        # a candidate modified peptide, are read
+        logging.info("Reading mass spectra files.")
+        all_spectra = self.read_mass_spectra(
+            spec_ids=self.db_res,
+            prec_mz_ranges=self._get_prec_mz_ranges(
+                peptides, self.config.retrieval_tolerance))
+        ret_times = self._get_retention_times(peptide_spectra, all_spectra)
+
         logging.info("Building LDA validation models.")
         model, score_stats, _, features = self.build_model()
         unmod_model, unmod_score_stats, _, unmod_features = \
@@ -156,12 +160,10 @@ class Retriever(validator_base.ValidateBase):
             sum(p.corrected for p in psms)))
 
         logging.info("Finding unmodified analogue PSMs.")
-        unmod_psms = self._find_unmod_analogues(psms)
+        unmod_psms = self._find_unmod_analogues(psms, all_spectra)
 
         logging.info("Calculating unmodified PSM features.")
-        for psm in tqdm.tqdm(unmod_psms):
-            psm.extract_features(None, self.proteolyzer)
-            psm.peptide.clean_fragment_ions()
+        self.calculate_features(unmod_psms, None)
 
         logging.info(
             "Calculating rPTMDetermine scores for unmodified analogues.")
@@ -172,6 +174,7 @@ class Retriever(validator_base.ValidateBase):
 
         logging.info("Calculating similarity scores.")
         psms = similarity.calculate_similarity_scores(psms, unmod_psms)
+        logging.info(f"Fragment ion cache: {FRAGMENT_CACHE}")
 
         if self.config.benchmark_file is not None:
             self.identify_benchmarks(psms)
@@ -225,57 +228,138 @@ class Retriever(validator_base.ValidateBase):
 
         return db_res
 
-    def _get_peptides(
-        self,
-        all_spectra: Dict[str, Dict[str, mass_spectrum.Spectrum]]) \
+    def _get_peptides(self) \
             -> Tuple[List[PeptideTuple],
-                     Dict[PeptideTuple, Dict[str, Dict[str, float]]]]:
+                     Dict[PeptideTuple, List[Tuple[str, str]]]]:
         """
         Retrieves the candidate peptides from the database search results.
 
-        """
-        allpeps: List[Tuple[str, str, str, Tuple[ModSite, ...], int,
-                            readers.PeptideType, Optional[float]]] = \
-            [(set_id, spec_id, m.seq, tuple(m.mods), m.charge,
-              m.pep_type, all_spectra[set_id][spec_id].retention_time)
-             for set_id, spectra in self.db_res.items()
-             for spec_id, matches in spectra.items()
-             for m in matches]
+        Returns:
+            Tuple of (the deduplicated candidate peptides, a dictionary
+            mapping each peptide to the (data set ID, spectrum ID) of its
+            identifications).
 
+        """
         residue_set = set(RESIDUES)
 
         # Deduplicate peptides based on sequence, charge, modifications and
-        # type, whilst also retaining the retention time for later use
-        peps = []
-        seen: Set[PeptideTuple] = set()
-        seen_add = seen.add
-        retention_times: Dict[PeptideTuple,
-                              Dict[str, Dict[str, List[float]]]] = \
-            collections.defaultdict(lambda: collections.defaultdict(lambda: collections.defaultdict(list)))
-        for (set_id, spec_id, seq, mods, charge, pep_type, rt) in allpeps:
-            if len(seq) >= 7 and residue_set.issuperset(seq) and \
-                    any(r in seq for r in self.config.target_residues):
-                filt_mods = tuple(self._filter_mods(mods, seq))
-                key = (seq, filt_mods, charge, pep_type)
-                if key not in seen:
-                    seen_add(key)
-                    peps.append((seq, filt_mods, charge, pep_type))
-                if rt is not None:
-                    experiment = spec_id.split(".")[0]
-                    retention_times[key][set_id][experiment].append(rt)
+        # type, whilst also retaining the identifying spectra for later use
+        peps: List[PeptideTuple] = []
+        peptide_spectra: Dict[PeptideTuple, List[Tuple[str, str]]] = \
+            collections.defaultdict(list)
+        for set_id, spectra in self.db_res.items():
+            for spec_id, matches in spectra.items():
+                for m in matches:
+                    seq = m.seq
+                    if len(seq) >= 7 and residue_set.issuperset(seq) and \
+                            any(r in seq
+                                for r in self.config.target_residues):
+                        filt_mods = tuple(self._filter_mods(m.mods, seq))
+                        key = (seq, filt_mods, m.charge, m.pep_type)
+                        if key not in peptide_spectra:
+                            peps.append(key)
+                        peptide_spectra[key].append((set_id, spec_id))
+
+        return peps, peptide_spectra
+
+    def _get_retention_times(
+            self,
+            peptide_spectra: Dict[PeptideTuple, List[Tuple[str, str]]],
+            all_spectra: Dict[str, Mapping[str, mass_spectrum.Spectrum]]) \
+            -> Dict[PeptideTuple, Dict[str, Dict[str, float]]]:
+        """
+        Finds the minimum retention time of each candidate peptide, within
+        the same data set and experiment.
+
+        Args:
+            peptide_spectra (dict): A dictionary mapping each peptide to the
+                                    (data set ID, spectrum ID) of its
+                                    identifications.
+            all_spectra (dict): The mass spectra, keyed by data set ID and
+                                then spectrum ID.
 
-        # Find the minimum retention time for each peptide, within the same
-        # data set and experiment
+        Returns:
+            Nested dictionary of peptide, data set ID and experiment ID to
+            the minimum retention time.
+
+        """
         min_rts: Dict[PeptideTuple, Dict[str, Dict[str, float]]] = \
             collections.defaultdict(lambda: collections.defaultdict(dict))
-        for peptide, datasets in retention_times.items():
-            for set_id, experiments in datasets.items():
+        for peptide, spec_keys in peptide_spectra.items():
+            retention_times: Dict[str, Dict[str, List[float]]] = \
+                collections.defaultdict(lambda: collections.defaultdict(list))
+            for set_id, spec_id in spec_keys:
+                try:
+                    rt = all_spectra[set_id][spec_id].retention_time
+                except KeyError:
+                    # The spectrum was excluded, e.g. by the activation
+                    # filters, when reading the spectra
+                    continue
+                if rt is not None:
+                    experiment = spec_id.split(".")[0]
+                    retention_times[set_id][experiment].append(rt)
+
+            for set_id, experiments in retention_times.items():
                 for exp_id, rts in experiments.items():
-                    rts = [r for r in rts if r is not None]
-                    if rts:
-                        min_rts[peptide][set_id][exp_id] = min(rts)
+                    min_rts[peptide][set_id][exp_id] = min(rts)
+
+        return min_rts
 
-        return peps, min_rts
+    def _get_free_target_sites(
+            self, seq: str,
+            mods: Optional[Sequence[ModSite]]) -> List[int]:
+        """
+        Finds the (zero-based) indices of the target residues in the
+        peptide which are not already modified.
+
+        """
+        if mods is None:
+            return [i for i, sk in enumerate(seq)
+                    if sk in self.config.target_residues]
+        return [i for i, sk in enumerate(seq)
+                if sk in self.config.target_residues
+                and not any(jk == i + 1 for _, jk, _ in mods
+                            if isinstance(jk, int))]
+
+    @staticmethod
+    def _get_candidate_mz(pmass: float, charge: int, mod_mass: float,
+                          num_mods: int) -> float:
+        """
+        Calculates the precursor m/z of the peptide with the given number of
+        target modifications, of mass mod_mass, added.
+
+        """
+        return (pmass + mod_mass * num_mods) / charge + 1.0073
+
+    def _get_prec_mz_ranges(self, peptides: List[PeptideTuple],
+                            tol: float) -> List[Tuple[float, float]]:
+        """
+        Calculates the precursor m/z ranges of the spectra which could be
+        matched to the modified candidate peptides by _get_matches.
+
+        Args:
+            peptides (list): The peptide candidates.
+            tol (float): The mass/charge ratio tolerance.
+
+        Returns:
+            List of (lower, upper) precursor m/z ranges.
+
+        """
+        if self.mod_mass is None:
+            logging.error("mod_mass has not been set - exiting.")
+            raise RuntimeError("mod_mass is not set - exiting.")
+
+        ranges: List[Tuple[float, float]] = []
+        for seq, mods, charge, _ in peptides:
+            num_sites = len(self._get_free_target_sites(seq, mods))
+            if not num_sites:
+                continue
+            pmass = Peptide(seq, charge, mods).mass
+            for nk in range(min(3, num_sites)):
+                cmz = self._get_candidate_mz(pmass, charge, self.mod_mass,
+                                             nk + 1)
+                ranges.append((cmz - tol, cmz + tol))
+        return ranges
 
     def _get_matches(
             self,
@@ -310,36 +394,29 @@ class Retriever(validator_base.ValidateBase):
             (seq, mods, charge, pep_type) = unmod_peptide
             pmass = Peptide(seq, charge, mods).mass
             # Check for free (non-modified target residue)
-            if mods is None:
-                mix = [i for i, sk in enumerate(seq)
-                       if sk in self.config.target_residues]
-            else:
-                mix = [i for i, sk in enumerate(seq)
-                       if sk in self.config.target_residues
-                       and not any(jk == i + 1 for _, jk, _ in mods
-                                   if isinstance(jk, int))]
+            mix = self._get_free_target_sites(seq, mods)
             if not mix:
                 continue
             modj = [] if mods is None else list(mods)
             for nk in range(min(3, len(mix))):
-                cmz = (pmass + self.mod_mass * (nk + 1)) / charge + 1.0073
+                cmz = self._get_candidate_mz(pmass, charge, self.mod_mass,
+                                             nk + 1)
                 bix, = np.where((prec_mzs >= cmz - tol) &
                                 (prec_mzs <= cmz + tol))
                 if bix.size == 0:
                     continue
 
-                for lx in itertools.combinations(mix, nk + 1):
-                    modk: List[ModSite] = modj + \
-                        [ModSite(self.mod_mass, j + 1, self.config.target_mod)
-                         for j in lx]
-                    mod_peptide = Peptide(seq, charge, modk)
-                    by_ions = [
-                        i for i in
-                        mod_peptide.fragment(ion_types=DEFAULT_FRAGMENT_IONS)
-                        if (i[1][0] == "y" or i[1][0] == "b")
-                        and "-" not in i[1]
-                    ]
-                    by_mzs = np.array([i[0] for i in by_ions])
+                mod_peptides = [
+                    Peptide(seq, charge, modj + [
+                        ModSite(self.mod_mass, j + 1, self.config.target_mod)
+                        for j in lx])
+                    for lx in itertools.combinations(mix, nk + 1)]
+                # Generate the b/y ions for all of the modified candidates
+                all_by_mzs, by_offsets = get_by_ion_mzs_batch(mod_peptides)
+
+                for jj, mod_peptide in enumerate(mod_peptides):
+                    modk: List[ModSite] = mod_peptide.mods
+                    by_mzs = all_by_mzs[by_offsets[jj]:by_offsets[jj + 1]]
                     by_mzs_u = by_mzs + 0.2
                     by_mzs_l = by_mzs - 0.2
                     for kk in bix:
@@ -380,7 +457,6 @@ class Retriever(validator_base.ValidateBase):
 
                         psm.extract_features(self.config.target_mod,
                                              self.proteolyzer)
-                        psm.peptide.clean_fragment_ions()
 
                         cands.append(psm)
         return cands
@@ -41,7 +41,6 @@ def calculate_similarity_scores(mod_psms: PSMContainer[PSM],
         for psm_uid in upsm.get_mod_ids():
             j = index[(psm_uid,)][0]
             mod_index[j].append(i)
-        upsm.peptide.clean_fragment_ions()
 
     # calculate similarities
     for i in tqdm.tqdm(mod_index.keys()):
@@ -56,8 +55,6 @@ def calculate_similarity_scores(mod_psms: PSMContainer[PSM],
             scores.append(SimilarityScore(data_id, spec_id, s))
         psm.similarity_scores = scores
 
-    mod_psms.clean_fragment_ions()
-
     return mod_psms
 
 
@@ -0,0 +1,207 @@
+#! /usr/bin/env python3
+"""
+A module providing a persistent byte-offset index of the spectra contained
+in a tandem mass spectrum file, allowing individual spectra to be decoded on
+demand rather than parsing the whole file.
+
+"""
+import logging
+import os
+import pickle
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+# Incremented whenever the layout of the persisted index changes, so that
+# stale index files are rebuilt rather than misread
+INDEX_VERSION = 2
+
+
+def index_path(spec_file: str) -> str:
+    """
+    Constructs the path at which the index for the spectrum file is
+    persisted, i.e. alongside the file itself.
+
+    Args:
+        spec_file (str): The path to the spectrum file.
+
+    Returns:
+        The path to the index file.
+
+    """
+    return f"{spec_file}.idx"
+
+
+def file_fingerprint(path: str) -> Tuple[int, int]:
+    """
+    Computes a cheap fingerprint of the file, used to detect whether the file
+    has changed since it was last processed.
+
+    Args:
+        path (str): The path to the file.
+
+    Returns:
+        Tuple of (file size in bytes, modification time in nanoseconds).
+
+    """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class SpectrumIndex:
+    """
+    A class to represent the byte offsets of the spectra in a file, keyed by
+    spectrum ID, along with the precursor mass/charge ratio of each spectrum
+    where this is known at indexing time (NaN otherwise). The same index
+    describes the peak offsets of the spectra in a SpectrumStore.
+
+    """
+
+    __slots__ = ("ids", "starts", "ends", "prec_mzs", "_positions",
+                 "_mz_order",)
+
+    def __init__(self, ids: List[str], starts: np.ndarray,
+                 ends: np.ndarray, prec_mzs: np.ndarray):
+        """
+        Initializes the class.
+
+        Args:
+            ids (list): The spectrum IDs.
+            starts (numpy.ndarray): The byte offset at which each spectrum
+                                    begins.
+            ends (numpy.ndarray): The byte offset at which each spectrum
+                                  ends.
+            prec_mzs (numpy.ndarray): The precursor mass/charge ratio of each
+                                      spectrum.
+
+        """
+        self.ids = ids
+        self.starts: np.ndarray = np.asarray(starts, dtype=np.int64)
+        self.ends: np.ndarray = np.asarray(ends, dtype=np.int64)
+        self.prec_mzs: np.ndarray = np.asarray(prec_mzs, dtype=np.float64)
+        self._positions = {spec_id: ii for ii, spec_id in enumerate(ids)}
+        # The positions sorted by precursor m/z, with unknown m/z last
+        self._mz_order: np.ndarray = np.argsort(self.prec_mzs, kind="stable")
+
+    def __len__(self) -> int:
+        """
+        Returns the number of indexed spectra.
+
+        """
+        return len(self.ids)
+
+    def __contains__(self, spec_id: object) -> bool:
+        """
+        Tests whether the spectrum ID is indexed.
+
+        """
+        return spec_id in self._positions
+
+    def offsets(self, spec_id: str) -> Tuple[int, int]:
+        """
+        Retrieves the byte range of the spectrum with the given ID.
+
+        Args:
+            spec_id (str): The spectrum ID.
+
+        Returns:
+            Tuple of (start offset, end offset).
+
+        Raises:
+            KeyError
+
+        """
+        pos = self._positions[spec_id]
+        return int(self.starts[pos]), int(self.ends[pos])
+
+    def select_ids(self, spec_ids: Iterable[str]) -> np.ndarray:
+        """
+        Finds the positions of the given spectrum IDs in the index, ignoring
+        those IDs which are not indexed.
+
+        Args:
+            spec_ids (iterable): The spectrum IDs to select.
+
+        Returns:
+            Index positions, ordered by file offset so that the spectra can be
+            read sequentially.
+
+        """
+        positions = np.array(
+            [self._positions[s] for s in spec_ids if s in self._positions],
+            dtype=np.int64)
+        return positions[np.argsort(self.starts[positions], kind="stable")]
+
+    def select_prec_mz(self, lower: float, upper: float) -> np.ndarray:
+        """
+        Finds the positions of the spectra whose precursor mass/charge ratio
+        falls within the given (inclusive) range.
+
+        Args:
+            lower (float): The lower bound of the range.
+            upper (float): The upper bound of the range.
+
+        Returns:
+            Index positions, ordered by file offset.
+
+        """
+        sorted_mzs = self.prec_mzs[self._mz_order]
+        start = sorted_mzs.searchsorted(lower, side="left")
+        end = sorted_mzs.searchsorted(upper, side="right")
+        positions = self._mz_order[start:end]
+        return positions[np.argsort(self.starts[positions], kind="stable")]
+
+    def save(self, spec_file: str):
+        """
+        Persists the index alongside the spectrum file, recording the file
+        fingerprint so that the index can be invalidated if the file changes.
+        Failure to write the index, e.g. due to a read-only data directory,
+        is logged but otherwise ignored.
+
+        Args:
+            spec_file (str): The path to the indexed spectrum file.
+
+        """
+        path = index_path(spec_file)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "wb") as fh:
+                pickle.dump({
+                    "version": INDEX_VERSION,
+                    "fingerprint": file_fingerprint(spec_file),
+                    "ids": self.ids,
+                    "starts": self.starts,
+                    "ends": self.ends,
+                    "prec_mzs": self.prec_mzs,
+                }, fh)
+            os.replace(tmp_path, path)
+        except OSError as ex:
+            logging.warning(f"Unable to write spectrum index {path}: {ex}")
+
+    @classmethod
+    def load(cls, spec_file: str) -> Optional["SpectrumIndex"]:
+        """
+        Loads the persisted index for the spectrum file.
+
+        Args:
+            spec_file (str): The path to the indexed spectrum file.
+
+        Returns:
+            The SpectrumIndex, or None if no index exists or the existing
+            index is out of date.
+
+        """
+        path = index_path(spec_file)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as fh:
+                data = pickle.load(fh)
+        except (EOFError, pickle.UnpicklingError):
+            return None
+        if (data.get("version") != INDEX_VERSION or
+                data.get("fingerprint") != file_fingerprint(spec_file)):
+            return None
+        return cls(data["ids"], data["starts"], data["ends"],
+                   data["prec_mzs"])
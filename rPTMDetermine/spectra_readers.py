@@ -4,13 +4,16 @@ A series of functions used to read different spectra file types.
 
 """
 import base64
+import bisect
 import collections
 import enum
 import functools
-import itertools
+import logging
+import mmap
+import os
 import re
-import struct
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import warnings
 import zlib
 
 import numpy as np
@@ -18,6 +21,7 @@ import numpy as np
 import lxml.etree as etree
 
 from .mass_spectrum import Spectrum
+from .spectra_index import SpectrumIndex
 
 
 MZMLPrecursor = collections.namedtuple(
@@ -25,6 +29,107 @@ MZMLPrecursor = collections.namedtuple(
     ("prec_id", "selected_ions", "charges", "activation_params"))
 
 
+def passes_activation_filters(act_params: Dict[str, Any],
+                              act_method: Optional[str],
+                              act_energy: Optional[float]) -> bool:
+    """
+    Determines whether the activation parameters of a precursor satisfy the
+    activation method and energy filters.
+
+    Args:
+        act_params (dict): The precursor activation parameters, containing
+                           the activation method name(s) as keys and the
+                           "collision energy", where available.
+        act_method (str): The activation method by which to filter spectra.
+                          If None, the method is not filtered.
+        act_energy (float): The collision energy by which to filter spectra.
+                            If None, the energy is not filtered.
+
+    Returns:
+        Boolean indicating whether the filters are satisfied.
+
+    """
+    if act_method is not None and act_method not in act_params:
+        return False
+    if (act_energy is not None and
+            act_params.get("collision energy", None) != act_energy):
+        return False
+    return True
+
+
+def merge_ranges(ranges: Iterable[Tuple[float, float]]) \
+        -> List[Tuple[float, float]]:
+    """
+    Merges overlapping (inclusive) ranges.
+
+    Args:
+        ranges (iterable): The (lower, upper) ranges.
+
+    Returns:
+        The merged (lower, upper) ranges, sorted by their lower bounds.
+
+    """
+    merged: List[List[float]] = []
+    for lower, upper in sorted(ranges):
+        if merged and lower <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], upper)
+        else:
+            merged.append([lower, upper])
+    return [(lower, upper) for lower, upper in merged]
+
+
+class SpectrumFilter:
+    """
+    A class to select spectra by spectrum ID and/or precursor mass/charge
+    ratio, such that spectra which cannot be used are skipped during parsing.
+    A spectrum is selected if its ID is in the ID set or its precursor m/z
+    falls within any of the (inclusive) m/z ranges.
+
+    """
+
+    __slots__ = ("spec_ids", "_lowers", "_uppers",)
+
+    def __init__(self, spec_ids: Optional[Iterable[str]] = None,
+                 prec_mz_ranges: Optional[
+                     Iterable[Tuple[float, float]]] = None):
+        """
+        Initializes the class.
+
+        Args:
+            spec_ids (iterable, optional): The IDs of the spectra to select.
+            prec_mz_ranges (iterable, optional): The (lower, upper) precursor
+                                                 m/z ranges of the spectra to
+                                                 select.
+
+        """
+        self.spec_ids = frozenset(spec_ids if spec_ids is not None else [])
+
+        # Merge overlapping ranges so that the single range preceding an m/z
+        # can be located by bisection
+        merged = merge_ranges(prec_mz_ranges or [])
+        self._lowers = [lower for lower, _ in merged]
+        self._uppers = [upper for _, upper in merged]
+
+    def matches(self, spec_id: str, prec_mz: Optional[float]) -> bool:
+        """
+        Determines whether the spectrum is selected by the filter.
+
+        Args:
+            spec_id (str): The spectrum ID.
+            prec_mz (float): The precursor mass/charge ratio, if known.
+
+        Returns:
+            Boolean indicating whether the spectrum is selected.
+
+        """
+        if spec_id in self.spec_ids:
+            return True
+        if prec_mz is None:
+            return False
+        idx = bisect.bisect_right(self._lowers, prec_mz) - 1
+        return idx >= 0 and prec_mz <= self._uppers[idx]
+
+
 class ParserException(Exception):
     """
     A custom exception to be raised during file parse errors.
@@ -39,6 +144,8 @@ class MGFReader:
 
     native_regex = re.compile(r".*NativeID:\"(.*)\"")
 
+    read_chunk_size = 1 << 24
+
     def __init__(self):
         """
         """
@@ -110,94 +217,348 @@ class MGFReader:
 
         raise ParserException("Failed to detect ID in TITLE field")
 
-    def read(self, spec_file: str) -> Dict[str, Spectrum]:
+    def _parse_block(self, block: str,
+                     spec_filter: Optional[SpectrumFilter] = None) \
+            -> Optional[Tuple[str, Spectrum]]:
+        """
+        Parses the text of a BEGIN IONS - END IONS block, excluding the
+        BEGIN IONS and END IONS lines themselves.
+
+        Args:
+            block (str): The text of the MGF block.
+            spec_filter (SpectrumFilter, optional): The filter to apply to
+                                                    the block header before
+                                                    parsing the peaks.
+
+        Returns:
+            Tuple of (spectrum ID, Spectrum), or None if the block contains
+            no peaks or is rejected by the filter.
+
+        """
+        fields = {}
+        pos = 0
+        while True:
+            line_end = block.find("\n", pos)
+            line = block[pos:] if line_end == -1 else block[pos:line_end]
+            if line.strip():
+                if "=" not in line:
+                    break
+                split_line = line.strip().split("=", maxsplit=1)
+                fields[split_line[0]] = split_line[1]
+            if line_end == -1:
+                # No lines containing mz/intensity information found
+                return None
+            pos = line_end + 1
+
+        spec_id = self._get_id(fields["TITLE"])
+
+        pep_mass_floats = fields["PEPMASS"].split(" ")
+        pep_mass = float(pep_mass_floats[0])
+
+        if spec_filter is not None and not spec_filter.matches(spec_id,
+                                                               pep_mass):
+            return None
+
+        return spec_id, Spectrum(
+            self._parse_peaks(block[pos:]),
+            pep_mass,
+            int(fields["CHARGE"].split("+")[0]) if "CHARGE" in fields
+            else None,
+            retention_time=float(fields["RTINSECONDS"])
+            if "RTINSECONDS" in fields else None)
+
+    @staticmethod
+    def _parse_peaks(text: str) -> np.ndarray:
+        """
+        Parses the peak region of an MGF block, retaining the m/z and
+        intensity columns. The whole region is converted to floats in a
+        single call, falling back to parsing line by line if the lines do
+        not share the same number of numeric columns, e.g. where a peak
+        charge annotation is included, or the region contains blank lines.
+
+        Args:
+            text (str): The peak lines of the MGF block.
+
+        Returns:
+            The peaks as an (N, 2) numpy array.
+
+        """
+        num_lines = text.count("\n") + (not text.endswith("\n"))
+        num_cols = len(text[:text.find("\n")].split())
+        if num_cols >= 2:
+            try:
+                with warnings.catch_warnings():
+                    # numpy warns, rather than raising, on unparseable text
+                    warnings.simplefilter("error", DeprecationWarning)
+                    values = np.fromstring(text, sep=" ")
+            except (ValueError, DeprecationWarning):
+                pass
+            else:
+                if values.size == num_cols * num_lines:
+                    return values.reshape(-1, num_cols)[:, :2]
+
+        return np.array([float(n) for s in text.splitlines() if s.strip()
+                         for n in s.split(" ")[:2]]).reshape(-1, 2)
+
+    def _iter_blocks(self, fh) -> Iterator[str]:
+        """
+        Iterates over the BEGIN IONS - END IONS blocks of the MGF file,
+        reading the file in large chunks rather than line by line.
+
+        Args:
+            fh (file): The open MGF file.
+
+        Returns:
+            Iterator of the text of each block, excluding the BEGIN IONS and
+            END IONS lines.
+
+        """
+        # The leading newline allows a BEGIN IONS on the first line to be
+        # found in the same way as all others
+        buffer = "\n"
+        while True:
+            chunk = fh.read(self.read_chunk_size)
+            buffer += chunk
+            pos = 0
+            while True:
+                end = buffer.find("\nEND IONS", pos)
+                if end == -1:
+                    break
+                # Taking the last BEGIN IONS discards unterminated blocks
+                begin = buffer.rfind("\nBEGIN IONS", pos, end)
+                if begin != -1:
+                    yield buffer[buffer.find("\n", begin + 1) + 1:end + 1]
+                pos = end + 1
+            if not chunk:
+                break
+            buffer = buffer[pos:]
+
+    def read(self, spec_file: str,
+             spec_ids: Optional[Iterable[str]] = None,
+             spec_filter: Optional[SpectrumFilter] = None) \
+            -> Dict[str, Spectrum]:
         """
         Reads the given MGF data file to extract spectra.
 
         Args:
             spec_file (str): The path to the MGF file to read.
+            spec_ids (iterable, optional): The IDs of the spectra to read. If
+                                           provided, only these spectra are
+                                           decoded, using the byte-offset
+                                           index of the file.
+            spec_filter (SpectrumFilter, optional): The filter to apply to
+                                                    the spectra before their
+                                                    peaks are parsed.
 
         Returns:
             A dictionary of spectrum ID to numpy array of peaks.
 
         """
+        if spec_ids is not None:
+            return self._read_indexed(spec_file, spec_ids, spec_filter)
+
         spectra: Dict[str, Spectrum] = {}
         with open(spec_file) as fh:
-            for key, group in itertools.groupby(fh, lambda ln: ln == "END IONS\n"):
-                if next(group) == "END IONS\n":
-                    continue
-
-                items = list(group)
-
-                fields = {}
-                peak_start_idx = 0
-                for ii, line in enumerate(items):
-                    if "=" not in line:
-                        peak_start_idx = ii
-                        break
-                    split_line = line.strip().split("=", maxsplit=1)
-                    fields[split_line[0]] = split_line[1]
-                else:
-                    # No lines containing mz/intensity information found
-                    continue
-
-                spec_id = self._get_id(fields["TITLE"])
-
-                pep_mass_floats = fields["PEPMASS"].split(" ")
-                pep_mass = float(pep_mass_floats[0])
-
-                spectra[spec_id] = Spectrum(
-                    np.array([float(n) for s in items[peak_start_idx:]
-                              for n in s.split(" ")[:2]]).reshape(-1, 2),
-                    pep_mass,
-                    int(fields["CHARGE"].split("+")[0]) if "CHARGE" in fields
-                    else None,
-                    retention_time=float(fields["RTINSECONDS"])
-                    if "RTINSECONDS" in fields else None)
+            for block in self._iter_blocks(fh):
+                parsed = self._parse_block(block, spec_filter)
+                if parsed is not None:
+                    spectra[parsed[0]] = parsed[1]
+
+        return spectra
+
+    def _read_indexed(self, spec_file: str, spec_ids: Iterable[str],
+                      spec_filter: Optional[SpectrumFilter] = None) \
+            -> Dict[str, Spectrum]:
+        """
+        Reads only the spectra with the given IDs from the MGF file, seeking
+        directly to each block using the file's byte-offset index.
+
+        Args:
+            spec_file (str): The path to the MGF file to read.
+            spec_ids (iterable): The IDs of the spectra to read.
+            spec_filter (SpectrumFilter, optional): The filter to apply to
+                                                    the spectra before their
+                                                    peaks are parsed.
+
+        Returns:
+            A dictionary of spectrum ID to Spectrum.
+
+        """
+        index = self.get_index(spec_file)
+        spectra: Dict[str, Spectrum] = {}
+        with open(spec_file, "rb") as fh:
+            for pos in index.select_ids(spec_ids):
+                fh.seek(index.starts[pos])
+                block = fh.read(index.ends[pos] - index.starts[pos])
+                # Drop the BEGIN IONS and END IONS lines
+                block_text = block.decode()
+                parsed = self._parse_block(
+                    block_text[block_text.find("\n") + 1:
+                               block_text.rfind("END IONS")],
+                    spec_filter)
+                if parsed is not None:
+                    spectra[parsed[0]] = parsed[1]
 
         return spectra
 
+    def get_index(self, spec_file: str) -> SpectrumIndex:
+        """
+        Retrieves the byte-offset index of the MGF file, loading it from
+        alongside the file if it exists and is up to date, or otherwise
+        building and persisting it.
+
+        Args:
+            spec_file (str): The path to the MGF file.
 
-def read_mgf_file(spec_file: str) -> Dict[str, Spectrum]:
+        Returns:
+            SpectrumIndex.
+
+        """
+        index = SpectrumIndex.load(spec_file)
+        if index is None:
+            logging.info(f"Indexing spectra in {spec_file}")
+            index = self.build_index(spec_file)
+            index.save(spec_file)
+        return index
+
+    def build_index(self, spec_file: str) -> SpectrumIndex:
+        """
+        Scans the MGF file to record the byte range, spectrum ID and
+        precursor mass/charge ratio of each BEGIN IONS - END IONS block.
+
+        Args:
+            spec_file (str): The path to the MGF file.
+
+        Returns:
+            SpectrumIndex.
+
+        """
+        ids: List[str] = []
+        starts: List[int] = []
+        ends: List[int] = []
+        prec_mzs: List[float] = []
+        with open(spec_file, "rb") as fh:
+            offset = 0
+            start: Optional[int] = None
+            title: Optional[str] = None
+            prec_mz = np.nan
+            for line in fh:
+                if line.startswith(b"BEGIN IONS"):
+                    start, title, prec_mz = offset, None, np.nan
+                elif start is not None:
+                    if line.startswith(b"TITLE="):
+                        title = line[6:].strip().decode()
+                    elif line.startswith(b"PEPMASS="):
+                        prec_mz = float(line[8:].split()[0])
+                    elif line.startswith(b"END IONS"):
+                        if title is not None:
+                            ids.append(self._get_id(title))
+                            starts.append(start)
+                            ends.append(offset + len(line))
+                            prec_mzs.append(prec_mz)
+                        start = None
+                offset += len(line)
+
+        return SpectrumIndex(ids, np.array(starts), np.array(ends),
+                             np.array(prec_mzs))
+
+
+def read_mgf_file(spec_file: str,
+                  spec_ids: Optional[Iterable[str]] = None,
+                  spec_filter: Optional[SpectrumFilter] = None) \
+        -> Dict[str, Spectrum]:
     """
     Reads the given MGF data file to extract individual spectra.
 
     Args:
         spec_file (str): The path to the MGF file to read.
+        spec_ids (iterable, optional): The IDs of the spectra to read. If
+                                       None, all spectra are read.
+        spec_filter (SpectrumFilter, optional): The filter by which to select
+                                                spectra during parsing.
 
     Returns:
         A dictionary of spectrum ID to numpy array of peaks.
 
     """
-    return MGFReader().read(spec_file)
+    return MGFReader().read(spec_file, spec_ids=spec_ids,
+                            spec_filter=spec_filter)
 
 
-def read_mzxml_file(spec_file: str):
+def read_mzxml_file(spec_file: str,
+                    spec_ids: Optional[Iterable[str]] = None,
+                    activation_method: Optional[str] = None,
+                    activation_energy: Optional[float] = None,
+                    spec_filter: Optional[SpectrumFilter] = None) \
+        -> Dict[str, Spectrum]:
     """
-    Reads the given mzXML file to extract spectra.
+    Reads the given mzXML file to extract the MS2 spectra.
 
-    """
-    # TODO
-    raise NotImplementedError()
+    Args:
+        spec_file (str): The path to the mzXML file to read.
+        spec_ids (iterable, optional): The IDs ("0.1.<scan number>") of the
+                                       spectra to read. If None, all spectra
+                                       are read.
+        activation_method (str, optional): The activation method by which to
+                                           filter spectra.
+        activation_energy (float, optional): The collision energy by which to
+                                             filter spectra.
+        spec_filter (SpectrumFilter, optional): The filter by which to select
+                                                spectra during parsing.
 
+    Returns:
+        A dictionary of spectrum ID to Spectrum.
 
-def read_spectra_file(spec_file: str, **kwargs) -> Dict[str, Spectrum]:
+    """
+    return MZXMLReader().extract_ms2(spec_file,
+                                     act_method=activation_method,
+                                     act_energy=activation_energy,
+                                     spec_ids=spec_ids,
+                                     spec_filter=spec_filter)
+
+
+def read_spectra_file(spec_file: str,
+                      spec_ids: Optional[Iterable[str]] = None,
+                      activation_method: Optional[str] = None,
+                      activation_energy: Optional[float] = None,
+                      spec_filter: Optional[SpectrumFilter] = None) \
+        -> Dict[str, Spectrum]:
     """
     Determines the format of the given tandem mass spectrum file and delegates
     to the appropriate reader.
 
     Args:
         spec_file (str): The path to the spectrum file to read.
+        spec_ids (iterable, optional): The IDs of the spectra to read. If
+                                       None, all spectra are read.
+        activation_method (str, optional): The activation method by which to
+                                           filter spectra, where supported by
+                                           the file format.
+        activation_energy (float, optional): The collision energy by which to
+                                             filter spectra, where supported
+                                             by the file format.
+        spec_filter (SpectrumFilter, optional): The filter by which to select
+                                                spectra during parsing, i.e.
+                                                before their peaks are
+                                                decoded.
 
     Returns:
 
     """
     if spec_file.endswith('.mgf'):
-        return read_mgf_file(spec_file)
+        return read_mgf_file(spec_file, spec_ids=spec_ids,
+                             spec_filter=spec_filter)
     if spec_file.lower().endswith('.mzml'):
-        return MZMLReader().extract_ms2(spec_file, **kwargs)
+        return MZMLReader().extract_ms2(spec_file,
+                                        act_method=activation_method,
+                                        act_energy=activation_energy,
+                                        spec_ids=spec_ids,
+                                        spec_filter=spec_filter)
     if spec_file.lower().endswith('.mzxml'):
-        return read_mzxml_file(spec_file)
+        return read_mzxml_file(spec_file, spec_ids=spec_ids,
+                               activation_method=activation_method,
+                               activation_energy=activation_energy,
+                               spec_filter=spec_filter)
     raise NotImplementedError(
         f"Unsupported spectrum file type for {spec_file}")
 
@@ -211,6 +572,18 @@ class MZMLReader:
     A reader class for mzML files.
 
     """
+    index_list_offset_regex = re.compile(
+        rb"<indexListOffset>\s*(\d+)\s*</indexListOffset>")
+
+    index_regex = re.compile(
+        rb"<index\s+name=\"(\w+)\"\s*>(.*?)</index>", re.DOTALL)
+
+    offset_regex = re.compile(
+        rb"<offset\s+idRef=\"([^\"]*)\"[^>]*>\s*(\d+)\s*</offset>")
+
+    spectrum_start_regex = re.compile(
+        rb"<spectrum\s[^>]*?\bid=\"([^\"]*)\"")
+
     def __init__(self, namespace: str = "http://psi.hupo.org/ms/mzml"):
         """
         Initializes the MZMLReader.
@@ -252,7 +625,9 @@ class MZMLReader:
 
     def extract_msn(self, mzml_file: str, n: int,
                     act_method: Optional[str] = None,
-                    act_energy: Optional[int] = None) \
+                    act_energy: Optional[float] = None,
+                    spec_ids: Optional[Iterable[str]] = None,
+                    spec_filter: Optional[SpectrumFilter] = None) \
             -> Dict[str, Spectrum]:
         """
         Extracts the MSn spectra from the input mzML file.
@@ -260,11 +635,28 @@ class MZMLReader:
         Args:
             mzml_file (str): The path to the mzML file.
             n (int): The MS level for which to return spectral information.
+            act_method (str, optional): The activation method by which to
+                                        filter spectra.
+            act_energy (float, optional): The collision energy by which to
+                                          filter spectra.
+            spec_ids (iterable, optional): The IDs of the spectra to read. If
+                                           provided, only these spectra are
+                                           parsed and decoded, using the
+                                           spectrum offset index.
+            spec_filter (SpectrumFilter, optional): The filter to apply to
+                                                    the spectra before their
+                                                    binary data arrays are
+                                                    decoded.
 
         Returns:
             A list of the MSn spectra encoded in dictionaries.
 
         """
+        if spec_ids is not None:
+            return self._extract_msn_indexed(mzml_file, n, spec_ids,
+                                             act_method, act_energy,
+                                             spec_filter)
+
         spectra = {}
 
         # Read from xml data
@@ -275,87 +667,286 @@ class MZMLReader:
         param_groups: Dict[str, Dict[str, Any]] = {}
         for event, element in context:
             if element.tag == self._fix_tag("referenceableParamGroup"):
-                params: Dict[str, Any] = {}
-                for param in element.findall(self._fix_tag("cvParam")):
-                    params[param.get("name")] = param.get("value", None)
-                param_groups[element.get("id")] = params
+                param_groups[element.get("id")] = \
+                    self._parse_param_group(element)
                 continue
 
-            # This contains the cycle and experiment information
-            spectrum_info = dict(element.items())
-            default_array_length = int(spectrum_info.get(
-                'default_array_length', spectrum_info["defaultArrayLength"]))
+            passes, precursor = self._filter_spectrum(
+                element, n, param_groups, act_method, act_energy,
+                spec_filter)
+            if passes:
+                spec_id, spectrum = self._build_spectrum(element, precursor)
+                spectra[spec_id] = spectrum
 
-            # MS level
-            try:
-                ms_level = int(
-                    element.xpath("x:cvParam[@name='ms level']",
-                                  namespaces=self.ns_map)[0].get("value"))
-            except IndexError:
-                group = element.find(
-                    self._fix_tag("referenceableParamGroupRef")).get("ref")
-                ms_level = int(param_groups[group]["ms level"])
-            if ms_level != n:
-                continue
+            element.clear()
 
-            # Extract only the last precursor since this should be the one
-            # preceding the current spectrum
-            try:
-                precursor: Optional[MZMLPrecursor] = \
-                    self._extract_precursors(element)[-1]
-            except IndexError:
-                precursor = None
-
-            # Apply filters based on the activation method/energy if specified
-            if (precursor is not None and ms_level >= 2 and
-                    (act_method is not None or act_energy is not None)):
-                act_params = precursor.activation_params
-                if act_method is not None and act_method not in act_params:
-                    continue
-                if (act_energy is not None and
-                        act_params.get("collision energy", None)
-                        != act_energy):
-                    continue
-
-            # MS spectrum
-            def _get_array(s):
-                return element.xpath(
-                    "x:binaryDataArrayList/x:binaryDataArray"
-                    f"[x:cvParam[@name='{s} array']]",
-                    namespaces=self.ns_map)[0]
-
-            mz = self._process_binary_data_array(
-                _get_array("m/z"), default_array_length)
-            intensity = self._process_binary_data_array(
-                _get_array("intensity"), default_array_length)
-
-            # Retention time
-            start_time = float(element.xpath(
-                "x:scanList/x:scan/x:cvParam[@name='scan start time']",
-                namespaces=self.ns_map)[0].get("value"))
-
-            # Remove spectral peaks with intensity 0
-            mz_intensity: List[Tuple[float, float]] = [
-                (mz[ii], intensity[ii])
-                for ii in range(default_array_length) if intensity[ii] > 0]
-
-            mz, intensity = (), ()
-            if mz_intensity:
-                mz, intensity = zip(*mz_intensity)
-
-            spec_id = self._parse_id(spectrum_info["id"])
+        return spectra
 
-            element.clear()
+    def _extract_msn_indexed(self, mzml_file: str, n: int,
+                             spec_ids: Iterable[str],
+                             act_method: Optional[str],
+                             act_energy: Optional[float],
+                             spec_filter: Optional[SpectrumFilter] = None) \
+            -> Dict[str, Spectrum]:
+        """
+        Extracts the requested MSn spectra from the input mzML file, seeking
+        directly to each spectrum using the offset index. The MS level and
+        activation filters are evaluated before any binary data arrays are
+        decoded.
+
+        """
+        index = self.get_index(mzml_file)
+        param_groups = self._read_param_groups(mzml_file)
 
-            spectra[spec_id] = Spectrum(
-                np.array([mz, intensity]),
-                precursor.selected_ions[0] if precursor is not None else None,
-                precursor.charges[0] if precursor is not None and
-                precursor.charges else None,
-                start_time)
+        spectra = {}
+        with open(mzml_file, "rb") as fh:
+            for pos in index.select_ids(spec_ids):
+                element = self._read_element(
+                    fh, index.starts[pos], index.ends[pos], "spectrum")
+                passes, precursor = self._filter_spectrum(
+                    element, n, param_groups, act_method, act_energy,
+                    spec_filter)
+                if passes:
+                    spec_id, spectrum = self._build_spectrum(element,
+                                                             precursor)
+                    spectra[spec_id] = spectrum
 
         return spectra
 
+    def _filter_spectrum(self, element, n: int,
+                         param_groups: Dict[str, Dict[str, Any]],
+                         act_method: Optional[str],
+                         act_energy: Optional[float],
+                         spec_filter: Optional[SpectrumFilter] = None) \
+            -> Tuple[bool, Optional[MZMLPrecursor]]:
+        """
+        Evaluates the MS level, activation and spectrum filters using the
+        spectrum header only, i.e. without decoding the binary data arrays.
+
+        Returns:
+            Tuple of (whether the spectrum passes the filters, the spectrum
+            precursor).
+
+        """
+        # MS level
+        try:
+            ms_level = int(
+                element.xpath("x:cvParam[@name='ms level']",
+                              namespaces=self.ns_map)[0].get("value"))
+        except IndexError:
+            group = element.find(
+                self._fix_tag("referenceableParamGroupRef")).get("ref")
+            ms_level = int(param_groups[group]["ms level"])
+        if ms_level != n:
+            return False, None
+
+        # Extract only the last precursor since this should be the one
+        # preceding the current spectrum
+        try:
+            precursor: Optional[MZMLPrecursor] = \
+                self._extract_precursors(element)[-1]
+        except IndexError:
+            precursor = None
+
+        if spec_filter is not None and not spec_filter.matches(
+                self._parse_id(element.get("id")),
+                precursor.selected_ions[0]
+                if precursor is not None and precursor.selected_ions
+                else None):
+            return False, precursor
+
+        # Apply filters based on the activation method/energy if specified
+        if precursor is not None and ms_level >= 2:
+            return (passes_activation_filters(precursor.activation_params,
+                                              act_method, act_energy),
+                    precursor)
+
+        return True, precursor
+
+    def _build_spectrum(self, element,
+                        precursor: Optional[MZMLPrecursor]) \
+            -> Tuple[str, Spectrum]:
+        """
+        Decodes the binary data arrays of the spectrum element to construct
+        the Spectrum.
+
+        Returns:
+            Tuple of (spectrum ID, Spectrum).
+
+        """
+        # This contains the cycle and experiment information
+        spectrum_info = dict(element.items())
+        default_array_length = int(spectrum_info.get(
+            'default_array_length', spectrum_info["defaultArrayLength"]))
+
+        # MS spectrum
+        def _get_array(s):
+            return element.xpath(
+                "x:binaryDataArrayList/x:binaryDataArray"
+                f"[x:cvParam[@name='{s} array']]",
+                namespaces=self.ns_map)[0]
+
+        mz = self._process_binary_data_array(
+            _get_array("m/z"), default_array_length)
+        intensity = self._process_binary_data_array(
+            _get_array("intensity"), default_array_length)
+
+        # Retention time
+        start_time = float(element.xpath(
+            "x:scanList/x:scan/x:cvParam[@name='scan start time']",
+            namespaces=self.ns_map)[0].get("value"))
+
+        # Remove spectral peaks with intensity 0
+        mask = intensity > 0
+        peaks = np.empty((np.count_nonzero(mask), 2))
+        peaks[:, 0] = mz[mask]
+        peaks[:, 1] = intensity[mask]
+
+        spec_id = self._parse_id(spectrum_info["id"])
+
+        return spec_id, Spectrum(
+            peaks,
+            precursor.selected_ions[0] if precursor is not None else None,
+            precursor.charges[0] if precursor is not None and
+            precursor.charges else None,
+            start_time)
+
+    def _parse_param_group(self, element) -> Dict[str, Any]:
+        """
+        Parses the cvParams of a referenceableParamGroup element.
+
+        """
+        params: Dict[str, Any] = {}
+        for param in element.findall(self._fix_tag("cvParam")):
+            params[param.get("name")] = param.get("value", None)
+        return params
+
+    def _read_param_groups(self, mzml_file: str) \
+            -> Dict[str, Dict[str, Any]]:
+        """
+        Reads the referenceableParamGroups from the header of the mzML file,
+        stopping at the start of the spectrum list.
+
+        """
+        param_groups: Dict[str, Dict[str, Any]] = {}
+        context = etree.iterparse(
+            mzml_file, events=("start", "end"),
+            tag=[self._fix_tag("referenceableParamGroup"),
+                 self._fix_tag("spectrumList")])
+        for event, element in context:
+            if element.tag == self._fix_tag("spectrumList"):
+                break
+            if event == "end":
+                param_groups[element.get("id")] = \
+                    self._parse_param_group(element)
+        return param_groups
+
+    def _read_element(self, fh, start: int, end: int, tag: str):
+        """
+        Reads and parses a single element from the byte range of the file,
+        discarding any trailing content beyond the element's closing tag.
+
+        """
+        fh.seek(start)
+        chunk = fh.read(end - start)
+        chunk = chunk[chunk.index(f"<{tag}".encode()):]
+        close_tag = f"</{tag}>".encode()
+        chunk = chunk[:chunk.index(close_tag) + len(close_tag)]
+        # Wrap the element to declare the namespace of the document
+        root = etree.fromstring(
+            f'<wrapper xmlns="{self.namespace}">'.encode() + chunk +
+            b"</wrapper>")
+        return root[0]
+
+    def get_index(self, mzml_file: str) -> SpectrumIndex:
+        """
+        Retrieves the spectrum offset index of the mzML file. For
+        indexedmzML files, the offsets are read from the indexList at the end
+        of the file. Otherwise, an index is built on a first pass of the file
+        and persisted alongside it.
+
+        Args:
+            mzml_file (str): The path to the mzML file.
+
+        Returns:
+            SpectrumIndex.
+
+        """
+        index = self._read_index_list(mzml_file)
+        if index is not None:
+            return index
+        index = SpectrumIndex.load(mzml_file)
+        if index is None:
+            logging.info(f"Indexing spectra in {mzml_file}")
+            index = self.build_index(mzml_file)
+            index.save(mzml_file)
+        return index
+
+    def _read_index_list(self, mzml_file: str) -> Optional[SpectrumIndex]:
+        """
+        Reads the spectrum offsets from the indexList of an indexedmzML file.
+
+        Returns:
+            SpectrumIndex, or None if the file is not indexed.
+
+        """
+        with open(mzml_file, "rb") as fh:
+            fh.seek(0, os.SEEK_END)
+            file_size = fh.tell()
+            fh.seek(max(file_size - 1024, 0))
+            match = self.index_list_offset_regex.search(fh.read())
+            if match is None:
+                return None
+            index_offset = int(match.group(1))
+            fh.seek(index_offset)
+            index_list = fh.read()
+
+        spectrum_offsets: List[Tuple[str, int]] = []
+        # All element offsets bound the extent of the preceding spectrum
+        bounds = [index_offset]
+        for index_match in self.index_regex.finditer(index_list):
+            offsets = [(ref.decode(), int(offset)) for ref, offset in
+                       self.offset_regex.findall(index_match.group(2))]
+            bounds.extend(offset for _, offset in offsets)
+            if index_match.group(1) == b"spectrum":
+                spectrum_offsets = offsets
+
+        if not spectrum_offsets:
+            return None
+
+        bounds_arr = np.unique(bounds)
+        starts = np.array([offset for _, offset in spectrum_offsets])
+        ends = bounds_arr[np.searchsorted(bounds_arr, starts, side="right")]
+        return SpectrumIndex(
+            [self._parse_id(ref) for ref, _ in spectrum_offsets],
+            starts, ends, np.full(len(starts), np.nan))
+
+    def build_index(self, mzml_file: str) -> SpectrumIndex:
+        """
+        Scans the mzML file to record the byte range of each spectrum
+        element.
+
+        Args:
+            mzml_file (str): The path to the mzML file.
+
+        Returns:
+            SpectrumIndex.
+
+        """
+        ids: List[str] = []
+        starts: List[int] = []
+        ends: List[int] = []
+        with open(mzml_file, "rb") as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for match in self.spectrum_start_regex.finditer(mm):
+                    ids.append(self._parse_id(match.group(1).decode()))
+                    starts.append(match.start())
+                    ends.append(mm.find(b"</spectrum>", match.end()) +
+                                len(b"</spectrum>"))
+
+        return SpectrumIndex(ids, np.array(starts), np.array(ends),
+                             np.full(len(ids), np.nan))
+
     def _extract_precursors(self, spectrum) -> List[MZMLPrecursor]:
         """
         """
@@ -395,7 +986,7 @@ class MZMLReader:
     def decode_binary(string: str, default_array_length: int,
                       precision: int = 64,
                       comp_mode: Optional[CompressionMode] = None) \
-            -> Tuple[Any, ...]:
+            -> np.ndarray:
         """
         Decodes binary string to floats.
 
@@ -407,21 +998,21 @@ class MZMLReader:
             comp_mode (CompressionMode, optional): The compression mode.
 
         Returns:
-            The decoded and decompressed binary content as a tuple.
+            The decoded and decompressed binary content as a numpy array of
+            little-endian float64 or float32 values, depending on precision.
+            The array is a read-only view of the decoded buffer.
 
         """
+        dtype = "<f8" if precision == 64 else "<f4"
         if string is None:
-            return ()
+            return np.empty(0, dtype=dtype)
         decoded = base64.b64decode(string)
         if comp_mode is CompressionMode.zlib:
             decoded = zlib.decompress(decoded)
-        unpack_format = "<%dd" % default_array_length if precision == 64 else \
-            "<%df" % default_array_length
-        return struct.unpack(unpack_format, decoded)
+        return np.frombuffer(decoded, dtype=dtype, count=default_array_length)
 
     def _process_binary_data_array(self, data_array,
-                                   default_array_length: int) \
-            -> Tuple[Any, ...]:
+                                   default_array_length: int) -> np.ndarray:
         """
         Processes the binary data array to extract the binary content.
 
@@ -442,3 +1033,377 @@ class MZMLReader:
 
         """
         return f"{{{self.namespace}}}{tag}"
+
+
+class MZXMLReader:
+    """
+    A reader class for mzXML files. Elements are matched regardless of the
+    mzXML schema version (namespace).
+
+    """
+    index_offset_regex = re.compile(
+        rb"<indexOffset>\s*(\d+)\s*</indexOffset>")
+
+    index_regex = re.compile(
+        rb"<index\s+name=\"scan\"\s*>(.*?)</index>", re.DOTALL)
+
+    offset_regex = re.compile(
+        rb"<offset\s+id=\"(\d+)\"[^>]*>\s*(\d+)\s*</offset>")
+
+    scan_start_regex = re.compile(rb"<scan\s[^>]*?\bnum=\"(\d+)\"")
+
+    duration_regex = re.compile(
+        r"P(?:\d+D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?")
+
+    # The mzML (PSI-MS) names of the mzXML activation methods, so that the
+    # same activation_mode filter applies to both formats
+    activation_methods = {
+        "CID": "collision-induced dissociation",
+        "HCD": "beam-type collision-induced dissociation",
+        "ETD": "electron transfer dissociation",
+        "ECD": "electron capture dissociation",
+        "PQD": "pulsed q dissociation",
+    }
+
+    @staticmethod
+    def spectrum_id(scan_num: str) -> str:
+        """
+        Constructs the spectrum ID of the scan, in the format produced by
+        MZMLReader for the native ID of the same scan
+        ("controllerType=0 controllerNumber=1 scan=<num>"), so that search
+        result IDs match spectra read from either format.
+
+        Args:
+            scan_num (str): The scan number.
+
+        Returns:
+            The spectrum ID.
+
+        """
+        return f"0.1.{scan_num}"
+
+    def extract_ms2(self, mzxml_file: str, **kwargs) \
+            -> Dict[str, Spectrum]:
+        """
+        Extracts the MS2 spectra from the input mzXML file.
+
+        Args:
+            mzxml_file (str): The path to the mzXML file.
+
+        Returns:
+            A dictionary of spectrum ID to Spectrum.
+
+        """
+        return self.extract_msn(mzxml_file, 2, **kwargs)
+
+    def extract_msn(self, mzxml_file: str, n: int,
+                    act_method: Optional[str] = None,
+                    act_energy: Optional[float] = None,
+                    spec_ids: Optional[Iterable[str]] = None,
+                    spec_filter: Optional[SpectrumFilter] = None) \
+            -> Dict[str, Spectrum]:
+        """
+        Extracts the MSn spectra from the input mzXML file, streaming the
+        scan elements, which may be nested within their precursor scans.
+
+        Args:
+            mzxml_file (str): The path to the mzXML file.
+            n (int): The MS level for which to return spectral information.
+            act_method (str, optional): The activation method by which to
+                                        filter spectra.
+            act_energy (float, optional): The collision energy by which to
+                                          filter spectra.
+            spec_ids (iterable, optional): The IDs ("0.1.<scan number>") of
+                                           the spectra to read. If provided,
+                                           only these spectra are parsed and
+                                           decoded, using the scan offset
+                                           index.
+            spec_filter (SpectrumFilter, optional): The filter to apply to
+                                                    the spectra before their
+                                                    peaks are decoded.
+
+        Returns:
+            A dictionary of spectrum ID to Spectrum.
+
+        """
+        if spec_ids is not None:
+            return self._extract_msn_indexed(mzxml_file, n, spec_ids,
+                                             act_method, act_energy,
+                                             spec_filter)
+
+        spectra = {}
+        for event, element in etree.iterparse(mzxml_file, events=("end",),
+                                              tag="{*}scan"):
+            passes, precursor = self._filter_scan(element, n, act_method,
+                                                  act_energy, spec_filter)
+            if passes:
+                spec_id, spectrum = self._build_spectrum(element, precursor)
+                spectra[spec_id] = spectrum
+
+            element.clear()
+
+        return spectra
+
+    def _extract_msn_indexed(self, mzxml_file: str, n: int,
+                             spec_ids: Iterable[str],
+                             act_method: Optional[str],
+                             act_energy: Optional[float],
+                             spec_filter: Optional[SpectrumFilter] = None) \
+            -> Dict[str, Spectrum]:
+        """
+        Extracts the requested MSn spectra from the input mzXML file, seeking
+        directly to each scan using the offset index.
+
+        """
+        index = self.get_index(mzxml_file)
+
+        spectra = {}
+        with open(mzxml_file, "rb") as fh:
+            for pos in index.select_ids(spec_ids):
+                element = self._read_scan(fh, index.starts[pos],
+                                          index.ends[pos])
+                passes, precursor = self._filter_scan(element, n, act_method,
+                                                      act_energy,
+                                                      spec_filter)
+                if passes:
+                    spec_id, spectrum = self._build_spectrum(element,
+                                                             precursor)
+                    spectra[spec_id] = spectrum
+
+        return spectra
+
+    def _filter_scan(self, element, n: int, act_method: Optional[str],
+                     act_energy: Optional[float],
+                     spec_filter: Optional[SpectrumFilter] = None) \
+            -> Tuple[bool, Optional[MZMLPrecursor]]:
+        """
+        Evaluates the MS level, activation and spectrum filters using the
+        scan attributes and precursor only, i.e. without decoding the peaks.
+
+        Returns:
+            Tuple of (whether the scan passes the filters, the scan
+            precursor).
+
+        """
+        ms_level = int(element.get("msLevel"))
+        if ms_level != n:
+            return False, None
+
+        precursor = self._extract_precursor(element)
+
+        if spec_filter is not None and not spec_filter.matches(
+                self.spectrum_id(element.get("num")),
+                precursor.selected_ions[0] if precursor is not None
+                else None):
+            return False, precursor
+
+        # Apply filters based on the activation method/energy if specified
+        if precursor is not None and ms_level >= 2:
+            return (passes_activation_filters(precursor.activation_params,
+                                              act_method, act_energy),
+                    precursor)
+
+        return True, precursor
+
+    def _extract_precursor(self, element) -> Optional[MZMLPrecursor]:
+        """
+        Extracts the precursor of the scan, using the mzML precursor
+        representation, including the PSI-MS name of the activation method.
+
+        """
+        prec_elements = element.findall("{*}precursorMz")
+        if not prec_elements:
+            return None
+        # Take the last precursor, consistent with mzML
+        prec = prec_elements[-1]
+
+        act_params: Dict[str, Any] = {}
+        method = prec.get("activationMethod")
+        if method is not None:
+            act_params[method] = None
+            if method in self.activation_methods:
+                act_params[self.activation_methods[method]] = None
+        if element.get("collisionEnergy") is not None:
+            act_params["collision energy"] = \
+                float(element.get("collisionEnergy"))
+
+        charge = prec.get("precursorCharge")
+        return MZMLPrecursor(
+            prec.get("precursorScanNum"), [float(prec.text)],
+            [int(charge)] if charge is not None else [], act_params)
+
+    def _build_spectrum(self, element,
+                        precursor: Optional[MZMLPrecursor]) \
+            -> Tuple[str, Spectrum]:
+        """
+        Decodes the peaks of the scan element to construct the Spectrum.
+
+        Returns:
+            Tuple of (spectrum ID, Spectrum).
+
+        """
+        peaks_element = element.find("{*}peaks")
+        peaks = np.empty((0, 2))
+        if peaks_element is not None:
+            peaks = self.decode_peaks(
+                peaks_element.text,
+                precision=int(peaks_element.get("precision", 32)),
+                byte_order=peaks_element.get("byteOrder", "network"),
+                compressed=peaks_element.get("compressionType") == "zlib")
+
+        # Remove spectral peaks with intensity 0
+        peaks = peaks[peaks[:, 1] > 0].astype(np.float64)
+
+        ret_time = element.get("retentionTime")
+
+        return self.spectrum_id(element.get("num")), Spectrum(
+            peaks,
+            precursor.selected_ions[0] if precursor is not None else None,
+            precursor.charges[0] if precursor is not None and
+            precursor.charges else None,
+            self._parse_duration(ret_time) if ret_time is not None
+            else None)
+
+    @staticmethod
+    def decode_peaks(string: Optional[str], precision: int = 32,
+                     byte_order: str = "network",
+                     compressed: bool = False) -> np.ndarray:
+        """
+        Decodes the base64-encoded, interleaved (m/z, intensity) pairs of an
+        mzXML peaks element.
+
+        Args:
+            string (str): The base64-encoded peaks.
+            precision (int, optional): The precision (32 or 64 bit) of the
+                                       floating point values.
+            byte_order (str, optional): The byte order of the values; mzXML
+                                        specifies "network" (big-endian).
+            compressed (bool, optional): Whether the peaks are zlib
+                                         compressed.
+
+        Returns:
+            The peaks as an (N, 2) numpy array.
+
+        """
+        dtype = np.dtype(f"f{precision // 8}").newbyteorder(
+            "<" if byte_order == "little" else ">")
+        if not string:
+            return np.empty((0, 2), dtype=dtype)
+        decoded = base64.b64decode(string)
+        if compressed:
+            decoded = zlib.decompress(decoded)
+        return np.frombuffer(decoded, dtype=dtype).reshape(-1, 2)
+
+    def _parse_duration(self, duration: str) -> float:
+        """
+        Converts an xs:duration retention time, e.g. PT12.34S, to seconds.
+
+        """
+        match = self.duration_regex.fullmatch(duration)
+        if match is None:
+            raise ParserException(f"Invalid retention time: {duration}")
+        hours, minutes, seconds = match.groups()
+        return (int(hours or 0) * 3600 + int(minutes or 0) * 60 +
+                float(seconds or 0))
+
+    def _read_scan(self, fh, start: int, end: int):
+        """
+        Reads and parses a single scan element from the byte range of the
+        file. Nested scans are excluded, such that the element contains only
+        its own header and peaks.
+
+        """
+        fh.seek(start)
+        chunk = fh.read(end - start)
+        chunk = chunk[chunk.index(b"<scan"):]
+        # The byte range of a scan ends at the start of the next scan, which
+        # may be nested within it, in which case the scan is not yet closed
+        close_tag = b"</scan>"
+        close_idx = chunk.find(close_tag)
+        if close_idx == -1:
+            chunk += close_tag
+        else:
+            chunk = chunk[:close_idx + len(close_tag)]
+        return etree.fromstring(chunk)
+
+    def get_index(self, mzxml_file: str) -> SpectrumIndex:
+        """
+        Retrieves the scan offset index of the mzXML file. The offsets are
+        read from the scan index at the end of the file where present.
+        Otherwise, an index is built on a first pass of the file and
+        persisted alongside it.
+
+        Args:
+            mzxml_file (str): The path to the mzXML file.
+
+        Returns:
+            SpectrumIndex.
+
+        """
+        index = self._read_scan_index(mzxml_file)
+        if index is not None:
+            return index
+        index = SpectrumIndex.load(mzxml_file)
+        if index is None:
+            logging.info(f"Indexing spectra in {mzxml_file}")
+            index = self.build_index(mzxml_file)
+            index.save(mzxml_file)
+        return index
+
+    def _read_scan_index(self, mzxml_file: str) -> Optional[SpectrumIndex]:
+        """
+        Reads the scan offsets from the index of an mzXML file.
+
+        Returns:
+            SpectrumIndex, or None if the file is not indexed.
+
+        """
+        with open(mzxml_file, "rb") as fh:
+            fh.seek(0, os.SEEK_END)
+            file_size = fh.tell()
+            fh.seek(max(file_size - 1024, 0))
+            match = self.index_offset_regex.search(fh.read())
+            if match is None:
+                return None
+            index_offset = int(match.group(1))
+            fh.seek(index_offset)
+            index_match = self.index_regex.search(fh.read())
+
+        if index_match is None:
+            return None
+        offsets = [(num.decode(), int(offset)) for num, offset in
+                   self.offset_regex.findall(index_match.group(1))]
+        if not offsets:
+            return None
+
+        # Each scan extends at most to the start of the next scan, which may
+        # be nested within it
+        starts = np.array([offset for _, offset in offsets])
+        bounds = np.unique(np.append(starts, index_offset))
+        ends = bounds[np.searchsorted(bounds, starts, side="right")]
+        return SpectrumIndex([self.spectrum_id(num) for num, _ in offsets],
+                             starts, ends, np.full(len(starts), np.nan))
+
+    def build_index(self, mzxml_file: str) -> SpectrumIndex:
+        """
+        Scans the mzXML file to record the byte range of each scan element.
+
+        Args:
+            mzxml_file (str): The path to the mzXML file.
+
+        Returns:
+            SpectrumIndex.
+
+        """
+        ids: List[str] = []
+        starts: List[int] = []
+        with open(mzxml_file, "rb") as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for match in self.scan_start_regex.finditer(mm):
+                    ids.append(self.spectrum_id(match.group(1).decode()))
+                    starts.append(match.start())
+                file_size = len(mm)
+
+        return SpectrumIndex(ids, np.array(starts),
+                             np.array(starts[1:] + [file_size]),
+                             np.full(len(ids), np.nan))
@@ -0,0 +1,324 @@
+#! /usr/bin/env python3
+"""
+A module providing a columnar, memory-mapped on-disk store of mass spectra.
+
+The store is a directory of numpy arrays: the peaks of all spectra
+concatenated into a single (m/z, intensity) array, the offsets of each
+spectrum within it, the precursor m/z, charge and retention time of each
+spectrum, and the data set and spectrum IDs. Spectra retrieved from the store
+are zero-copy, read-only views into the memory-mapped peak array, so loading
+the store is near-instant and processes reading the same store share the page
+cache.
+
+"""
+import collections.abc
+import os
+import pickle
+import shutil
+from typing import (Any, Dict, Iterable, Iterator, Mapping, Optional,
+                    Sequence, Set)
+
+import numpy as np
+
+from .mass_spectrum import Spectrum
+from .spectra_index import SpectrumIndex
+
+
+PEAKS_FILE = "peaks.npy"
+OFFSETS_FILE = "offsets.npy"
+PREC_MZ_FILE = "prec_mz.npy"
+CHARGE_FILE = "charge.npy"
+RT_FILE = "rt.npy"
+DATA_IDS_FILE = "data_ids.npy"
+SPEC_IDS_FILE = "spec_ids.npy"
+METADATA_FILE = "metadata.pkl"
+
+
+class SpectrumStore:
+    """
+    A class to provide access to a columnar spectrum store on disk.
+
+    """
+    def __init__(self, path: str):
+        """
+        Opens the spectrum store, memory-mapping its arrays.
+
+        Args:
+            path (str): The path to the store directory.
+
+        """
+        self.path = path
+
+        def _load(name: str, mmap_mode="r") -> np.ndarray:
+            # The arrays are mapped read-only, so that the spectra are
+            # immutable and all views share the same pages
+            return np.load(os.path.join(path, name),
+                           mmap_mode=mmap_mode).view(np.ndarray)
+
+        self.peaks = _load(PEAKS_FILE)
+        self.offsets = _load(OFFSETS_FILE)
+        self.prec_mzs = _load(PREC_MZ_FILE)
+        self.charges = _load(CHARGE_FILE)
+        self.retention_times = _load(RT_FILE)
+        self.data_ids = np.load(os.path.join(path, DATA_IDS_FILE))
+        self.spec_ids = np.load(os.path.join(path, SPEC_IDS_FILE))
+
+        self.metadata: Dict[str, Any] = {}
+        metadata_path = os.path.join(path, METADATA_FILE)
+        if os.path.isfile(metadata_path):
+            with open(metadata_path, "rb") as fh:
+                self.metadata = pickle.load(fh)
+
+    def __len__(self) -> int:
+        """
+        Returns the number of spectra in the store.
+
+        """
+        return len(self.spec_ids)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        """
+        Tests whether a complete spectrum store exists at the path.
+
+        """
+        return os.path.isfile(os.path.join(path, SPEC_IDS_FILE))
+
+    def index(self) -> SpectrumIndex:
+        """
+        Constructs a SpectrumIndex of the store, in which the offsets are
+        those of the spectra in the peak array, for selecting spectra by ID
+        and precursor mass/charge ratio.
+
+        Returns:
+            SpectrumIndex, whose positions are positions in the store.
+
+        """
+        return SpectrumIndex(self.spec_ids.tolist(), self.offsets[:-1],
+                             self.offsets[1:], self.prec_mzs)
+
+    def spectrum(self, pos: int) -> Spectrum:
+        """
+        Constructs the Spectrum at the given position in the store. The peaks
+        of the Spectrum are a read-only view into the store.
+
+        Args:
+            pos (int): The position of the spectrum in the store.
+
+        Returns:
+            Spectrum.
+
+        """
+        prec_mz = self.prec_mzs[pos]
+        charge = self.charges[pos]
+        ret_time = self.retention_times[pos]
+        return Spectrum(
+            self.peaks[self.offsets[pos]:self.offsets[pos + 1]],
+            None if np.isnan(prec_mz) else float(prec_mz),
+            None if charge == 0 else int(charge),
+            retention_time=None if np.isnan(ret_time) else float(ret_time))
+
+    def data_sets(self, selected: Optional[Iterable[int]] = None) \
+            -> Dict[str, "StoredSpectra"]:
+        """
+        Constructs mappings of spectrum ID to Spectrum for each data set in
+        the store.
+
+        Args:
+            selected (iterable, optional): The positions of the spectra to
+                                           include. Defaults to all spectra.
+
+        Returns:
+            Dictionary mapping data set ID to StoredSpectra.
+
+        """
+        data_ids = self.data_ids.tolist()
+        spec_ids = self.spec_ids.tolist()
+        if selected is None:
+            selected = range(len(spec_ids))
+
+        positions: Dict[str, Dict[str, int]] = collections.defaultdict(dict)
+        for pos in selected:
+            positions[data_ids[pos]][spec_ids[pos]] = pos
+        return {data_id: StoredSpectra(self, spec_positions)
+                for data_id, spec_positions in positions.items()}
+
+    @staticmethod
+    def write(path: str, spectra: Mapping[str, Mapping[str, Spectrum]],
+              metadata: Optional[Dict[str, Any]] = None):
+        """
+        Writes the spectra to a new store at the given path, replacing any
+        existing store. The store is written to a temporary directory and
+        moved into place once complete.
+
+        Args:
+            path (str): The path to the store directory.
+            spectra (dict): A nested dictionary, keyed by the data set ID,
+                            then the spectrum ID.
+            metadata (dict, optional): Picklable information to store with
+                                       the spectra, available as the
+                                       metadata attribute of the opened
+                                       store.
+
+        """
+        tmp_path = f"{path}.tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        data_ids = [data_id for data_id, _spectra in spectra.items()
+                    for _ in _spectra]
+        spec_ids = [spec_id for _spectra in spectra.values()
+                    for spec_id in _spectra]
+        all_spectra = [spec for _spectra in spectra.values()
+                       for spec in _spectra.values()]
+
+        offsets = np.zeros(len(all_spectra) + 1, dtype=np.int64)
+        np.cumsum([len(spec) for spec in all_spectra], out=offsets[1:])
+
+        # Fill the peak array in place to avoid holding a second,
+        # concatenated copy of the peaks in memory
+        peaks = np.lib.format.open_memmap(
+            os.path.join(tmp_path, PEAKS_FILE), mode="w+",
+            dtype=np.float64, shape=(int(offsets[-1]), 2))
+        for ii, spec in enumerate(all_spectra):
+            peaks[offsets[ii]:offsets[ii + 1]] = spec[:, :2]
+        peaks.flush()
+        del peaks
+
+        def _save(name: str, values):
+            np.save(os.path.join(tmp_path, name), values)
+
+        _save(OFFSETS_FILE, offsets)
+        _save(PREC_MZ_FILE, np.array(
+            [np.nan if spec.prec_mz is None else spec.prec_mz
+             for spec in all_spectra], dtype=np.float64))
+        _save(CHARGE_FILE, np.array(
+            [0 if spec.charge is None else spec.charge
+             for spec in all_spectra], dtype=np.int64))
+        _save(RT_FILE, np.array(
+            [np.nan if spec.retention_time is None else spec.retention_time
+             for spec in all_spectra], dtype=np.float64))
+        _save(DATA_IDS_FILE, np.array(data_ids, dtype=str))
+        with open(os.path.join(tmp_path, METADATA_FILE), "wb") as fh:
+            pickle.dump(metadata if metadata is not None else {}, fh)
+        # The spectrum IDs are written last, marking the store as complete
+        _save(SPEC_IDS_FILE, np.array(spec_ids, dtype=str))
+
+        if os.path.exists(path):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        os.replace(tmp_path, path)
+
+
+class StoredSpectra(collections.abc.Mapping):
+    """
+    A read-only mapping of spectrum ID to Spectrum for a single data set in a
+    SpectrumStore. Spectra are constructed on access as views into the store.
+
+    """
+    def __init__(self, store: SpectrumStore, positions: Dict[str, int]):
+        """
+        Initializes the mapping.
+
+        Args:
+            store (SpectrumStore): The spectrum store.
+            positions (dict): A dictionary mapping spectrum ID to position in
+                              the store.
+
+        """
+        self._store = store
+        self._positions = positions
+
+    def __getitem__(self, spec_id: str) -> Spectrum:
+        """
+        Retrieves the Spectrum with the given ID.
+
+        Raises:
+            KeyError
+
+        """
+        return self._store.spectrum(self._positions[spec_id])
+
+    def __contains__(self, spec_id: object) -> bool:
+        """
+        Tests whether the spectrum ID is in the mapping, without constructing
+        the Spectrum.
+
+        """
+        return spec_id in self._positions
+
+    def __iter__(self) -> Iterator[str]:
+        """
+        Iterates over the spectrum IDs.
+
+        """
+        return iter(self._positions)
+
+    def __len__(self) -> int:
+        """
+        Returns the number of spectra in the mapping.
+
+        """
+        return len(self._positions)
+
+
+class MergedSpectra(collections.abc.Mapping):
+    """
+    A read-only mapping of spectrum ID to Spectrum which merges the spectra
+    of several mappings, e.g. those of the spectra files of a data set.
+    Where a spectrum ID is in more than one mapping, the Spectrum of the
+    last mapping takes precedence.
+
+    """
+    def __init__(self, spectra: Sequence[Mapping[str, Spectrum]]):
+        """
+        Initializes the mapping.
+
+        Args:
+            spectra (list): The mappings of spectrum ID to Spectrum to merge,
+                            in increasing order of precedence.
+
+        """
+        self._spectra = list(reversed(spectra))
+
+    def __getitem__(self, spec_id: str) -> Spectrum:
+        """
+        Retrieves the Spectrum with the given ID.
+
+        Raises:
+            KeyError
+
+        """
+        for spectra in self._spectra:
+            if spec_id in spectra:
+                return spectra[spec_id]
+        raise KeyError(spec_id)
+
+    def __contains__(self, spec_id: object) -> bool:
+        """
+        Tests whether the spectrum ID is in any of the merged mappings.
+
+        """
+        return any(spec_id in spectra for spectra in self._spectra)
+
+    def __iter__(self) -> Iterator[str]:
+        """
+        Iterates over the unique spectrum IDs.
+
+        """
+        seen: Set[str] = set()
+        for spectra in self._spectra:
+            for spec_id in spectra:
+                if spec_id not in seen:
+                    seen.add(spec_id)
+                    yield spec_id
+
+    def __len__(self) -> int:
+        """
+        Returns the number of unique spectrum IDs.
+
+        """
+        return sum(1 for _ in self)
@@ -3,46 +3,10 @@
 A script providing utility functions for peptide modification validation.
 
 """
-from bisect import bisect_left
-import collections
 import operator
 from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
 
 
-Slices = collections.namedtuple("Slices", ["idxs", "bounds"])
-
-
-def slice_list(values: List[float], nslices: int = 800) -> Slices:
-    """
-    Slices the list of values into nslices segments.
-
-    Args:
-        values (list): A list of floats.
-        nslices (int, optional): The number of slices to split.
-
-    Returns:
-        Slices: index at which each slice begins in values,
-                the value at which each slice begins.
-
-    """
-    size = (values[-1] - values[0]) / nslices
-    # bounds contains the lower bound of each slice
-    idxs, bounds = [], []
-    for ii in range(nslices + 1):
-        pos = bisect_left(values, size * ii + values[0])
-        if pos == 0:
-            idxs.append(0)
-            bounds.append(values[0])
-        elif pos < len(values):
-            idxs.append(pos - 1)
-            bounds.append(values[pos - 1])
-        else:
-            idxs.append(pos - 1)
-            bounds.append(values[-1])
-
-    return Slices(idxs, bounds)
-
-
 def longest_sequence(seq: Sequence[int]) -> Tuple[int, Optional[List[int]]]:
     """
     Finds the length (and subsequence) of the longest consecutive sequence
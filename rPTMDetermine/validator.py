@@ -6,32 +6,33 @@ spectra.
 """
 from bisect import bisect_left
 import collections
-import copy
 import csv
 import enum
-import functools
 import itertools
 import logging
-import multiprocessing as mp
 import operator
 import os
 import pickle
 import sys
-from typing import List, Optional, Sequence, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
 import tqdm
 
-from pepfrag import AA_MASSES, FIXED_MASSES, ModSite, Peptide
+from pepfrag import FIXED_MASSES, ModSite, Peptide
 
 from .base_config import SearchEngine
 from .constants import RESIDUES
 from .features import Features
+from .fragment_cache import (FRAGMENT_CACHE, batch_fragment_ions,
+                             get_fragment_ions)
+from . import decoy_index
 from . import generate_decoys
 from . import lda
 from . import mass_spectrum
 from . import peptides
-from .peptide_spectrum_match import DecoyID, PSM, UnmodPSM
+from .peptide_spectrum_match import (DecoyID, PSM, UnmodPSM,
+                                     calculate_match_scores)
 from . import proteolysis
 from .psm_container import PSMContainer, PSMType
 from . import readers
@@ -47,14 +48,26 @@ class ValidationSteps(enum.Enum):
     CalculateSimilarity = enum.auto()
 
 
+# The decoy peptides of a DecoyIndex, with the function generating the fixed
+# modifications of a sequence, the fixed modification masses indexed by the
+# ASCII code of the residue, the N-terminal fixed modification mass and the
+# target modification mass and name
 DecoyPeptides = collections.namedtuple("DecoyPeptides",
-                                       ["seqs", "var_idxs", "idxs", "mods",
-                                        "masses"])
+                                       ["index", "fixed_mods", "fixed_masses",
+                                        "nterm_mass", "mod_mass",
+                                        "target_mod"])
 
 
 VarPTMs = collections.namedtuple("VarPTMs", ["masses", "max_mass",
                                              "min_mass"])
 
+# The decoy candidates for a peptide mass, as arrays of the positions of the
+# decoy peptides in the DecoyIndex, the candidate charge states and the mass
+# and (zero-based) site of the variable PTM, with site -1 for no variable PTM
+DecoyCandidates = collections.namedtuple("DecoyCandidates",
+                                         ["idxs", "charges", "var_masses",
+                                          "var_sites"])
+
 
 DB_RES_FILE = "db_res.pkl"
 LDA_PSM_FILE = "lda_psms.pkl"
@@ -67,7 +80,8 @@ def get_decoys(decoy_db: str, residue: Optional[str]) -> List[str]:
     residue.
 
     Args:
-        decoy_db (str): The path to the decoy database.
+        decoy_db (str): The path to the decoy database, either a decoy
+                        peptide file or a decoy peptide table.
         residue (str): The residue by which to limit decoy sequences. If None,
                        no residue filter will be applied.
 
@@ -75,105 +89,230 @@ def get_decoys(decoy_db: str, residue: Optional[str]) -> List[str]:
         List of matching decoy peptide sequences.
 
     """
-    with open(decoy_db) as handle:
-        rdr = csv.DictReader(handle, delimiter='\t')
-        return list({
-            r['Sequence'] for r in rdr
-            if (residue is None or residue in r['Sequence']) and
-            len(r['Sequence']) >= 7 and RESIDUES.issuperset(r['Sequence'])})
+    if decoy_db.endswith(generate_decoys.DECOY_TABLE_SUFFIX):
+        seqs = set(generate_decoys.read_decoy_table(decoy_db))
+    else:
+        with open(decoy_db) as handle:
+            rdr = csv.DictReader(handle, delimiter='\t')
+            seqs = {r['Sequence'] for r in rdr}
+    return [seq for seq in seqs
+            if (residue is None or residue in seq) and
+            len(seq) >= 7 and RESIDUES.issuperset(seq)]
+
+
+def decoy_peptide(decoys: DecoyPeptides,
+                  idx: int) -> Tuple[str, List[ModSite]]:
+    """
+    Constructs the sequence and modifications of the decoy peptide at the
+    given position in the decoy index.
+
+    Args:
+        decoys (DecoyPeptides): The decoy peptides.
+        idx (int): The position of the decoy peptide.
+
+    Returns:
+        Tuple of (sequence, list of ModSites).
+
+    """
+    seq = decoys.index.sequence(decoys.index.seq_idxs[idx])
+    mods = decoys.fixed_mods(seq) + [
+        ModSite(decoys.mod_mass, site + 1, decoys.target_mod)
+        for site in decoys.index.peptide_sites(idx)]
+    return seq, mods
 
 
 def match_decoys(peptide_mz: float, decoys: DecoyPeptides,
-                 slices: utilities.Slices, var_ptms: VarPTMs,
-                 tol_factor: float = 0.01) -> List[Peptide]:
+                 var_ptms: VarPTMs,
+                 tol_factor: float = 0.01) -> DecoyCandidates:
     """
     Finds the decoy peptide candidates for the given peptide mass charge
     ratio.
 
+    Since the decoy masses are sorted, the decoy peptides within tolerance
+    of the peptide mass, for each charge state and each variable PTM mass
+    offset, form a contiguous window of the index, and all of the windows
+    are located at once. The variable PTMs are applied at each instance of
+    their residue in the sequence; the residues bearing variable
+    modifications exclude those with fixed modifications.
+
+    Args:
+        peptide_mz (float): The mass/charge ratio of the peptide.
+        decoys (DecoyPeptides): The decoy peptides.
+        var_ptms (VarPTMs): The variable PTMs which may be applied to the
+                            decoy peptides.
+        tol_factor (float, optional): The mass tolerance per charge.
+
+    Returns:
+        DecoyCandidates, ordered by charge, then variable PTM (no variable
+        PTM first), then decoy mass and then variable PTM site.
+
+    """
+    residue_list, mass_list = [0], [0.]
+    for res, _masses in var_ptms.masses.items():
+        residue_list.extend([ord(res)] * len(_masses))
+        mass_list.extend(_masses)
+    var_residues: np.ndarray = np.array(residue_list, dtype=np.uint8)
+    var_masses: np.ndarray = np.array(mass_list)
+
+    charges = np.arange(2, 5)
+    pep_masses = peptide_mz * charges
+    tols = tol_factor * charges
+
+    # The mass windows, one row per charge state and one column per variable
+    # PTM mass offset
+    lower = (pep_masses - tols)[:, np.newaxis] - var_masses
+    upper = (pep_masses + tols)[:, np.newaxis] - var_masses
+    starts = decoys.index.masses.searchsorted(lower.ravel(), side="left")
+    ends = decoys.index.masses.searchsorted(upper.ravel(), side="right")
+    counts = np.maximum(ends - starts, 0)
+
+    # Expand the windows to the decoy indices
+    window_idxs = np.repeat(np.arange(len(counts)), counts)
+    idxs = starts[window_idxs] + np.arange(counts.sum()) - \
+        (np.cumsum(counts) - counts)[window_idxs]
+    var_idxs = window_idxs % len(var_masses)
+    var_codes = var_residues[var_idxs]
+
+    # Expand the candidates with a variable PTM to each position in their
+    # sequences, keeping the positions of the variable PTM residue
+    seq_idxs = decoys.index.seq_idxs[idxs]
+    seq_starts = decoys.index.seq_offsets[seq_idxs]
+    has_var = var_codes > 0
+    num_positions = np.where(
+        has_var, decoys.index.seq_offsets[seq_idxs + 1] - seq_starts, 1)
+    rows = np.repeat(np.arange(len(idxs)), num_positions)
+    positions = np.arange(num_positions.sum()) - \
+        np.repeat(np.cumsum(num_positions) - num_positions, num_positions)
+    keep = ~has_var[rows] | \
+        (decoys.index.seq_bytes[seq_starts[rows] + positions] ==
+         var_codes[rows])
+    rows, positions = rows[keep], positions[keep]
+
+    return DecoyCandidates(
+        idxs[rows], charges[window_idxs // len(var_masses)][rows],
+        var_masses[var_idxs][rows],
+        np.where(has_var[rows], positions, -1))
+
+
+def decoy_candidate_masses(decoys: DecoyPeptides,
+                           candidates: DecoyCandidates) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Constructs the masses of the N-terminus, the modified residues and the
+    C-terminus of the decoy candidates, as used by
+    peptides.get_by_ion_mzs_from_masses, without constructing the peptides.
+
+    Args:
+        decoys (DecoyPeptides): The decoy peptides.
+        candidates (DecoyCandidates): The decoy candidates.
+
+    Returns:
+        Tuple of (mass matrix, sequence lengths).
+
+    """
+    index = decoys.index
+    seq_idxs = index.seq_idxs[candidates.idxs]
+    starts = index.seq_offsets[seq_idxs]
+    lengths = index.seq_offsets[seq_idxs + 1] - starts
+    max_len = int(lengths.max()) if len(lengths) else 0
+
+    cols = np.arange(max_len)
+    codes = np.where(
+        cols < lengths[:, np.newaxis],
+        index.seq_bytes[np.minimum(starts[:, np.newaxis] + cols,
+                                   len(index.seq_bytes) - 1)], 0)
+
+    # The modification masses at each site are summed, in the order of the
+    # peptide modifications, before being added to the residue masses
+    masses = np.zeros((len(codes), max_len + 2), dtype=np.float64)
+    masses[:, 0] = decoys.nterm_mass
+    masses[:, 1:max_len + 1] = decoys.fixed_masses[codes]
+
+    target_sites = index.target_sites[candidates.idxs]
+    rows, cols = (target_sites >= 0).nonzero()
+    masses[rows, target_sites[rows, cols] + 1] += decoys.mod_mass
+
+    rows, = (candidates.var_sites >= 0).nonzero()
+    masses[rows, candidates.var_sites[rows] + 1] += \
+        candidates.var_masses[rows]
+
+    masses[:, 1:max_len + 1] += peptides.residue_masses(codes)
+    return masses, lengths
+
+
+def decoy_candidate_peptides(decoys: DecoyPeptides,
+                             candidates: DecoyCandidates,
+                             positions: Optional[np.ndarray] = None) \
+        -> List[Peptide]:
+    """
+    Constructs the peptides for the decoy candidates.
+
     Args:
+        decoys (DecoyPeptides): The decoy peptides.
+        candidates (DecoyCandidates): The decoy candidates.
+        positions (numpy.ndarray, optional): The positions of the
+                                             candidates for which to
+                                             construct peptides. Defaults
+                                             to all candidates.
+
+    Returns:
+        List of candidate peptides.
+
     """
-    candidates = []
-    for charge in range(2, 5):
-        pep_mass = peptide_mz * charge
-        tol = tol_factor * charge
-
-        # start and end are the beginning and ending indices of
-        # the slices within which the pep_mass (with a tolerance)
-        # falls
-        start = slices.idxs[bisect_left(slices.bounds, pep_mass - 1)]
-        end = slices.idxs[
-            min(bisect_left(slices.bounds, pep_mass + 1),
-                len(slices.idxs) - 1)]
-
-        # Find the decoy sequences which fall within the tolerance
-        seq_idxs, = np.asarray(
-            (decoys.masses[start:end] <= pep_mass + tol) &
-            (decoys.masses[start:end] >= pep_mass - tol)).nonzero()
-        # Shift the indices by the starting index
-        seq_idxs += start
-
-        # Add candidate decoy peptides
-        candidates.extend(
-            [Peptide(decoys.seqs[decoys.idxs[idx]], charge, decoys.mods[idx])
-             for idx in seq_idxs])
-
-        # Get new start and end indices accounting for variable
-        # PTM masses
-        start = slices.idxs[max(
-            bisect_left(slices.bounds, pep_mass - var_ptms.max_mass - 1) - 1,
-            0)]
-        end = slices.idxs[
-            min(bisect_left(slices.bounds, pep_mass - var_ptms.min_mass + 1),
-                len(slices.idxs) - 1)]
-
-        # Subset the general decoy lists for the given slice ranges
-        r_mods = decoys.mods[start:end]
-        r_masses = decoys.masses[start:end]
-        r_seqs = [decoys.seqs[idx] for idx in decoys.idxs[start:end]]
-        r_var_idxs = [decoys.var_idxs[idx] for idx in decoys.idxs[start:end]]
-
-        for res, _masses in var_ptms.masses.items():
-            for mass in _masses:
-                # Find the decoy sequences within the tolerance
-                seq_idxs, = np.asarray((r_masses >= pep_mass - tol - mass) &
-                                       (r_masses <= pep_mass + tol - mass))\
-                                       .nonzero()
-
-                # Find the indices of res in the sequences
-                seq_res_idxs = [(ii, jj) for ii in seq_idxs
-                                for jj in r_var_idxs[ii]
-                                if r_seqs[ii][jj] == res]
-
-                candidates.extend([
-                    Peptide(r_seqs[ii],
-                            charge, r_mods[ii] +
-                            [ModSite(mass, jj + 1, None)])
-                    for ii, jj in seq_res_idxs])
-
-    return candidates
-
-
-def count_matched_ions(peptide: Peptide,
-                       spectrum: mass_spectrum.Spectrum) -> int:
+    if positions is None:
+        positions = np.arange(len(candidates.idxs))
+
+    peps = []
+    for idx, charge, var_mass, var_site in zip(
+            candidates.idxs[positions].tolist(),
+            candidates.charges[positions].tolist(),
+            candidates.var_masses[positions].tolist(),
+            candidates.var_sites[positions].tolist()):
+        seq, mods = decoy_peptide(decoys, idx)
+        if var_site >= 0:
+            mods.append(ModSite(var_mass, var_site + 1, None))
+        peps.append(Peptide(seq, charge, mods))
+    return peps
+
+
+def count_matched_ions(decoys: DecoyPeptides, candidates: DecoyCandidates,
+                       spectrum: mass_spectrum.Spectrum,
+                       tol: float = 0.2) -> np.ndarray:
     """
-    Fragments the peptide and counts the number of ions matched against
-    the given spectrum.
+    Fragments the decoy candidates and counts, for each, the number of
+    spectrum peaks matched by its b/y ions.
+
+    The ions of all candidates are located in the spectrum at once: each
+    ion matches the contiguous range of peaks within tol of it, and since the
+    ions of each candidate are sorted, the ranges are non-decreasing and the
+    size of their union is found from the overlap with the previous range.
 
     Args:
-        peptide (pepfrag.Peptide): The peptide to fragment.
+        decoys (DecoyPeptides): The decoy peptides.
+        candidates (DecoyCandidates): The decoy candidates to fragment.
         spectrum (Spectrum): The spectrum against which to match ions.
+        tol (float, optional): The m/z tolerance for matching.
 
     Returns:
-        integer: The number of matching ions between the peptide fragments
-                 and the mass spectrum.
+        numpy.ndarray: The number of peaks matched by each candidate.
 
     """
-    ion_mzs = peptides.get_by_ion_mzs(peptide)
-    bisect_idxs = [bisect_left(ion_mzs, mz) for mz in spectrum.mz]
-    return len(
-        [idx for idx, mz in zip(bisect_idxs, list(spectrum.mz))
-         if (idx > 0 and mz - ion_mzs[idx - 1] <= 0.2) or
-         (idx < len(ion_mzs) and ion_mzs[idx] - mz <= 0.2)])
+    num_cands = len(candidates.idxs)
+    ion_mzs, offsets = peptides.get_by_ion_mzs_from_masses(
+        *decoy_candidate_masses(decoys, candidates), candidates.charges)
+    mzs = spectrum.mz
+    starts = mzs.searchsorted(ion_mzs - tol, side="left")
+    ends = mzs.searchsorted(ion_mzs + tol, side="right")
+
+    # Exclude the peaks already matched by the previous ion of the candidate
+    prev_ends = np.empty_like(ends)
+    prev_ends[1:] = ends[:-1]
+    prev_ends[offsets[:-1][np.diff(offsets) > 0]] = 0
+    new_peaks = np.maximum(ends - np.maximum(starts, prev_ends), 0)
+
+    cand_idxs = np.repeat(np.arange(num_cands), np.diff(offsets))
+    return np.bincount(cand_idxs, weights=new_peaks,
+                       minlength=num_cands).astype(np.int64)
 
 
 def write_results(output_file: str, psms: Sequence[PSM],
@@ -225,17 +364,19 @@ def write_results(output_file: str, psms: Sequence[PSM],
             writer.writerow(row)
 
 
-def decoy_features(decoy_peptide: Peptide, spec: mass_spectrum.Spectrum,
-                   target_mod: str,
+def decoy_features(decoy_peptide: Peptide,
+                   decoy_anns: Dict[str, mass_spectrum.Annotation],
+                   spec: mass_spectrum.Spectrum, target_mod: Optional[str],
                    proteolyzer: proteolysis.Proteolyzer) -> Features:
     """
     Calculates the PSM features for the decoy peptide and spectrum
-    combination. This function is defined here in order to be picklable
-    for multiprocessing.
+    combination, given the annotations of the spectrum by the decoy peptide.
+    This function is defined here in order to be picklable for
+    multiprocessing.
 
     """
-    return PSM(None, None, decoy_peptide, spectrum=copy.deepcopy(spec))\
-        .extract_features(target_mod, proteolyzer)
+    return PSM(None, None, decoy_peptide, spectrum=spec)\
+        .extract_features(target_mod, proteolyzer, anns=decoy_anns)
 
 
 def get_fdr_threshold(
@@ -302,10 +443,10 @@ class Validator(validator_base.ValidateBase):
         logging.info("Reading UniProt PTM file")
         self.uniprot = readers.read_uniprot_ptms(self.config.uniprot_ptm_file)
 
-        # Generate the full decoy protein sequence database file
+        # Generate the full decoy peptide table
         logging.info("Generating decoy database")
-        self.decoy_db_path = generate_decoys.generate_decoy_file(
-            self.config.target_db_path, self.proteolyzer)
+        self.decoy_db_path = generate_decoys.generate_decoy_table(
+            self.config.target_db_path, self.proteolyzer, pool=self.pool)
 
         # Cache these config options since they are used regularly
         self.target_residues = self.config.target_residues
@@ -319,9 +460,6 @@ class Validator(validator_base.ValidateBase):
         self.model = None
         self.mod_features = None
 
-        # Used for multiprocessing throughout the class methods
-        self.pool = mp.Pool()
-
     def validate(self):
         """
         Validates the identifications in the input data files.
@@ -345,8 +483,7 @@ class Validator(validator_base.ValidateBase):
 
         # Calculate features for the unmodified peptide analogues
         logging.info("Calculating unmodified PSM features.")
-        for psm in tqdm.tqdm(self.unmod_psms):
-            psm.extract_features(None, self.proteolyzer)
+        self.calculate_features(self.unmod_psms, None)
 
         if os.path.exists(self.file_prefix + UNMOD_PSM_FILE):
             with open(self.file_prefix + UNMOD_PSM_FILE, "rb") as fh:
@@ -397,6 +534,7 @@ class Validator(validator_base.ValidateBase):
         # Calculate the highest similarity score for each target peptide
         self.psms = similarity.calculate_similarity_scores(
             self.psms, self.unmod_psms)
+        logging.info(f"Fragment ion cache: {FRAGMENT_CACHE}")
                                                            
     def _validate_modified(self) -> PSMContainer[PSM]:
         """
@@ -411,8 +549,7 @@ class Validator(validator_base.ValidateBase):
 
         # Calculate the PSM quality features for each PSM
         logging.info("Calculating PSM features.")
-        for psm in tqdm.tqdm(self.psms):
-            psm.extract_features(self.target_mod, self.proteolyzer)
+        self.calculate_features(self.psms, self.target_mod)
 
         logging.info(f"Total {len(self.psms)} identifications found.")
 
@@ -555,7 +692,7 @@ class Validator(validator_base.ValidateBase):
             The PSM objects, now with their associated mass spectra.
 
         """
-        all_spectra = self.read_mass_spectra()
+        all_spectra = self.read_mass_spectra(spec_ids=self.db_res)
         for set_id, spectra in all_spectra.items():
             for psm in self.psms:
                 if psm.data_id == set_id and psm.spec_id in spectra:
@@ -586,15 +723,9 @@ class Validator(validator_base.ValidateBase):
 
         # Generate the decoy sequences, including the target_mod if
         # target_residue is provided
-        decoys = self._generate_residue_decoys(target_res, fixed_aas)
+        decoys = self._generate_residue_decoys(target_res)
 
-        # Split the decoy mass range into slices of 500 peptides to optimize
-        # the search
-        slices = \
-            utilities.slice_list(decoys.masses,
-                                 nslices=int(len(decoys.masses) / 500))
-
-        msg = f"Generated {len(decoys.seqs)} random sequences"
+        msg = f"Generated {decoys.index.num_sequences} random sequences"
         if target_res is not None:
             msg += f" for target residue {target_res}"
         logging.info(msg)
@@ -610,7 +741,7 @@ class Validator(validator_base.ValidateBase):
         var_ptms = VarPTMs(var_ptm_masses, var_ptm_max, var_ptm_min)
 
         def _match_decoys(peptide_mz, tol_factor):
-            return match_decoys(peptide_mz, decoys, slices, var_ptms,
+            return match_decoys(peptide_mz, decoys, var_ptms,
                                 tol_factor=tol_factor)
 
         pep_strs = [peptides.merge_seq_mods(psm.seq, psm.mods)
@@ -652,56 +783,63 @@ class Validator(validator_base.ValidateBase):
                 if not spectra:
                     continue
 
-                # Extract the spectrum with the highest base peak intensity
+                # Extract the spectrum with the highest base peak intensity.
+                # Feature extraction no longer normalizes the spectra in
+                # place, so this compares the raw base peaks, rather than
+                # always taking the first spectrum as when every base peak
+                # had been normalized to 1
                 max_spec = max(spectra, key=operator.itemgetter(1))[0]
 
-                # Generate decoy candidate peptides by searching the mass
-                # slices
+                # Generate decoy candidate peptides by searching the decoy
+                # masses
                 logging.info("Starting search")
                 d_candidates = _match_decoys(pep_mz, tol_factor=0.01)
-                logging.info(f"{len(d_candidates)} found")
+                logging.info(f"{len(d_candidates.idxs)} found")
 
-                if len(d_candidates) < 1000:
+                if len(d_candidates.idxs) < 1000:
                     # Search again using a larger mass tolerance
                     d_candidates = _match_decoys(pep_mz, tol_factor=0.1)
 
-                if not d_candidates:
+                if not len(d_candidates.idxs):
                     continue
 
                 # Find the number of matched ions in the spectrum per decoy
                 # peptide candidate
-                _count_matched_ions = functools.partial(count_matched_ions,
-                                                        spectrum=max_spec)
-                cand_num_ions =\
-                   self.pool.map(_count_matched_ions, d_candidates)
-                #cand_num_ions = [count_matched_ions(dc, max_spec) for dc in d_candidates]
-
-                # Order the decoy matches by the number of ions matched
-                sorted_idxs: List[int] = sorted(
-                    range(len(cand_num_ions)),
-                    key=lambda k, cand_ions=cand_num_ions: cand_ions[k],
-                    reverse=True)
+                cand_num_ions = count_matched_ions(decoys, d_candidates,
+                                                   max_spec)
+
+                # Order the decoy matches by the number of ions matched,
+                # retaining the candidate order for ties
+                sorted_idxs = np.argsort(-cand_num_ions, kind="stable")
 
                 # Keep only the top 1000 decoy candidates in terms of the
-                # the number of ions matched
-                d_candidates = [d_candidates[jj] for jj in sorted_idxs[:1000]]
+                # the number of ions matched, constructing their peptides
+                d_candidates = decoy_candidate_peptides(
+                    decoys, d_candidates, sorted_idxs[:1000])
+
+                # The theoretical ions of the candidates are shared by all of
+                # the spectra. These are generated in-process, so that they
+                # are retained in FRAGMENT_CACHE for later lookups rather
+                # than in the caches of the worker processes
+                cand_ions = [get_fragment_ions(p) for p in d_candidates]
+                cand_batch = batch_fragment_ions(cand_ions)
 
                 # For each spectrum, find the top matching decoy peptide
                 # and calculate the features for the match
                 logging.warning(f"Candidates {len(d_candidates)}, spectra {len(spectra)}")
                 for jj, (spec, _, idx) in enumerate(spectra):
-                    _decoy_features = functools.partial(
-                        decoy_features, spec=spec,
-                        target_mod=self.target_mod if target_res is not None
-                        else None,
-                        proteolyzer=self.proteolyzer)
-                    dpsm_vars = self.pool.map(_decoy_features, d_candidates)
-
-                    # Find the decoy candidate with the highest MatchScore
-                    max_match = max(dpsm_vars,
-                                    key=lambda k: k.MatchScore
-                                                  if k.MatchScore is not None
-                                                  else -1)
+                    # Screen the candidates using only their MatchScores,
+                    # taking the first candidate with the highest score
+                    best = int(np.argmax(calculate_match_scores(
+                        d_candidates, spec, cand_batch)))
+                    d_peptide = d_candidates[best]
+
+                    # Calculate the full features for the best candidate only
+                    max_match = decoy_features(
+                        d_peptide, spec.annotate_many([cand_ions[best]])[0],
+                        spec,
+                        self.target_mod if target_res is not None else None,
+                        self.proteolyzer)
 
                     # If the decoy ID is better than the one already assigned
                     # to the PSM, then replace it
@@ -709,108 +847,178 @@ class Validator(validator_base.ValidateBase):
                     if (psm.decoy_id is None or
                             psm.decoy_id.features.MatchScore <
                             max_match.MatchScore):
-                        d_peptide = d_candidates[dpsm_vars.index(max_match)]
                         psm.decoy_id = \
                             DecoyID(d_peptide.seq, d_peptide.charge,
                                     d_peptide.mods, max_match)
 
         return psms
 
-    def _generate_residue_decoys(self, target_res: Optional[str],
-                                 fixed_aas: List[str]) -> DecoyPeptides:
+    def _generate_residue_decoys(
+            self, target_res: Optional[str]) -> DecoyPeptides:
         """
         Generate the base decoy peptides with fixed modifications applied,
-        including the target modification at target_res if specified.
+        including the target modification at target_res if specified. The
+        decoy peptides are read from the persistent index for the database
+        and modification configuration, which is built if necessary.
 
         Args:
             target_res (str): The target (fixed) residue. If None, all
                               residues not contained in self.fixed_residues
                               are subject to variable modifications.
-            fixed_aas (list): The amino acid residues which should bear fixed
-                              modifications.
 
         Returns:
             DecoyPeptides
 
         """
-        # Generate list of decoy peptides containing the residue of interest
-        seqs = get_decoys(self.decoy_db_path, target_res)
-
-        # Extract the indices of the residues in the decoy peptides which are
-        # not modified by a fixed modification
-        var_idxs = [
-            [idx for idx, res in enumerate(seq) if res not in fixed_aas]
-            for seq in seqs]
+        fixed_mods = {res: self._get_mod_mass(mod)
+                      for res, mod in self.fixed_residues.items()}
+        mod_mass = self._get_mod_mass(self.target_mod)
+        index_path = os.path.join(
+            os.path.dirname(os.path.abspath(self.decoy_db_path)),
+            decoy_index.decoy_index_name(
+                self.config.target_db_path, self.decoy_db_path,
+                self.proteolyzer.enzyme, fixed_mods, self.target_mod,
+                mod_mass, target_res))
+
+        if decoy_index.DecoyIndex.exists(index_path):
+            logging.info(f"Using existing decoy index at {index_path}")
+        else:
+            logging.info(f"Building decoy index at {index_path}")
+            self._build_decoy_index(index_path, target_res)
+            decoy_index.prune_stale_indices(index_path)
 
-        idxs: List[int] = []
-        mods: List[List[ModSite]] = []
-        masses: List[float] = []
-        if target_res is not None:
-            # Find the sites of the target residue in the decoy peptides
-            res_idxs = [[idx for idx, res in enumerate(seq)
-                         if res == target_res]
-                        for seq in seqs]
+        return DecoyPeptides(decoy_index.DecoyIndex(index_path),
+                             self.gen_fixed_mods, *self._fixed_mod_masses(),
+                             mod_mass, self.target_mod)
 
-            # Apply the target modification to the decoy peptides
-            idxs, mods, masses = self.modify_decoys(seqs, res_idxs)
-        else:
-            # For unmodified analogues, apply the fixed modifications and
-            # calculate the peptide masses
-            idxs = list(range(len(seqs)))
-            for seq in seqs:
-                _mods = self.gen_fixed_mods(seq)
-                mods.append(_mods)
-                masses.append(FIXED_MASSES["H2O"] +
-                              sum(AA_MASSES[res].mono for res in seq) +
-                              sum(ms.mass for ms in _mods))
-
-        # Sort the sequence masses, indices and mods according to the
-        # sequence mass
-        masses, idxs, mods = utilities.sort_lists(0, masses, idxs, mods)
-
-        return DecoyPeptides(seqs, var_idxs, idxs, mods, np.array(masses))
-
-    def modify_decoys(self, seqs: List[str], res_idxs: List[List[int]])\
-            -> Tuple[List[int], List[List[ModSite]], List[float]]:
+    def _get_mod_mass(self, mod: str) -> float:
         """
-        Applies the target modification to the decoy peptide sequences.
+        Retrieves the mass of the modification from UniMod.
 
         Args:
-            seqs (list): The decoy peptide sequences.
-            res_idxs (list of lists): A list of the indices of the residue
-                                      targeted by the modification in the
-                                      peptide.
+            mod (str): The name of the modification.
+
+        Returns:
+            The modification mass.
+
+        Raises:
+            RuntimeError if the mass of the modification is unknown.
+
+        """
+        mass = self.unimod.get_mass(mod)
+        if mass is None:
+            logging.error(f"No mass found for modification {mod} - exiting.")
+            raise RuntimeError(f"No mass found for modification {mod}")
+        return mass
+
+    def _fixed_mod_masses(self) -> Tuple[np.ndarray, float]:
+        """
+        Constructs the masses of the fixed modifications.
 
         Returns:
-            tuple: (The indices of the decoy peptides,
-                    The modifications applied to the decoy peptide,
-                    The masses of the decoy peptides)
+            Tuple of (fixed modification masses indexed by the ASCII code of
+            the residue, N-terminal fixed modification mass).
+
+        """
+        fixed_masses = np.zeros(256, dtype=np.float64)
+        for res, mod in self.fixed_residues.items():
+            if len(res) == 1:
+                fixed_masses[ord(res)] = self._get_mod_mass(mod)
+        nterm_mod = self.fixed_residues.get("nterm", None)
+        nterm_mass = (self._get_mod_mass(nterm_mod)
+                      if nterm_mod is not None else 0.)
+        return fixed_masses, nterm_mass
+
+    def _build_decoy_index(self, index_path: str, target_res: Optional[str],
+                           chunk_size: int = 100000):
+        """
+        Builds the decoy index, containing the decoy peptides with the target
+        modification applied to each combination of up to
+        decoy_index.MAX_TARGET_SITES instances of target_res, or the
+        unmodified decoy peptides if target_res is None, sorted by mass.
+
+        Args:
+            index_path (str): The path at which to write the index.
+            target_res (str): The target (fixed) residue.
+            chunk_size (int, optional): The number of sequences for which to
+                                        calculate masses at once.
 
         """
-        decoy_idxs: List[int] = []
-        decoy_mods: List[List[ModSite]] = []
-        decoy_seq_masses: List[float] = []
-        for ii, seq in enumerate(seqs):
-            # Calculate the mass of the decoy sequence and construct the
-            # modifications
-            mods = self.gen_fixed_mods(seq)
-            mass = (FIXED_MASSES["H2O"] +
-                    sum(AA_MASSES[res].mono for res in seq) +
-                    sum(ms.mass for ms in mods))
-
-            target_idxs = res_idxs[ii]
-            # Generate target modification combinations, up to a maximum of 3
-            # instances of the modification
-            for jj in range(min(len(target_idxs), 3)):
-                for idxs in itertools.combinations(target_idxs, jj + 1):
-                    decoy_idxs.append(ii)
-                    decoy_seq_masses.append(mass + self.mod_mass * len(idxs))
-                    decoy_mods.append(
-                        mods + [ModSite(self.mod_mass, kk + 1,
-                                        self.target_mod)
-                                for kk in idxs])
-
-        return decoy_idxs, decoy_mods, decoy_seq_masses
+        max_sites = decoy_index.MAX_TARGET_SITES
+
+        # Generate list of decoy peptides containing the residue of interest
+        seqs = sorted(get_decoys(self.decoy_db_path, target_res))
+
+        fixed_masses, nterm_mass = self._fixed_mod_masses()
+        mod_mass = self._get_mod_mass(self.target_mod)
+
+        seq_idxs, masses, target_sites, num_sites, combs = [], [], [], [], []
+        for start in range(0, len(seqs), chunk_size):
+            codes = peptides.encode_sequences(seqs[start:start + chunk_size])
+            chunk_idxs = np.arange(start, start + len(codes))
+
+            # Calculate the masses of the sequences with their fixed
+            # modifications, summing the residue and modification masses in
+            # sequence order
+            mod_masses = np.column_stack([
+                np.full(len(codes), nterm_mass), fixed_masses[codes]])
+            seq_masses = (
+                FIXED_MASSES["H2O"] +
+                np.cumsum(peptides.residue_masses(codes), axis=1)[:, -1]) + \
+                np.cumsum(mod_masses, axis=1)[:, -1]
+
+            if target_res is None:
+                # For unmodified analogues, only the fixed modifications are
+                # applied
+                seq_idxs.append(chunk_idxs)
+                masses.append(seq_masses)
+                target_sites.append(
+                    np.full((len(codes), max_sites), -1, dtype=np.int16))
+                num_sites.append(np.zeros(len(codes), dtype=np.int64))
+                combs.append(np.zeros(len(codes), dtype=np.int64))
+                continue
+
+            # Apply the target modification to each combination of the target
+            # residue sites, processing sequences with equal numbers of sites
+            # together
+            is_target = codes == ord(target_res)
+            seq_num_targets = is_target.sum(axis=1)
+            for num_targets in np.unique(seq_num_targets[seq_num_targets > 0]):
+                rows, = (seq_num_targets == num_targets).nonzero()
+                sites = is_target[rows].nonzero()[1].reshape(
+                    len(rows), num_targets)
+                for nsites in range(1, min(num_targets, max_sites) + 1):
+                    comb_idxs = np.array(list(itertools.combinations(
+                        range(num_targets), nsites)))
+                    ncombs = len(comb_idxs)
+                    comb_sites = np.full((len(rows), ncombs, max_sites), -1,
+                                         dtype=np.int16)
+                    comb_sites[:, :, :nsites] = sites[:, comb_idxs]
+
+                    seq_idxs.append(np.repeat(chunk_idxs[rows], ncombs))
+                    masses.append(np.repeat(
+                        seq_masses[rows] + mod_mass * nsites, ncombs))
+                    target_sites.append(comb_sites.reshape(-1, max_sites))
+                    num_sites.append(
+                        np.full(len(rows) * ncombs, nsites, dtype=np.int64))
+                    combs.append(np.tile(np.arange(ncombs), len(rows)))
+
+        def _concatenate(arrays, dtype, shape=(0,)):
+            return (np.concatenate(arrays) if arrays
+                    else np.empty(shape, dtype=dtype))
+
+        seq_idxs = _concatenate(seq_idxs, np.int64)
+        masses = _concatenate(masses, np.float64)
+        target_sites = _concatenate(target_sites, np.int16, (0, max_sites))
+
+        # Sort the decoy peptides by mass, retaining the order of sequence,
+        # number of target sites and site combination for ties
+        order = np.lexsort((_concatenate(combs, np.int64),
+                            _concatenate(num_sites, np.int64),
+                            seq_idxs, masses))
+
+        decoy_index.DecoyIndex.write(index_path, seqs, seq_idxs[order],
+                                     masses[order], target_sites[order])
 
     def gen_fixed_mods(self, seq: str) -> List[ModSite]:
         """
@@ -6,29 +6,39 @@ retrieval pathways.
 """
 
 import collections
+import contextlib
 import copy
 import functools
+import hashlib
 import itertools
 import logging
 import math
+import multiprocessing as mp
+import multiprocessing.pool
 import operator
 import os
-import pickle
+import shutil
 import sys
-from typing import Dict, Iterable, List, Sequence, Tuple
+from typing import (Any, Dict, Iterable, List, Mapping, Optional, Sequence,
+                    Set, Tuple)
 
+import numpy as np
 import tqdm
 
 from pepfrag import ModSite, Peptide
 
+from .fragment_cache import get_fragment_ions
 from . import lda
 from . import mass_spectrum
 from . import peptides
 from . import proteolysis
-from .peptide_spectrum_match import PSM, UnmodPSM
+from .features import Features
+from .peptide_spectrum_match import PSM, UnmodPSM, extract_feature_matrix
 from .psm_container import PSMContainer
 from . import readers
+from . import spectra_index
 from . import spectra_readers
+from .spectrum_store import MergedSpectra, SpectrumStore
 
 
 @functools.lru_cache(maxsize=1024)
@@ -63,6 +73,230 @@ def site_probability(score: float, all_scores: Iterable[float]) -> float:
     return 1. / sum(math.exp(s) / math.exp(score) for s in all_scores)
 
 
+# Incremented whenever the preprocessing applied by read_spectra_file, or the
+# contents of the spectra cache shards, change, so that stale spectra cache
+# shards are re-parsed
+SPECTRA_PREPROCESSING_VERSION = 2
+
+SPECTRA_SHARD_SUFFIX = ".shard"
+
+
+def _shard_key(*values) -> str:
+    """
+    Hashes the values for use in a spectra cache shard name.
+
+    """
+    return hashlib.sha1(repr(values).encode()).hexdigest()
+
+
+def spectra_shard_name(spec_file: str, activation_method: Optional[str],
+                       activation_energy: Optional[float]) -> str:
+    """
+    Constructs the name of the spectra cache shard for the given file, keyed
+    by the file path, the file fingerprint and the preprocessing parameters,
+    so that a shard is invalidated whenever any of these changes. The shard
+    name begins with the key of the file path, followed by the key of the
+    file fingerprint, so that the shards of a changed file can be found.
+
+    Args:
+        spec_file (str): The path to the spectra file.
+        activation_method (str): The activation method by which to filter
+                                 spectra.
+        activation_energy (float): The activation energy by which to filter
+                                   spectra.
+
+    Returns:
+        The shard name.
+
+    """
+    return "-".join([
+        _shard_key(os.path.abspath(spec_file)),
+        _shard_key(spectra_index.file_fingerprint(spec_file)),
+        _shard_key(activation_method, activation_energy,
+                   SPECTRA_PREPROCESSING_VERSION)]) + SPECTRA_SHARD_SUFFIX
+
+
+class SpectraCoverage:
+    """
+    A class to record which spectra of a file have been read into its cache
+    shard: either all of the spectra, or those selected by spectrum ID and
+    precursor mass/charge ratio range. A selected spectrum is not necessarily
+    in the shard, since it may not exist or may be excluded by the activation
+    filters, but it is not necessary to read it again.
+
+    """
+
+    __slots__ = ("complete", "spec_ids", "prec_mz_ranges",)
+
+    def __init__(self, complete: bool = False,
+                 spec_ids: Optional[Iterable[str]] = None,
+                 prec_mz_ranges: Optional[
+                     Iterable[Tuple[float, float]]] = None):
+        """
+        Initializes the class.
+
+        Args:
+            complete (bool, optional): Whether all of the spectra have been
+                                       read.
+            spec_ids (iterable, optional): The IDs of the spectra which have
+                                           been read.
+            prec_mz_ranges (iterable, optional): The (lower, upper) precursor
+                                                 m/z ranges of the spectra
+                                                 which have been read.
+
+        """
+        self.complete = complete
+        self.spec_ids = set(spec_ids if spec_ids is not None else [])
+        self.prec_mz_ranges = spectra_readers.merge_ranges(
+            prec_mz_ranges if prec_mz_ranges is not None else [])
+
+    @classmethod
+    def from_store(cls, store: SpectrumStore) -> "SpectraCoverage":
+        """
+        Constructs the coverage recorded in the metadata of the shard.
+
+        """
+        return cls(**store.metadata.get("coverage", {}))
+
+    def to_metadata(self) -> Dict[str, Any]:
+        """
+        Constructs the metadata with which to write the shard.
+
+        """
+        return {"coverage": {"complete": self.complete,
+                             "spec_ids": sorted(self.spec_ids),
+                             "prec_mz_ranges": self.prec_mz_ranges}}
+
+    def missing(self, spec_ids: Iterable[str],
+                prec_mz_ranges: Sequence[Tuple[float, float]]) \
+            -> Tuple[List[str], List[Tuple[float, float]]]:
+        """
+        Finds the spectrum IDs and precursor m/z ranges of a selection which
+        have not yet been read.
+
+        Args:
+            spec_ids (iterable): The IDs of the selected spectra.
+            prec_mz_ranges (list): The (lower, upper) precursor m/z ranges of
+                                   the selected spectra.
+
+        Returns:
+            Tuple of (the spectrum IDs not yet read, the precursor m/z ranges
+            not contained within a range already read).
+
+        """
+        if self.complete:
+            return [], []
+
+        missing_ids = [spec_id for spec_id in spec_ids
+                       if spec_id not in self.spec_ids]
+
+        if not prec_mz_ranges or not self.prec_mz_ranges:
+            return missing_ids, list(prec_mz_ranges)
+
+        ranges = np.array(prec_mz_ranges, dtype=np.float64)
+        covered = np.array(self.prec_mz_ranges, dtype=np.float64)
+        # Since the covered ranges are merged, a selected range is covered
+        # only if it lies within the last covered range starting before it
+        idxs = covered[:, 0].searchsorted(ranges[:, 0], side="right") - 1
+        contained = (idxs >= 0) & \
+            (ranges[:, 1] <= covered[np.maximum(idxs, 0), 1])
+        return missing_ids, [prec_mz_ranges[ii] for ii in
+                             np.flatnonzero(~contained).tolist()]
+
+    def update(self, spec_ids: Iterable[str],
+               prec_mz_ranges: Iterable[Tuple[float, float]]):
+        """
+        Records that the spectra with the given IDs and precursor m/z ranges
+        have been read.
+
+        """
+        self.spec_ids.update(spec_ids)
+        self.prec_mz_ranges = spectra_readers.merge_ranges(
+            itertools.chain(self.prec_mz_ranges, prec_mz_ranges))
+
+
+def read_spectra_file(
+        spec_file: str, activation_method: Optional[str],
+        activation_energy: Optional[float],
+        spec_ids: Optional[Iterable[str]] = None,
+        spec_filter: Optional[spectra_readers.SpectrumFilter] = None) \
+        -> Dict[str, mass_spectrum.Spectrum]:
+    """
+    Reads the spectra from the given file and preprocesses them by
+    centroiding and removing iTRAQ reporter ion peaks. This function is
+    defined here in order to be picklable for multiprocessing.
+
+    Args:
+        spec_file (str): The path to the spectra file.
+        activation_method (str): The activation method by which to filter
+                                 spectra.
+        activation_energy (float): The activation energy by which to filter
+                                   spectra.
+        spec_ids (iterable, optional): The IDs of the spectra to read. If
+                                       provided, only these spectra are
+                                       decoded, using the offset index of
+                                       the file.
+        spec_filter (SpectrumFilter, optional): The filter by which to select
+                                                spectra during parsing.
+
+    Returns:
+        Dictionary mapping spectrum ID to preprocessed Spectrum.
+
+    """
+    spectra = spectra_readers.read_spectra_file(
+        spec_file,
+        spec_ids=spec_ids,
+        activation_method=activation_method,
+        activation_energy=activation_energy,
+        spec_filter=spec_filter)
+
+    # Preprocess all of the spectra in a single block
+    offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    np.cumsum([len(spec) for spec in spectra.values()], out=offsets[1:])
+    peaks, offsets = mass_spectrum.preprocess_peaks(
+        np.concatenate([spec[:, :2] for spec in spectra.values()])
+        if spectra else np.empty((0, 2)), offsets)
+
+    return {spec_id: mass_spectrum.Spectrum(
+                peaks[offsets[ii]:offsets[ii + 1]], spec.prec_mz,
+                spec.charge, retention_time=spec.retention_time)
+            for ii, (spec_id, spec) in enumerate(spectra.items())}
+
+
+def _read_spectra_file_job(
+        args: Tuple[str, Optional[str], Optional[float], Optional[List[str]],
+                    Optional[spectra_readers.SpectrumFilter]]) \
+        -> Dict[str, mass_spectrum.Spectrum]:
+    """
+    Unpacks the arguments to read_spectra_file, for use with Pool.imap.
+
+    """
+    return read_spectra_file(*args)
+
+
+# The compact form in which a PSM is sent to worker processes for feature
+# extraction: the peptide (sequence, charge, modifications) and the spectrum
+# (peaks, precursor m/z, precursor charge)
+FeaturePayload = Tuple[Tuple[str, int, Tuple[ModSite, ...]],
+                       Tuple[np.ndarray, Optional[float], Optional[int]]]
+
+
+def _extract_features_job(args: Tuple[
+        List[FeaturePayload], Optional[str], proteolysis.Proteolyzer]) \
+        -> np.ndarray:
+    """
+    Reconstructs the PSMs of a chunk of payloads and calculates their
+    feature matrix, for use with Pool.imap.
+
+    """
+    payloads, target_mod, proteolyzer = args
+    pairs = [(Peptide(seq, charge, list(mods)),
+              mass_spectrum.Spectrum(peaks, prec_mz, spec_charge))
+             for (seq, charge, mods), (peaks, prec_mz, spec_charge)
+             in payloads]
+    return extract_feature_matrix(pairs, target_mod, proteolyzer)
+
+
 class ValidateBase():
     """
     A base class to contain common attributes and methods for validation and
@@ -126,6 +360,55 @@ class ValidateBase():
 
         self.file_prefix = f"{output_dir}/{path_str}_"
 
+        # Used for multiprocessing throughout the class methods, until close
+        # is called
+        self.pool = mp.Pool()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Shuts down the worker processes of the multiprocessing pool, waiting
+        for any outstanding tasks to complete.
+
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def calculate_features(self, psms: Sequence[PSM],
+                           target_mod: Optional[str],
+                           chunk_size: int = 500):
+        """
+        Calculates the features of the PSMs in parallel, sending chunks of
+        compact PSM payloads to the pool and setting the returned feature
+        rows on the PSMs in order.
+
+        Args:
+            psms (list): The PSMs, which must have assigned spectra.
+            target_mod (str): The modification type under validation, or
+                              None for unmodified analogues.
+            chunk_size (int, optional): The number of PSMs per job.
+
+        """
+        payloads: List[FeaturePayload] = []
+        for psm in psms:
+            psm._check_spectrum_initialized()
+            spec = psm.spectrum
+            payloads.append(((psm.seq, psm.charge, tuple(psm.mods)),
+                             (spec[:], spec.prec_mz, spec.charge)))
+
+        jobs = [(payloads[ii:ii + chunk_size], target_mod, self.proteolyzer)
+                for ii in range(0, len(payloads), chunk_size)]
+        rows = itertools.chain.from_iterable(tqdm.tqdm(
+            self.pool.imap(_extract_features_job, jobs), total=len(jobs)))
+
+        for psm, row in zip(psms, rows):
+            psm.features = Features.from_array(row)
+
     def identify_benchmarks(self, psms: Sequence[PSM]):
         """
         Labels the PSMs which are in the benchmark set of peptides.
@@ -140,11 +423,21 @@ class ValidateBase():
                 psm.benchmark = (peptides.merge_seq_mods(psm.seq, psm.mods)
                                  in benchmarks)
 
-    def _find_unmod_analogues(self, mod_psms: Sequence[PSM]) \
+    def _find_unmod_analogues(
+            self, mod_psms: Sequence[PSM],
+            all_spectra: Optional[
+                Dict[str, Mapping[str, mass_spectrum.Spectrum]]] = None) \
             -> PSMContainer[UnmodPSM]:
         """
         Finds the unmodified analogues in the database search results.
 
+        Args:
+            mod_psms (list): The modified PSMs.
+            all_spectra (dict, optional): The mass spectra, keyed by data set
+                                          ID and then spectrum ID. If None,
+                                          the spectra of the database search
+                                          results are read.
+
         Returns:
             PSMContainer of UnmodPSMs.
 
@@ -177,7 +470,8 @@ class ValidateBase():
             psm_info[(merge_peptide_sequence(psm.seq, tuple(mods)),
                       psm.charge)].append((psm, mods))
 
-        all_spectra = self.read_mass_spectra()
+        if all_spectra is None:
+            all_spectra = self.read_mass_spectra(spec_ids=self.db_res)
 
         for data_id, data in self.db_res.items():
             logging.info(f"Processing data set {data_id}.")
@@ -246,7 +540,7 @@ class ValidateBase():
         return new_mods
 
     def _localize(self, psms: List[PSM], lda_model: lda.CustomPipeline,
-                  features: Iterable[str], spd_prob_threshold: float,
+                  features: Sequence[str], spd_prob_threshold: float,
                   sim_threshold: float):
         """
         For peptide identifications with multiple possible modification sites,
@@ -279,6 +573,7 @@ class ValidateBase():
 
             isoform_scores = {}
 
+            isoforms = []
             for mod_comb in itertools.combinations(target_idxs, mod_count):
                 # Construct a new PSM with the given combination of modified
                 # sites
@@ -291,12 +586,23 @@ class ValidateBase():
                         ModSite(
                             self.mod_mass, idx + 1, self.target_mod))
 
-                # Compute the PSM features using the new modification site(s)
-                new_psm.extract_features(self.target_mod, self.proteolyzer)
+                isoforms.append(new_psm)
 
-                # Get the target score for the new PSM
-                isoform_scores[new_psm] = lda_model.decide_predict(
-                    PSMContainer([new_psm]).to_df()[features])[0, 0]
+            # Annotate the spectrum with all of the isoforms at once
+            isoform_anns = psm.spectrum.annotate_many(
+                [get_fragment_ions(new_psm.peptide) for new_psm in isoforms])
+
+            # Compute the PSM features using the new modification site(s)
+            isoform_features = extract_feature_matrix(
+                [(new_psm.peptide, new_psm.spectrum)
+                 for new_psm in isoforms],
+                self.target_mod, self.proteolyzer, anns=isoform_anns)
+            for new_psm, row in zip(isoforms, isoform_features):
+                new_psm.features = Features.from_array(row)
+
+            # Get the target scores for the new PSMs
+            isoform_scores.update(zip(
+                isoforms, lda.calculate_scores(lda_model, isoforms, features)))
 
             all_scores = list(isoform_scores.values())
 
@@ -330,52 +636,175 @@ class ValidateBase():
                     break
         return PSMContainer(new_psms)
 
-    def read_mass_spectra(self) -> \
-            Dict[str, Dict[str, mass_spectrum.Spectrum]]:
+    def read_mass_spectra(
+            self,
+            spec_ids: Optional[Mapping[str, Iterable[str]]] = None,
+            prec_mz_ranges: Optional[Iterable[Tuple[float, float]]] = None) \
+            -> Dict[str, Mapping[str, mass_spectrum.Spectrum]]:
         """
-        Reads the mass spectra from the configured spectra_files.
+        Reads the mass spectra from the configured spectra_files. The
+        spectra of each file are cached in a columnar SpectrumStore shard,
+        from which they are returned as memory-mapped views.
+
+        If spec_ids and/or prec_mz_ranges are provided, only the spectra
+        selected by either are read and returned, i.e. the spectra whose IDs
+        are given for their data set, or whose precursor m/z falls within any
+        of the ranges. Otherwise, all spectra are read and returned. The
+        spectra which have not been selected are skipped while parsing, and
+        the spectra read are added to those already in the shard, so that
+        later selections need only parse the spectra not yet read.
+
+        Args:
+            spec_ids (dict, optional): A mapping of data set ID to the IDs of
+                                       the spectra to read.
+            prec_mz_ranges (list, optional): The (lower, upper) precursor m/z
+                                             ranges of the spectra to read.
 
         Returns:
-            Dictionary mapping data set ID to spectra (dict).
+            Dictionary mapping data set ID to spectra (mapping of spectrum ID
+            to Spectrum).
 
         """
-        cache_file = (self.config.spectra_cache_file
-                      if self.config.spectra_cache_file is not None
-                      else f"{self.file_prefix}spectra")
-        if os.path.exists(cache_file):
-            logging.info(f"Using cached mass spectra at {cache_file}")
-            with open(cache_file, "rb") as fh:
-                try:
-                    return pickle.load(fh)
-                except EOFError:
-                    logging.warn(
-                        "Mass spectra cache empty - re-reading spectra")
-
-        all_spectra = {}
-        for data_conf_id, data_conf in tqdm.tqdm(
-                self.config.data_sets.items()):
-            for spec_file in tqdm.tqdm(
-                    data_conf["spectra_files"],
-                    desc=f"Processing {data_conf_id}"):
+        cache_dir = (self.config.spectra_cache_file
+                     if self.config.spectra_cache_file is not None
+                     else f"{self.file_prefix}spectra")
+        if os.path.isfile(cache_dir):
+            # This may be a legacy pickled spectra cache, but the path is
+            # configurable, so the file is not removed
+            raise FileExistsError(
+                f"The mass spectra cache location {cache_dir} is a file, but "
+                "must be a directory. Remove the file, e.g. a legacy pickled "
+                "spectra cache, or configure another spectra_cache_file")
+        os.makedirs(cache_dir, exist_ok=True)
+
+        select = spec_ids is not None or prec_mz_ranges is not None
+        prec_mz_ranges = (list(prec_mz_ranges)
+                          if prec_mz_ranges is not None else [])
+
+        # Each spectra file is cached in its own shard, so that only new or
+        # modified files, or newly selected spectra, need to be parsed. A
+        # file may be configured in more than one data set, in which case
+        # the IDs selected for each are read into the same shard
+        spec_files: List[Tuple[str, str, str]] = []
+        shard_files: Dict[str, str] = {}
+        shard_ids: Dict[str, Set[str]] = {}
+        for data_conf_id, data_conf in self.config.data_sets.items():
+            for spec_file in data_conf["spectra_files"]:
                 spec_file_path = os.path.join(data_conf["data_dir"], spec_file)
 
                 if not os.path.isfile(spec_file_path):
                     raise FileNotFoundError(
                         f"Spectra file {spec_file_path} not found")
 
-                spectra = spectra_readers.read_spectra_file(
-                    spec_file_path,
-                    activation_method=self.config.activation_mode,
-                    activation_energy=self.config.activation_energy)
-
-                for _, spec in spectra.items():
-                    spec.centroid().remove_itraq()
-
-                all_spectra[data_conf_id] = spectra
-
-        # Save the spectra to the cache file
-        logging.info(f"Writing mass spectra to cache at {cache_file}")
-        with open(cache_file, "wb") as fh:
-            pickle.dump(all_spectra, fh)
-
-        return all_spectra
+                shard = os.path.join(
+                    cache_dir,
+                    spectra_shard_name(spec_file_path,
+                                       self.config.activation_mode,
+                                       self.config.activation_energy))
+                spec_files.append((data_conf_id, spec_file_path, shard))
+                shard_files[shard] = spec_file_path
+                shard_ids.setdefault(shard, set()).update(
+                    spec_ids.get(data_conf_id, [])
+                    if spec_ids is not None else [])
+
+        jobs: Dict[str, Tuple[str, Optional[str], Optional[float],
+                              Optional[List[str]],
+                              Optional[spectra_readers.SpectrumFilter]]] = {}
+        coverages: Dict[str, SpectraCoverage] = {}
+        for shard, spec_file_path in shard_files.items():
+            store = (SpectrumStore(shard) if SpectrumStore.exists(shard)
+                     else None)
+            coverage = (SpectraCoverage.from_store(store)
+                        if store is not None else SpectraCoverage())
+            read_ids: Optional[List[str]] = None
+            spec_filter: Optional[spectra_readers.SpectrumFilter] = None
+            if not select:
+                if coverage.complete:
+                    continue
+                coverage = SpectraCoverage(complete=True)
+            else:
+                # The spectra already in the shard need not be read again
+                missing_ids, missing_ranges = coverage.missing(
+                    shard_ids[shard] - set(
+                        store.spec_ids.tolist() if store is not None
+                        else []),
+                    prec_mz_ranges)
+                if not missing_ids and not missing_ranges:
+                    continue
+                if missing_ranges:
+                    spec_filter = spectra_readers.SpectrumFilter(
+                        missing_ids, missing_ranges)
+                else:
+                    # Spectra selected only by ID are decoded directly using
+                    # the offset index of the file, without parsing the rest
+                    read_ids = missing_ids
+                coverage.update(missing_ids, missing_ranges)
+            jobs[shard] = (spec_file_path, self.config.activation_mode,
+                           self.config.activation_energy, read_ids,
+                           spec_filter)
+            coverages[shard] = coverage
+
+        to_read = list(jobs)
+        logging.info(f"Using cached mass spectra at {cache_dir} for "
+                     f"{len(shard_files) - len(to_read)} of "
+                     f"{len(shard_files)} files")
+
+        # The files are read using the shared pool by default, or a pool of
+        # the configured number of worker processes
+        workers = self.config.spectra_workers
+        with contextlib.ExitStack() as stack:
+            pool: Optional[mp.pool.Pool] = None
+            if workers != 1 and len(to_read) > 1:
+                pool = (self.pool if workers is None else stack.enter_context(
+                    mp.Pool(min(workers, len(to_read)))))
+
+            results = (pool.imap if pool is not None else map)(
+                _read_spectra_file_job, [jobs[shard] for shard in to_read])
+            for shard, spectra in zip(
+                    to_read, tqdm.tqdm(results, total=len(to_read))):
+                spec_file_path = shard_files[shard]
+                # Newly selected spectra are added to those already cached
+                if not coverages[shard].complete and \
+                        SpectrumStore.exists(shard):
+                    spectra = {
+                        **SpectrumStore(shard).data_sets().get(
+                            spec_file_path, {}),
+                        **spectra}
+                SpectrumStore.write(shard, {spec_file_path: spectra},
+                                    metadata=coverages[shard].to_metadata())
+
+        # Remove the shards of the configured files which have since changed.
+        # The shards of other files are retained, since the cache directory
+        # may be shared with other configurations
+        current_files = dict(os.path.basename(shard).split("-")[:2]
+                             for shard in shard_files)
+        for entry in os.listdir(cache_dir):
+            if not entry.endswith(SPECTRA_SHARD_SUFFIX):
+                continue
+            path_key, file_key = entry.split("-")[:2]
+            if (path_key in current_files and
+                    file_key != current_files[path_key]):
+                shutil.rmtree(os.path.join(cache_dir, entry),
+                              ignore_errors=True)
+
+        # The spectra of each data set are merged in the configured file
+        # order, with later files taking precedence for duplicate IDs
+        file_spectra: Dict[str, List[Mapping[str, mass_spectrum.Spectrum]]] \
+            = {data_conf_id: [] for data_conf_id in self.config.data_sets}
+        for data_conf_id, path, shard in spec_files:
+            store = SpectrumStore(shard)
+            selected = None
+            if select:
+                index = store.index()
+                selected = np.unique(np.concatenate(
+                    [index.select_ids(
+                        spec_ids.get(data_conf_id, [])
+                        if spec_ids is not None else [])] +
+                    [index.select_prec_mz(lower, upper)
+                     for lower, upper in prec_mz_ranges])).tolist()
+            file_spectra[data_conf_id].append(
+                store.data_sets(selected).get(path, {}))
+
+        return {data_conf_id: (spectra[0] if len(spectra) == 1 else
+                               MergedSpectra(spectra))
+                for data_conf_id, spectra in file_spectra.items()}
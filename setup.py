@@ -27,6 +27,7 @@ setup(
         [
             c_rptmdetermine,
             os.path.join(PACKAGE_DIR, "binomial.pyx"),
+            os.path.join(PACKAGE_DIR, "denoise.pyx"),
             os.path.join(PACKAGE_DIR, "ionscore.pyx"),
         ],
         include_path=[
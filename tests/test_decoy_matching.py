@@ -0,0 +1,180 @@
+#! /usr/bin/env python3
+"""
+Tests for the vectorized decoy candidate matching and ion counting, checked
+against a brute-force scan of the decoy peptides and a per-candidate bisect
+count of the matched peaks.
+
+"""
+from bisect import bisect_left, bisect_right
+import itertools
+
+import numpy as np
+import pytest
+
+from pepfrag import IonType, ModSite, Peptide
+
+from rPTMDetermine import decoy_index
+from rPTMDetermine.mass_spectrum import Spectrum
+from rPTMDetermine.validator import (DecoyCandidates, DecoyPeptides, VarPTMs,
+                                     count_matched_ions,
+                                     decoy_candidate_peptides, match_decoys)
+
+
+RESIDUES = "ACDEFGHIKLMNPQRSTVWY"
+
+FIXED_MODS = {"nterm": 144.102063, "C": 57.021464}
+
+MOD_MASS = 79.966331
+
+VAR_PTMS = VarPTMs({"M": [15.994915], "K": [42.010565, 14.01565],
+                    "Y": [79.966331]},
+                   79.966331, 14.01565)
+
+
+def _fixed_mods(seq: str):
+    """
+    Generates the fixed modifications of the sequence, as
+    Validator.gen_fixed_mods.
+
+    """
+    return [ModSite(FIXED_MODS["nterm"], "nterm", "iTRAQ8plex")] + \
+        [ModSite(FIXED_MODS["C"], ii + 1, "Carbamidomethyl")
+         for ii, res in enumerate(seq) if res == "C"]
+
+
+@pytest.fixture(scope="module")
+def decoys(tmp_path_factory):
+    """
+    Builds a decoy index of random sequences, with the target modification
+    at up to decoy_index.MAX_TARGET_SITES serine residues, and a narrow
+    mass range so that the windows contain many decoys.
+
+    """
+    rng = np.random.default_rng(1)
+    seqs = sorted({"".join(rng.choice(list(RESIDUES), int(length)))
+                   for length in rng.integers(7, 16, 300)})
+
+    seq_idxs, masses, target_sites = [], [], []
+    for seq_idx, seq in enumerate(seqs):
+        s_sites = [ii for ii, res in enumerate(seq) if res == "S"]
+        for num_sites in range(min(len(s_sites),
+                                   decoy_index.MAX_TARGET_SITES) + 1):
+            for sites in itertools.combinations(s_sites, num_sites):
+                seq_idxs.append(seq_idx)
+                masses.append(rng.uniform(1000., 1100.))
+                target_sites.append(
+                    list(sites) +
+                    [-1] * (decoy_index.MAX_TARGET_SITES - num_sites))
+
+    order = np.argsort(masses)
+    path = str(tmp_path_factory.mktemp("decoys") / "index.decoyidx")
+    decoy_index.DecoyIndex.write(path, seqs, np.array(seq_idxs)[order],
+                                 np.array(masses)[order],
+                                 np.array(target_sites)[order])
+
+    fixed_masses = np.zeros(256, dtype=np.float64)
+    fixed_masses[ord("C")] = FIXED_MODS["C"]
+    return DecoyPeptides(decoy_index.DecoyIndex(path), _fixed_mods,
+                         fixed_masses, FIXED_MODS["nterm"], MOD_MASS,
+                         "Phospho")
+
+
+def brute_force_match(peptide_mz: float, decoys: DecoyPeptides,
+                      var_ptms: VarPTMs, tol_factor: float):
+    """
+    Scans every decoy peptide for each charge state and variable PTM mass,
+    in the order returned by match_decoys.
+
+    """
+    index = decoys.index
+    var_mods = [(None, 0.)] + [(res, mass)
+                               for res, _masses in var_ptms.masses.items()
+                               for mass in _masses]
+    candidates = []
+    for charge in range(2, 5):
+        pep_mass = peptide_mz * charge
+        tol = tol_factor * charge
+        for res, var_mass in var_mods:
+            for idx, mass in enumerate(index.masses.tolist()):
+                if not (pep_mass - tol - var_mass <= mass <=
+                        pep_mass + tol - var_mass):
+                    continue
+                if res is None:
+                    candidates.append((idx, charge, var_mass, -1))
+                    continue
+                seq = index.sequence(index.seq_idxs[idx])
+                candidates.extend([(idx, charge, var_mass, site)
+                                   for site, seq_res in enumerate(seq)
+                                   if seq_res == res])
+    return candidates
+
+
+def bisect_count(peptide: Peptide, mzs: np.ndarray, tol: float) -> int:
+    """
+    Counts the spectrum peaks within tol of any b/y ion of the peptide,
+    bisecting the sorted peak m/z values for each ion.
+
+    """
+    ions = [mass for mass, _, _ in peptide.fragment(
+        ion_types={IonType.b.value: [], IonType.y.value: []})]
+    mzs = mzs.tolist()
+    matched = set()
+    for ion in ions:
+        matched.update(range(bisect_left(mzs, ion - tol),
+                             bisect_right(mzs, ion + tol)))
+    return len(matched)
+
+
+def _candidate_tuples(candidates: DecoyCandidates):
+    return list(zip(candidates.idxs.tolist(), candidates.charges.tolist(),
+                    candidates.var_masses.tolist(),
+                    candidates.var_sites.tolist()))
+
+
+@pytest.mark.parametrize("tol_factor", [0.01, 0.5])
+def test_match_decoys(decoys, tol_factor):
+    rng = np.random.default_rng(2)
+    num_matched = 0
+    for peptide_mz in np.concatenate([rng.uniform(240., 560., 100),
+                                      [100., 2000.]]):
+        candidates = match_decoys(peptide_mz, decoys, VAR_PTMS,
+                                  tol_factor=tol_factor)
+        expected = brute_force_match(peptide_mz, decoys, VAR_PTMS,
+                                     tol_factor)
+        assert _candidate_tuples(candidates) == expected
+        num_matched += len(expected)
+    assert num_matched > 0
+
+
+def test_count_matched_ions(decoys):
+    rng = np.random.default_rng(3)
+    for peptide_mz in rng.uniform(260., 560., 20):
+        candidates = match_decoys(peptide_mz, decoys, VAR_PTMS,
+                                  tol_factor=0.5)
+        peps = decoy_candidate_peptides(decoys, candidates)
+        if not peps:
+            continue
+
+        # Place peaks at some of the ions of the candidates, so that
+        # overlapping ranges of matched peaks occur, amongst random peaks
+        ions = peps[0].fragment(
+            ion_types={IonType.b.value: [], IonType.y.value: []})
+        mzs = np.sort(np.concatenate([
+            rng.uniform(100., 1500., 200),
+            np.array([mass for mass, _, _ in ions]) +
+            rng.uniform(-0.3, 0.3, len(ions))]))
+        spectrum = Spectrum(
+            np.column_stack([mzs, rng.uniform(1., 100., len(mzs))]),
+            peptide_mz, 2)
+
+        for tol in [0.2, 1.]:
+            np.testing.assert_array_equal(
+                count_matched_ions(decoys, candidates, spectrum, tol=tol),
+                [bisect_count(pep, spectrum.mz, tol) for pep in peps])
+
+
+def test_count_matched_ions_empty(decoys):
+    candidates = match_decoys(100., decoys, VAR_PTMS)
+    assert len(candidates.idxs) == 0
+    spectrum = Spectrum(np.array([[150., 3.], [250., 2.]]), 100., 2)
+    assert count_matched_ions(decoys, candidates, spectrum).tolist() == []
@@ -0,0 +1,156 @@
+#! /usr/bin/env python3
+"""
+Tests for the compiled spectrum denoising, checked against the original
+pure Python implementation.
+
+"""
+from typing import List, Sequence
+
+import numpy as np
+import pytest
+
+from rPTMDetermine.mass_spectrum import Spectrum
+
+
+def reference_denoise(peaks: np.ndarray, assigned_peaks: Sequence[bool],
+                      max_peaks_per_window: int) -> List[int]:
+    """
+    The original Python implementation of Spectrum.denoise, retained as the
+    reference for the compiled version, including its treatment of the
+    final peak, which may be retained once per trailing window.
+
+    Args:
+        peaks (numpy.ndarray): The (m/z, intensity) peaks, sorted by m/z.
+        assigned_peaks (list): Whether each peak is annotated.
+        max_peaks_per_window (int): The maximum number of peaks to include
+                                    per 100 Da window.
+
+    Returns:
+        The denoised peak indexes.
+
+    """
+    npeaks = len(peaks)
+    n_windows = int((peaks[-1][0] - peaks[0][0]) / 100.) + 1
+    start_idx = 0
+    new_peaks: List[int] = []
+
+    for window in range(n_windows):
+        max_mass = peaks[0][0] + (window + 1) * 100.
+
+        for end_idx in range(start_idx, npeaks):
+            if peaks[end_idx][0] > max_mass:
+                break
+
+        if end_idx == start_idx:
+            if peaks[end_idx][0] <= max_mass and assigned_peaks[end_idx]:
+                new_peaks.append(end_idx)
+            continue
+
+        window_peaks = sorted(list(range(start_idx, end_idx)),
+                              key=lambda ii: peaks[ii][1],
+                              reverse=True)
+
+        ion_scores = [assigned_peaks[idx] for idx in window_peaks]
+
+        sum_scores = [sum(ion_scores[:idx])
+                      for idx in range(1, min(len(ion_scores) + 1,
+                                              max_peaks_per_window + 1))]
+
+        new_peaks += window_peaks[:sum_scores.index(max(sum_scores)) + 1]
+
+        start_idx = end_idx
+
+    return new_peaks
+
+
+def _check(peaks: np.ndarray, assigned_peaks: Sequence[bool],
+           max_peaks_per_window: int):
+    """
+    Asserts that Spectrum.denoise matches the reference implementation.
+
+    """
+    spectrum = Spectrum(peaks, 500., 2)
+    expected = reference_denoise(peaks, assigned_peaks, max_peaks_per_window)
+
+    indices, denoised = spectrum.denoise(list(assigned_peaks),
+                                         max_peaks_per_window)
+
+    assert indices == expected
+    np.testing.assert_array_equal(
+        denoised._peaks, Spectrum(peaks[expected, :], 500., 2)._peaks)
+
+
+WINDOW_SIZES = [1, 3, 8]
+
+
+@pytest.mark.parametrize("max_peaks_per_window", WINDOW_SIZES)
+def test_tied_intensities(max_peaks_per_window):
+    peaks = np.array([[100., 5.], [120., 5.], [150., 5.], [180., 2.],
+                      [190., 5.], [210., 2.], [250., 2.], [260., 2.]])
+    for assigned in ([False, True, False, True, True, False, True, False],
+                     [True, False, False, False, True, True, False, True],
+                     [False] * 8):
+        _check(peaks, assigned, max_peaks_per_window)
+
+
+@pytest.mark.parametrize("max_peaks_per_window", WINDOW_SIZES)
+def test_single_peak_windows(max_peaks_per_window):
+    # Windows containing one peak, as well as empty windows
+    peaks = np.array([[100., 10.], [250., 3.], [420., 8.], [430., 1.],
+                      [800., 4.], [1150., 6.]])
+    for assigned in ([True] * 6, [False] * 6,
+                     [True, False, True, False, True, False],
+                     [False, True, False, True, False, True]):
+        _check(peaks, assigned, max_peaks_per_window)
+
+
+@pytest.mark.parametrize("max_peaks_per_window", WINDOW_SIZES)
+def test_repeated_last_peak(max_peaks_per_window):
+    # Once the final peak is reached, it is retained for each remaining
+    # window if it is assigned. With the final peak on a window boundary it
+    # is reached before the last window and so is retained twice
+    peaks = np.array([[100., 1.], [110., 4.], [200., 2.], [300., 9.]])
+    assert reference_denoise(peaks, [True] * 4, max_peaks_per_window)[-2:] \
+        == [3, 3]
+    for assigned in ([False, True, False, True], [True, True, True, False],
+                     [False, False, False, True]):
+        _check(peaks, assigned, max_peaks_per_window)
+
+    peaks = np.array([[100., 1.], [110., 4.], [130., 2.], [420., 9.]])
+    for assigned in ([False, True, False, True], [False, False, False, True]):
+        _check(peaks, assigned, max_peaks_per_window)
+
+    _check(np.array([[100., 1.]]), [True], max_peaks_per_window)
+    _check(np.array([[100., 1.]]), [False], max_peaks_per_window)
+
+
+@pytest.mark.parametrize("max_peaks_per_window", WINDOW_SIZES)
+def test_random_spectra(max_peaks_per_window):
+    rng = np.random.default_rng(max_peaks_per_window)
+    for _ in range(200):
+        npeaks = int(rng.integers(1, 200))
+        mzs = np.sort(np.round(rng.uniform(100., 1500., npeaks),
+                               int(rng.integers(0, 3))))
+        # Few distinct intensities, so that ties are common
+        intensities = rng.integers(0, 5, npeaks).astype(float)
+        assigned = (rng.random(npeaks) < rng.random()).tolist()
+        _check(np.column_stack([mzs, intensities]), assigned,
+               max_peaks_per_window)
+
+
+@pytest.mark.parametrize("max_peaks_per_window", WINDOW_SIZES)
+def test_denoise_many(max_peaks_per_window):
+    rng = np.random.default_rng(max_peaks_per_window)
+    for _ in range(50):
+        npeaks = int(rng.integers(1, 200))
+        peaks = np.column_stack([
+            np.sort(np.round(rng.uniform(100., 1500., npeaks), 1)),
+            rng.integers(0, 5, npeaks).astype(float)])
+        assigned = rng.random((int(rng.integers(1, 20)), npeaks)) < 0.3
+        indices, offsets = Spectrum(peaks, 500., 2).denoise_many(
+            assigned, max_peaks_per_window)
+
+        assert len(offsets) == len(assigned) + 1
+        for ii, row in enumerate(assigned):
+            assert indices[offsets[ii]:offsets[ii + 1]].tolist() == \
+                reference_denoise(peaks, row.tolist(), max_peaks_per_window)
@@ -0,0 +1,159 @@
+#! /usr/bin/env python3
+"""
+Tests for the vectorized spectrum centroiding and iTRAQ reporter ion peak
+removal, checked against the original loop implementations.
+
+"""
+import operator
+
+import numpy as np
+import pytest
+
+from rPTMDetermine.constants import ITRAQ_MASSES
+from rPTMDetermine.mass_spectrum import (Spectrum, centroid_peaks,
+                                         itraq_mask, preprocess_peaks)
+
+
+def reference_centroid(peaks: np.ndarray) -> np.ndarray:
+    """
+    The original loop implementation of Spectrum.centroid, retained as the
+    reference for the vectorized version, applied to an (N, 2) array of
+    m/z-sorted peaks.
+
+    """
+    if len(peaks) <= 1:
+        return peaks
+
+    mz_diffs = np.diff(peaks[:, 0])
+
+    centroided = []
+    idx = 0
+    while idx < len(peaks):
+        peak = peaks[idx]
+        if idx >= len(mz_diffs):
+            centroided.append(peak)
+            break
+        diff = mz_diffs[idx]
+        if diff > 0.1:
+            centroided.append(peak)
+        else:
+            peak_cluster = [peak]
+            _diff = 0
+            while _diff <= 0.1:
+                idx += 1
+                peak = peaks[idx]
+                peak_cluster.append(peak)
+                if idx == len(mz_diffs):
+                    break
+                _diff = mz_diffs[idx]
+            if len({p[1] for p in peak_cluster}) == 1:
+                centroided.append(np.array(
+                    [sum(p[0] for p in peak_cluster) /
+                     float(len(peak_cluster)),
+                     peak_cluster[0][1]]))
+            else:
+                centroided.append(max(peak_cluster,
+                                      key=operator.itemgetter(1)))
+        idx += 1
+
+    return np.array(centroided)
+
+
+def reference_remove_itraq(peaks: np.ndarray, tol: float = 0.1) \
+        -> np.ndarray:
+    """
+    The original implementation of Spectrum.remove_itraq, applied to an
+    (N, 2) array of peaks.
+
+    """
+    return peaks[
+        (np.abs(np.subtract.outer(peaks[:, 0], ITRAQ_MASSES)) > tol).all(1)]
+
+
+def _random_peaks(rng, npeaks: int) -> np.ndarray:
+    """
+    Generates m/z-sorted peaks containing clusters of close peaks, tied
+    intensities and peaks close to the iTRAQ reporter ions.
+
+    """
+    mzs = np.sort(np.concatenate([
+        rng.uniform(100., 1000., npeaks),
+        rng.choice(ITRAQ_MASSES, npeaks // 4) +
+        rng.uniform(-0.15, 0.15, npeaks // 4)]))
+    # Round some m/z values so that adjacent differences of exactly 0.1 occur
+    mzs = np.sort(np.where(rng.random(len(mzs)) < 0.5, np.round(mzs, 1),
+                           mzs))
+    # Insert clusters by duplicating peaks at small m/z offsets
+    dup = rng.random(len(mzs)) < 0.3
+    mzs = np.sort(np.concatenate(
+        [mzs, mzs[dup] + rng.uniform(0., 0.1, dup.sum())]))
+    intensities = rng.integers(1, 4, len(mzs)).astype(float)
+    return np.column_stack([mzs, intensities])
+
+
+SPECIAL_SPECTRA = [
+    np.empty((0, 2)),
+    np.array([[150., 3.]]),
+    np.array([[150., 3.], [150.05, 3.]]),
+    np.array([[150., 3.], [150.5, 2.]]),
+    # A single cluster with tied intensities, and one with a clear maximum
+    np.array([[200., 1.], [200.05, 1.], [200.1, 1.]]),
+    np.array([[200., 1.], [200.05, 5.], [200.1, 5.], [200.15, 2.]]),
+    # Only iTRAQ reporter ion peaks
+    np.array([[113.1, 4.], [114.12, 1.], [117.05, 2.], [121.1, 8.]]),
+    np.array([[114.1, 4.], [114.15, 2.]]),
+]
+
+
+@pytest.mark.parametrize("peaks", SPECIAL_SPECTRA)
+def test_special_spectra(peaks):
+    np.testing.assert_array_equal(
+        centroid_peaks(peaks, np.array([0, len(peaks)]))[0],
+        reference_centroid(peaks).reshape(-1, 2))
+    np.testing.assert_array_equal(peaks[itraq_mask(peaks[:, 0])],
+                                  reference_remove_itraq(peaks))
+
+
+def test_random_spectra():
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        peaks = _random_peaks(rng, int(rng.integers(2, 100)))
+        expected = reference_centroid(peaks)
+
+        np.testing.assert_array_equal(
+            centroid_peaks(peaks, np.array([0, len(peaks)]))[0], expected)
+        np.testing.assert_array_equal(
+            Spectrum(peaks.copy(), 500., 2).centroid().remove_itraq()[:],
+            reference_remove_itraq(expected))
+
+
+def test_preprocess_block():
+    rng = np.random.default_rng(2)
+    spectra = [_random_peaks(rng, int(rng.integers(2, 50)))
+               for _ in range(50)] + SPECIAL_SPECTRA
+    rng.shuffle(spectra)
+
+    offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    np.cumsum([len(peaks) for peaks in spectra], out=offsets[1:])
+    peaks, new_offsets = preprocess_peaks(np.concatenate(spectra), offsets)
+
+    assert len(new_offsets) == len(spectra) + 1
+    for ii, spec_peaks in enumerate(spectra):
+        np.testing.assert_array_equal(
+            peaks[new_offsets[ii]:new_offsets[ii + 1]],
+            reference_remove_itraq(
+                reference_centroid(spec_peaks).reshape(-1, 2)))
+
+
+def test_preprocess_empty_block():
+    peaks, offsets = preprocess_peaks(np.empty((0, 2)), np.array([0]))
+    assert peaks.shape == (0, 2)
+    assert offsets.tolist() == [0]
+
+
+def test_two_peak_spectrum():
+    # A 2 x 2 peak array is taken to be row-oriented, i.e. (m/z, intensity)
+    # pairs, rather than transposed as column-oriented
+    spectrum = Spectrum(np.array([[150., 3.], [150.5, 2.]]), 500., 2)
+    np.testing.assert_array_equal(spectrum.centroid()[:],
+                                  [[150., 3.], [150.5, 2.]])
@@ -0,0 +1,297 @@
+#! /usr/bin/env python3
+"""
+Tests for the selective reading of spectra files, checked against reading
+the whole file.
+
+"""
+import base64
+import zlib
+
+import numpy as np
+import pytest
+
+from rPTMDetermine import spectra_readers
+from rPTMDetermine.spectra_index import index_path
+
+
+def write_mgf(path, num_spectra: int, seed: int = 1):
+    """
+    Writes an MGF file of random spectra, with IDs 1.1.1.<n>.1.
+
+    """
+    rng = np.random.default_rng(seed)
+    with open(path, "w") as fh:
+        for ii in range(num_spectra):
+            fh.write(f"BEGIN IONS\nTITLE=Locus:1.1.1.{ii}.1\n"
+                     f"PEPMASS={400 + ii * 3.1:.4f}\nCHARGE=2+\n"
+                     f"RTINSECONDS={ii}\n")
+            for mz in np.sort(rng.uniform(100., 1000., 20)):
+                fh.write(f"{mz:.4f} {rng.uniform(1., 100.):.2f}\n")
+            fh.write("END IONS\n")
+
+
+def _mzml_array(values: np.ndarray, name: str) -> str:
+    """
+    Constructs an mzML binaryDataArray of zlib-compressed 64-bit floats.
+
+    """
+    encoded = base64.b64encode(
+        zlib.compress(values.astype("<f8").tobytes())).decode()
+    return (f'<binaryDataArray encodedLength="{len(encoded)}">'
+            '<cvParam cvRef="MS" accession="MS:1000523" '
+            'name="64-bit float"/>'
+            '<cvParam cvRef="MS" accession="MS:1000574" '
+            'name="zlib compression"/>'
+            f'<cvParam cvRef="MS" name="{name} array"/>'
+            f'<binary>{encoded}</binary></binaryDataArray>')
+
+
+def write_mzml(path, num_spectra: int, indexed: bool, seed: int = 1):
+    """
+    Writes an mzML file of alternating MS1 and MS2 random spectra, with
+    IDs 0.1.<scan>, optionally wrapped as indexedmzML with an offset index.
+
+    """
+    rng = np.random.default_rng(seed)
+    ns = "http://psi.hupo.org/ms/mzml"
+    content = b""
+    if indexed:
+        content += f'<indexedmzML xmlns="{ns}">'.encode()
+    content += f'<mzML xmlns="{ns}"><run><spectrumList>'.encode()
+    offsets = []
+    for ii in range(num_spectra):
+        scan = ii + 1
+        ms_level = 1 if ii % 2 == 0 else 2
+        mzs = np.sort(rng.uniform(100., 1000., 20))
+        precursor = ""
+        if ms_level == 2:
+            precursor = (
+                '<precursorList count="1">'
+                f'<precursor spectrumRef="controllerType=0 '
+                f'controllerNumber=1 scan={scan - 1}">'
+                '<selectedIonList count="1"><selectedIon>'
+                f'<cvParam name="selected ion m/z" value="{400 + ii:.2f}"/>'
+                '<cvParam name="charge state" value="2"/>'
+                '</selectedIon></selectedIonList><activation>'
+                '<cvParam name="beam-type collision-induced dissociation"/>'
+                '<cvParam name="collision energy" value="30"/>'
+                '</activation></precursor></precursorList>')
+        spectrum = (
+            f'<spectrum index="{ii}" id="controllerType=0 '
+            f'controllerNumber=1 scan={scan}" defaultArrayLength="20">'
+            f'<cvParam name="ms level" value="{ms_level}"/>'
+            '<scanList count="1"><scan>'
+            f'<cvParam name="scan start time" value="{ii * 0.5}"/>'
+            f'</scan></scanList>{precursor}'
+            '<binaryDataArrayList count="2">'
+            f'{_mzml_array(mzs, "m/z")}'
+            f'{_mzml_array(rng.uniform(1., 100., 20), "intensity")}'
+            '</binaryDataArrayList></spectrum>\n').encode()
+        offsets.append((scan, len(content)))
+        content += spectrum
+    content += b"</spectrumList></run></mzML>"
+    if indexed:
+        index_offset = len(content)
+        content += b'<indexList count="1"><index name="spectrum">'
+        for scan, offset in offsets:
+            content += (f'<offset idRef="controllerType=0 controllerNumber=1 '
+                        f'scan={scan}">{offset}</offset>').encode()
+        content += (f'</index></indexList><indexListOffset>{index_offset}'
+                    '</indexListOffset></indexedmzML>').encode()
+    with open(path, "wb") as fh:
+        fh.write(content)
+
+
+def _mzxml_peaks(peaks: np.ndarray, precision: int,
+                 compressed: bool) -> str:
+    """
+    Constructs an mzXML peaks element of network byte order, interleaved
+    (m/z, intensity) pairs.
+
+    """
+    data = peaks.astype(f">f{precision // 8}").tobytes()
+    if compressed:
+        data = zlib.compress(data)
+    compression = ' compressionType="zlib"' if compressed else ""
+    return (f'<peaks precision="{precision}" byteOrder="network" '
+            f'contentType="m/z-int"{compression}>'
+            f'{base64.b64encode(data).decode()}</peaks>')
+
+
+def write_mzxml(path, num_cycles: int, indexed: bool, seed: int = 1):
+    """
+    Writes an mzXML file of MS1 scans, each with two MS2 scans nested
+    within it, with IDs 0.1.<scan>, optionally with a scan offset index.
+    The MS1 peaks are 32-bit and uncompressed, while the MS2 peaks are
+    64-bit and zlib-compressed.
+
+    Returns:
+        Dictionary of MS2 spectrum ID to (peaks, precursor m/z, charge,
+        retention time in seconds).
+
+    """
+    rng = np.random.default_rng(seed)
+    content = (b'<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+               b'<mzXML xmlns="http://sashimi.sourceforge.net/schema_revision'
+               b'/mzXML_3.2"><msRun>\n')
+    offsets = []
+    expected = {}
+    scan = 0
+
+    def _peaks():
+        return np.column_stack([np.sort(rng.uniform(100., 1000., 20)),
+                                rng.uniform(1., 100., 20)])
+
+    for ii in range(num_cycles):
+        scan += 1
+        offsets.append((scan, len(content)))
+        content += (
+            f'<scan num="{scan}" msLevel="1" peaksCount="20" '
+            f'retentionTime="PT{ii}M1.5S">'
+            f'{_mzxml_peaks(_peaks(), 32, False)}\n').encode()
+        for jj, method in enumerate(["HCD", "CID"]):
+            scan += 1
+            peaks = _peaks()
+            prec_mz = round(400 + 10 * ii + jj, 2)
+            ret_time = f"PT{ii}M{jj + 2.25}S"
+            expected[f"0.1.{scan}"] = (peaks, prec_mz, 2 + jj,
+                                       ii * 60 + jj + 2.25)
+            offsets.append((scan, len(content)))
+            content += (
+                f'<scan num="{scan}" msLevel="2" peaksCount="20" '
+                f'retentionTime="{ret_time}" collisionEnergy="30">'
+                f'<precursorMz precursorScanNum="{scan - jj - 1}" '
+                f'precursorCharge="{2 + jj}" activationMethod="{method}">'
+                f'{prec_mz}</precursorMz>'
+                f'{_mzxml_peaks(peaks, 64, True)}</scan>\n').encode()
+        content += b"</scan>\n"
+    content += b"</msRun>\n"
+    if indexed:
+        index_offset = len(content)
+        content += b'<index name="scan">\n'
+        for num, offset in offsets:
+            content += f'<offset id="{num}">{offset}</offset>\n'.encode()
+        content += (f'</index>\n<indexOffset>{index_offset}</indexOffset>'
+                    '\n').encode()
+    content += b"</mzXML>\n"
+    with open(path, "wb") as fh:
+        fh.write(content)
+    return expected
+
+
+def _assert_same_spectra(actual, expected):
+    """
+    Asserts that the dictionaries of spectra are equal.
+
+    """
+    assert sorted(actual) == sorted(expected)
+    for spec_id, spec in expected.items():
+        np.testing.assert_array_equal(actual[spec_id][:], spec[:])
+        assert actual[spec_id].prec_mz == spec.prec_mz
+        assert actual[spec_id].charge == spec.charge
+        assert actual[spec_id].retention_time == spec.retention_time
+
+
+@pytest.fixture
+def mgf_file(tmp_path):
+    path = str(tmp_path / "spectra.mgf")
+    write_mgf(path, 50)
+    return path
+
+
+def test_mgf_indexed_read(mgf_file):
+    all_spectra = spectra_readers.read_spectra_file(mgf_file)
+    assert len(all_spectra) == 50
+
+    spec_ids = ["1.1.1.49.1", "1.1.1.3.1", "missing", "1.1.1.0.1"]
+    spectra = spectra_readers.read_spectra_file(mgf_file, spec_ids=spec_ids)
+    _assert_same_spectra(
+        spectra, {s: all_spectra[s] for s in spec_ids if s in all_spectra})
+
+    # The index is persisted and reused
+    with open(index_path(mgf_file), "rb") as fh:
+        saved = fh.read()
+    _assert_same_spectra(
+        spectra_readers.read_spectra_file(mgf_file, spec_ids=spec_ids),
+        spectra)
+    with open(index_path(mgf_file), "rb") as fh:
+        assert fh.read() == saved
+
+
+def test_mgf_filtered_read(mgf_file):
+    all_spectra = spectra_readers.read_spectra_file(mgf_file)
+
+    spec_filter = spectra_readers.SpectrumFilter(
+        ["1.1.1.40.1"], [(400., 410.), (405., 420.), (500.5, 501.)])
+    spectra = spectra_readers.read_spectra_file(mgf_file,
+                                                spec_filter=spec_filter)
+    _assert_same_spectra(
+        spectra, {s: spec for s, spec in all_spectra.items()
+                  if s == "1.1.1.40.1" or 400. <= spec.prec_mz <= 420. or
+                  500.5 <= spec.prec_mz <= 501.})
+
+
+@pytest.mark.parametrize("indexed", [True, False])
+def test_mzml_indexed_read(tmp_path, monkeypatch, indexed):
+    path = str(tmp_path / "spectra.mzML")
+    write_mzml(path, 40, indexed)
+
+    all_spectra = spectra_readers.read_spectra_file(path)
+    assert len(all_spectra) == 20
+
+    # Only the binary data arrays of the requested MS2 spectra are decoded
+    decoded = []
+    decode_binary = spectra_readers.MZMLReader.decode_binary
+    monkeypatch.setattr(
+        spectra_readers.MZMLReader, "decode_binary",
+        staticmethod(lambda *args, **kwargs: decoded.append(1) or
+                     decode_binary(*args, **kwargs)))
+
+    # 0.1.1 is an MS1 spectrum
+    spec_ids = ["0.1.40", "0.1.2", "0.1.1", "missing", "0.1.18"]
+    spectra = spectra_readers.read_spectra_file(
+        path, spec_ids=spec_ids,
+        activation_method="beam-type collision-induced dissociation")
+    _assert_same_spectra(
+        spectra, {s: all_spectra[s] for s in spec_ids if s in all_spectra})
+    assert len(decoded) == 2 * len(spectra)
+
+    assert not spectra_readers.read_spectra_file(
+        path, spec_ids=spec_ids, activation_method="electron transfer "
+        "dissociation")
+
+
+@pytest.mark.parametrize("indexed", [True, False])
+def test_mzxml_indexed_read(tmp_path, monkeypatch, indexed):
+    path = str(tmp_path / "spectra.mzXML")
+    expected = write_mzxml(path, 10, indexed)
+
+    all_spectra = spectra_readers.read_spectra_file(path)
+    assert sorted(all_spectra) == sorted(expected)
+    for spec_id, (peaks, prec_mz, charge, ret_time) in expected.items():
+        np.testing.assert_array_equal(all_spectra[spec_id][:], peaks)
+        assert all_spectra[spec_id].prec_mz == prec_mz
+        assert all_spectra[spec_id].charge == charge
+        assert all_spectra[spec_id].retention_time == pytest.approx(ret_time)
+
+    # Only the peaks of the requested MS2 spectra are decoded
+    decoded = []
+    decode_peaks = spectra_readers.MZXMLReader.decode_peaks
+    monkeypatch.setattr(
+        spectra_readers.MZXMLReader, "decode_peaks",
+        staticmethod(lambda *args, **kwargs: decoded.append(1) or
+                     decode_peaks(*args, **kwargs)))
+
+    # 0.1.1 and 0.1.28 are MS1 spectra, the others are nested within them
+    spec_ids = ["0.1.30", "0.1.2", "0.1.1", "missing", "0.1.28", "0.1.15"]
+    spectra = spectra_readers.read_spectra_file(path, spec_ids=spec_ids)
+    _assert_same_spectra(
+        spectra, {s: all_spectra[s] for s in spec_ids if s in all_spectra})
+    assert len(spectra) == 3
+    assert len(decoded) == len(spectra)
+
+    # HCD scans are the first MS2 scan of each cycle
+    spectra = spectra_readers.read_spectra_file(
+        path, spec_ids=spec_ids,
+        activation_method="beam-type collision-induced dissociation")
+    _assert_same_spectra(spectra, {"0.1.2": all_spectra["0.1.2"]})